@@ -0,0 +1,96 @@
+# benchmarks/bench_text_split.py
+# -*- coding: utf-8 -*-
+"""
+章节分段基准：内置中文分句器 vs. 旧的 nltk.sent_tokenize 流程
+
+用法（在项目根目录下）：
+    python benchmarks/bench_text_split.py [章节文件.txt] [--repeat 20]
+
+未指定章节文件时使用合成的中文章节文本。
+旧流程包含每次调用都会执行的 nltk.download('punkt'/'punkt_tab')，与定稿时的真实开销一致。
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from novel_generator.vectorstore_utils import split_text_for_vectorstore, estimate_tokens
+
+
+def _synthetic_chapter(paragraphs: int = 120) -> str:
+    lines = []
+    for i in range(paragraphs):
+        lines.append(
+            f"林风抬头望向第{i}座山峰，云雾翻涌。“师兄，我们真的要进去吗？”小师妹低声问道。"
+            f"他没有回答，只是握紧了手中的剑……良久，他才开口：“走吧！”"
+        )
+    return "\n".join(lines)
+
+
+def _legacy_split(chapter_text: str, max_length: int = 500):
+    import nltk
+    nltk.download('punkt', quiet=True)
+    nltk.download('punkt_tab', quiet=True)
+    sentences = nltk.sent_tokenize(chapter_text)
+    final_segments = []
+    current_segment = []
+    current_length = 0
+    for sentence in sentences:
+        sentence_length = len(sentence)
+        if current_length + sentence_length > max_length:
+            if current_segment:
+                final_segments.append(" ".join(current_segment))
+            current_segment = [sentence]
+            current_length = sentence_length
+        else:
+            current_segment.append(sentence)
+            current_length += sentence_length
+    if current_segment:
+        final_segments.append(" ".join(current_segment))
+    return final_segments
+
+
+def _time(func, text: str, repeat: int):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), result
+
+
+def _describe(name: str, seconds: float, segments: list):
+    sizes = [estimate_tokens(s) for s in segments] or [0]
+    print(f"{name:<10} 中位耗时 {seconds * 1000:8.2f} ms | 分段数 {len(segments):4d} | "
+          f"token 最小/中位/最大 {min(sizes)}/{int(statistics.median(sizes))}/{max(sizes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="章节分段基准测试")
+    parser.add_argument("chapter_file", nargs="?", help="章节文本文件（UTF-8）")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.chapter_file:
+        with open(args.chapter_file, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = _synthetic_chapter()
+    print(f"输入：{len(text)} 字符，约 {estimate_tokens(text)} tokens，重复 {args.repeat} 次\n")
+
+    seconds, segments = _time(split_text_for_vectorstore, text, args.repeat)
+    _describe("builtin", seconds, segments)
+
+    try:
+        seconds, segments = _time(_legacy_split, text, args.repeat)
+        _describe("nltk", seconds, segments)
+    except Exception as e:
+        print(f"nltk      无法运行旧流程（未安装或离线下载失败）：{e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# benchmarks/bench_vector_backends.py
+# -*- coding: utf-8 -*-
+"""
+向量库后端基准：NumPy 内存映射后端 vs. Chroma（PersistentClient）
+
+用法（在项目根目录下）：
+    python benchmarks/bench_vector_backends.py [--docs 20000] [--dim 1024] [--queries 200] [--k 4]
+
+使用随机单位向量，不调用 embedding 接口，只比较后端本身的开销：
+导入耗时、批量写入、单条查询延迟（中位数 / P95）、批量多查询、删除，以及 NumPy 后端的压缩。
+未安装 chromadb 时只测 NumPy 后端。
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+
+def _random_unit_vectors(count: int, dim: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _report(name: str, label: str, seconds: float):
+    print(f"{name:<7} {label:<18} {seconds * 1000:10.2f} ms")
+
+
+def _bench_collection(name: str, collection, vectors: np.ndarray, queries: np.ndarray, k: int, batch: int):
+    ids = [f"doc_{i}" for i in range(len(vectors))]
+    metadatas = [{"source_type": "chapter", "chapter_number": i // 20} for i in range(len(vectors))]
+    documents = [f"文档{i}" for i in range(len(vectors))]
+
+    start = time.perf_counter()
+    for offset in range(0, len(vectors), batch):
+        collection.add(
+            ids=ids[offset:offset + batch],
+            embeddings=vectors[offset:offset + batch].tolist(),
+            documents=documents[offset:offset + batch],
+            metadatas=metadatas[offset:offset + batch]
+        )
+    _report(name, f"写入 {len(vectors)} 条", time.perf_counter() - start)
+
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        collection.query(query_embeddings=[query.tolist()], n_results=k, include=["documents", "distances"])
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    _report(name, "单查询 中位数", statistics.median(samples))
+    _report(name, "单查询 P95", samples[int(len(samples) * 0.95) - 1])
+
+    start = time.perf_counter()
+    collection.query(query_embeddings=queries[:16].tolist(), n_results=k, include=["documents", "distances"])
+    _report(name, "16 查询批量", time.perf_counter() - start)
+
+    where = {"chapter_number": {"$lt": len(vectors) // 40}}
+    start = time.perf_counter()
+    collection.query(query_embeddings=[queries[0].tolist()], n_results=k, where=where,
+                     include=["documents", "distances"])
+    _report(name, "带 where 查询", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    collection.delete(ids=ids[: len(ids) // 10])
+    _report(name, f"删除 {len(ids) // 10} 条", time.perf_counter() - start)
+
+
+def _recall(reference: list, candidate: list) -> float:
+    hits = sum(len(set(a) & set(b)) for a, b in zip(reference, candidate))
+    return hits / max(1, sum(len(a) for a in reference))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库后端基准测试")
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    vectors = _random_unit_vectors(args.docs, args.dim, seed=1)
+    queries = _random_unit_vectors(args.queries, args.dim, seed=2)
+    print(f"文档 {args.docs} 条，维度 {args.dim}，查询 {args.queries} 次，k={args.k}\n")
+
+    workdir = tempfile.mkdtemp(prefix="bench_vectors_")
+    try:
+        start = time.perf_counter()
+        from novel_generator.npy_vectorstore import NpyCollection
+        _report("numpy", "导入模块", time.perf_counter() - start)
+        npy = NpyCollection(os.path.join(workdir, "numpy"), "bench")
+        _bench_collection("numpy", npy, vectors, queries, args.k, args.batch)
+        start = time.perf_counter()
+        npy.compact()
+        _report("numpy", "压缩", time.perf_counter() - start)
+        npy_top = npy.query(query_embeddings=queries[:50].tolist(), n_results=args.k)["ids"]
+        print()
+
+        try:
+            start = time.perf_counter()
+            import chromadb
+            from chromadb.config import Settings
+            _report("chroma", "导入模块", time.perf_counter() - start)
+        except ImportError:
+            print("chroma  未安装 chromadb，跳过")
+            return
+        client = chromadb.PersistentClient(path=os.path.join(workdir, "chroma"),
+                                           settings=Settings(anonymized_telemetry=False))
+        chroma = client.create_collection("bench", metadata={"hnsw:space": "cosine"})
+        _bench_collection("chroma", chroma, vectors, queries, args.k, args.batch)
+        chroma_top = chroma.query(query_embeddings=queries[:50].tolist(), n_results=args.k)["ids"]
+        # NumPy 后端为精确检索，以它为基准衡量 HNSW 的近似召回率
+        print(f"\nchroma HNSW 相对精确检索的 recall@{args.k}: {_recall(npy_top, chroma_top):.3f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 # chapter_blueprint_parser.py
 # -*- coding: utf-8 -*-
+import os
 import re
+import hashlib
+import threading
+from collections import OrderedDict
 
 def parse_chapter_blueprint(blueprint_text: str):
     """
@@ -316,6 +320,121 @@ def parse_unit_blueprint(blueprint_text: str):
     return units
 
 
+def _default_chapter_info(target_chapter_number: int) -> dict:
+    """蓝图中找不到章节时的默认结构"""
+    return {
+        "chapter_number": target_chapter_number,
+        "chapter_title": f"第{target_chapter_number}章",
+        "chapter_role": "常规章节",
+        "chapter_purpose": "内容推进",
+        "suspense_level": "中等",
+        "foreshadowing": "无特殊伏笔",
+        "plot_twist_level": "★☆☆☆☆",
+        "surface_cultivation": "未设定",
+        "actual_cultivation": "未设定",
+        "scene_location": "未设定",
+        "chapter_summary": f"第{target_chapter_number}章的剧情发展"
+    }
+
+
+_MAX_UNIT_SPAN = 10000
+
+
+class BlueprintIndex:
+    """
+    章节目录的解析结果索引：整份蓝图只解析一次，按章节号、单元覆盖的章节号建立字典，
+    章节信息、下一章信息、所属单元均为 O(1) 查找。返回值为副本，调用方可自由修改。
+    """
+
+    def __init__(self, blueprint_text: str):
+        self.text = blueprint_text or ""
+        self.chapters = parse_chapter_blueprint(self.text) if self.text.strip() else []
+        self.units = parse_unit_blueprint(self.text) if self.text.strip() else []
+        self._chapter_by_number = {}
+        for chapter in self.chapters:
+            # 与逐个扫描的旧实现一致：同一章号出现多次时取第一个
+            self._chapter_by_number.setdefault(chapter["chapter_number"], chapter)
+        self._unit_by_chapter = {}
+        self._wide_units = []  # 章节范围异常大的单元不展开，查找时顺序比较
+        for unit in self.units:
+            if unit["end_chapter"] - unit["start_chapter"] > _MAX_UNIT_SPAN:
+                self._wide_units.append(unit)
+                continue
+            for number in range(unit["start_chapter"], unit["end_chapter"] + 1):
+                self._unit_by_chapter.setdefault(number, unit)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.text.strip()
+
+    def get_chapter(self, chapter_number: int):
+        """蓝图中的章节信息，不存在时返回 None"""
+        chapter = self._chapter_by_number.get(chapter_number)
+        return dict(chapter) if chapter is not None else None
+
+    def chapter_info(self, chapter_number: int) -> dict:
+        """章节信息，不存在时返回默认结构（同 get_chapter_info_from_blueprint）"""
+        return self.get_chapter(chapter_number) or _default_chapter_info(chapter_number)
+
+    def next_chapter_info(self, chapter_number: int) -> dict:
+        return self.chapter_info(chapter_number + 1)
+
+    def unit_for_chapter(self, chapter_number: int):
+        """章节所属单元信息，不存在时返回 None"""
+        unit = self._unit_by_chapter.get(chapter_number)
+        if unit is None:
+            unit = next((u for u in self._wide_units
+                         if u["start_chapter"] <= chapter_number <= u["end_chapter"]), None)
+        return dict(unit) if unit is not None else None
+
+
+_file_indexes = {}
+_text_indexes = OrderedDict()
+_TEXT_INDEX_CACHE_SIZE = 8
+_index_lock = threading.Lock()
+
+def get_blueprint_index(directory_file: str) -> BlueprintIndex:
+    """
+    读取章节目录文件并返回其索引。按文件缓存，文件的修改时间或大小变化后自动重新解析；
+    文件不存在时返回空索引。
+    """
+    key = os.path.normcase(os.path.abspath(directory_file))
+    try:
+        stat = os.stat(directory_file)
+        signature = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return BlueprintIndex("")
+    with _index_lock:
+        cached = _file_indexes.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    try:
+        with open(directory_file, "r", encoding="utf-8") as f:
+            text = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"[get_blueprint_index] 读取章节目录时发生错误: {e}")
+        text = ""
+    index = blueprint_index_for_text(text)
+    with _index_lock:
+        _file_indexes[key] = (signature, index)
+    return index
+
+def blueprint_index_for_text(blueprint_text: str) -> BlueprintIndex:
+    """按文本内容缓存的索引（最近使用的少量文本），供只持有蓝图文本的调用方使用"""
+    digest = hashlib.sha1((blueprint_text or "").encode("utf-8")).hexdigest()
+    with _index_lock:
+        index = _text_indexes.get(digest)
+        if index is not None:
+            _text_indexes.move_to_end(digest)
+            return index
+    index = BlueprintIndex(blueprint_text)
+    with _index_lock:
+        _text_indexes[digest] = index
+        while len(_text_indexes) > _TEXT_INDEX_CACHE_SIZE:
+            _text_indexes.popitem(last=False)
+    return index
+
+
 def get_unit_for_chapter(blueprint_text: str, target_chapter_number: int):
     """
     根据章节号查找所属单元信息
@@ -327,13 +446,7 @@ def get_unit_for_chapter(blueprint_text: str, target_chapter_number: int):
     返回:
         单元信息dict，如果找不到则返回None
     """
-    units = parse_unit_blueprint(blueprint_text)
-    
-    for unit in units:
-        if unit["start_chapter"] <= target_chapter_number <= unit["end_chapter"]:
-            return unit
-    
-    return None
+    return blueprint_index_for_text(blueprint_text).unit_for_chapter(target_chapter_number)
 
 
 def get_chapter_info_from_blueprint(blueprint_text: str, target_chapter_number: int):
@@ -341,24 +454,4 @@ def get_chapter_info_from_blueprint(blueprint_text: str, target_chapter_number:
     在已经加载好的章节蓝图文本中，找到对应章号的结构化信息，返回一个 dict。
     若找不到则返回一个默认的结构。
     """
-    all_chapters = parse_chapter_blueprint(blueprint_text)
-
-    for ch in all_chapters:
-
-        if ch["chapter_number"] == target_chapter_number:
-            return ch
-
-    # 默认返回，提供更有意义的默认值
-    return {
-        "chapter_number": target_chapter_number,
-        "chapter_title": f"第{target_chapter_number}章",
-        "chapter_role": "常规章节",
-        "chapter_purpose": "内容推进",
-        "suspense_level": "中等",
-        "foreshadowing": "无特殊伏笔",
-        "plot_twist_level": "★☆☆☆☆",
-        "surface_cultivation": "未设定",
-        "actual_cultivation": "未设定",
-        "scene_location": "未设定",
-        "chapter_summary": f"第{target_chapter_number}章的剧情发展"
-    }
+    return blueprint_index_for_text(blueprint_text).chapter_info(target_chapter_number)
@@ -1,5 +1,6 @@
 # main.py
 # -*- coding: utf-8 -*-
+import multiprocessing
 import customtkinter as ctk
 from ui import NovelGeneratorGUI
 
@@ -9,4 +10,6 @@ def main():
     app.mainloop()
 
 if __name__ == "__main__":
+    # 打包后的程序使用进程池（知识库批量导入）时需要
+    multiprocessing.freeze_support()
     main()
@@ -14,5 +14,5 @@ from .chapter import (
     generate_chapter_draft
 )
 from .finalization import finalize_chapter, enrich_chapter_text
-from .knowledge import import_knowledge_file
+from .knowledge import import_knowledge_file, import_knowledge_files
 from .vectorstore_utils import clear_vector_store
\ No newline at end of file
@@ -8,6 +8,7 @@ import json
 import logging
 import re  # 添加re模块导入
 import time  # 添加time模块导入
+from concurrent.futures import ThreadPoolExecutor
 from llm_adapters import create_llm_adapter
 from prompt_definitions import (
     first_chapter_draft_prompt, 
@@ -16,14 +17,44 @@ from prompt_definitions import (
     knowledge_filter_prompt,
     knowledge_search_prompt
 )
-from chapter_directory_parser import get_chapter_info_from_blueprint, get_unit_for_chapter
-from novel_generator.common import invoke_with_cleaning
+from chapter_directory_parser import get_blueprint_index
+from novel_generator.common import invoke_with_cleaning, extract_metadata, load_novel_settings
 from utils import read_file, clear_file_content, save_string_to_txt
+from novel_generator.index_queue import wait_for_index
+from novel_generator.chapter_summaries import get_fresh_summaries, assemble_short_summary
+from novel_generator.character_store import get_character_store
+from novel_generator.stage_graph import StageGraph
+from novel_generator.keyword_extraction import extract_search_keywords, DEFAULT_KEYWORD_EXTRACTOR
+from novel_generator.knowledge_rerank import rerank_knowledge_context, DEFAULT_KNOWLEDGE_FILTER
+from novel_generator.prompt_budget import (
+    PromptSection,
+    allocate_prompt_budget,
+    get_prompt_token_budget,
+    load_character_recency,
+    make_character_compressor,
+    compress_plot_arcs,
+    drop_trailing_blocks,
+    keep_head,
+    keep_tail
+)
 from novel_generator.vectorstore_utils import (
-    get_relevant_context_from_vector_store,
-    load_vector_store  # 添加导入
+    get_relevant_contexts_batch,
+    get_query_embedding_stats,
+    QueryEmbeddingStats,
+    build_retrieval_filter,
+    embed_queries_cached,
+    get_vectorstore_dir,
+    load_vector_store,
+    estimate_tokens,
+    CHAPTER_COLLECTION,
+    KNOWLEDGE_COLLECTION
 )
 
+# 检索时排除的最近章节数（这些章节已通过前文摘要和上一章结尾进入提示词）
+RECENT_CHAPTERS_EXCLUDED = 3
+# 等待后台向量库写入队列的最长时间（秒），超时后按库中现有数据检索
+INDEX_WAIT_TIMEOUT = 300
+
 # ============== 角色状态智能筛选功能 ==============
 
 def get_relevant_character_state(filepath: str, characters_involved: str, current_chapter: int) -> str:
@@ -38,12 +69,11 @@ def get_relevant_character_state(filepath: str, characters_involved: str, curren
     返回:
         筛选后的角色状态文本
     """
-    character_state_file = os.path.join(filepath, "character_state.txt")
-    
-    if not os.path.exists(character_state_file):
+    store = get_character_store(filepath)
+    if store is None:
         return "（无角色状态）"
     
-    full_state = read_file(character_state_file)
+    full_state = store.text
     
     # 如果角色状态较短（<8000字），直接返回全部
     if len(full_state) < 8000:
@@ -51,7 +81,7 @@ def get_relevant_character_state(filepath: str, characters_involved: str, curren
     
     # 如果未指定角色，使用索引提取活跃角色
     if not characters_involved or characters_involved.strip() in ["", "未指定", "无"]:
-        return _extract_active_characters(full_state, filepath, current_chapter)
+        return _extract_active_characters(store, filepath, current_chapter)
     
     # 解析指定角色列表（支持中英文逗号）
     specified_chars = []
@@ -60,99 +90,33 @@ def get_relevant_character_state(filepath: str, characters_involved: str, curren
         if char_name and char_name not in specified_chars:
             specified_chars.append(char_name)
     
-    # 尝试提取指定角色的状态
-    relevant_state = _extract_character_blocks(full_state, specified_chars)
+    # 按角色名直接取出状态块，末尾附上"新出场角色"部分（如果原状态中有）
+    relevant_state = store.render(specified_chars, include_new_section=False)
     
     # 如果提取结果太短（<500字），可能匹配失败，返回活跃角色
     if len(relevant_state) < 500:
-        return _extract_active_characters(full_state, filepath, current_chapter)
+        return _extract_active_characters(store, filepath, current_chapter)
     
-    # 在提取结果末尾添加"新出场角色"部分（如果原状态中有）
-    new_chars_section = _extract_new_characters_section(full_state)
-    if new_chars_section and new_chars_section not in relevant_state:
-        relevant_state += "\n\n" + new_chars_section
+    if store.new_section:
+        relevant_state += "\n\n" + store.new_section
     
     return relevant_state
 
 
-def _extract_character_blocks(full_state: str, char_names: list) -> str:
-    """
-    从完整状态中提取指定角色的状态块
-    
-    参数:
-        full_state: 完整的角色状态文本
-        char_names: 需要提取的角色名列表
-    
-    返回:
-        提取的角色状态文本
-    """
-    blocks = []
-    current_block = []
-    capturing = False
-    current_char = None
-    
-    lines = full_state.split('\n')
-    
-    for i, line in enumerate(lines):
-        # 检测角色名行（角色名开头 + 冒号，且不是属性行）
-        is_char_header = False
-        stripped_line = line.strip()
-        
-        # 跳过属性行和子属性行
-        if stripped_line.startswith('├') or stripped_line.startswith('│') or stripped_line.startswith('└'):
-            if capturing:
-                current_block.append(line)
-            continue
-        
-        # 检查是否是角色标题行
-        for name in char_names:
-            if stripped_line == f"{name}：" or stripped_line == f"{name}:" or stripped_line.startswith(f"{name}：") or stripped_line.startswith(f"{name}:"):
-                is_char_header = True
-                # 保存之前的块
-                if capturing and current_block:
-                    blocks.append('\n'.join(current_block))
-                current_block = [line]
-                current_char = name
-                capturing = True
-                break
-        
-        if not is_char_header:
-            if capturing:
-                # 检查是否是另一个角色的开始（非属性行且包含冒号）
-                if stripped_line and '：' in stripped_line or ':' in stripped_line:
-                    # 检查是否是新角色
-                    possible_name = stripped_line.split('：')[0].split(':')[0].strip()
-                    if possible_name and not possible_name.startswith('├') and not possible_name.startswith('│'):
-                        # 这可能是新角色的开始
-                        if possible_name not in char_names:
-                            # 结束当前捕获
-                            blocks.append('\n'.join(current_block))
-                            capturing = False
-                            current_block = []
-                            continue
-                
-                current_block.append(line)
-    
-    # 保存最后一个块
-    if capturing and current_block:
-        blocks.append('\n'.join(current_block))
-    
-    return '\n\n'.join(blocks)
-
-
-def _extract_active_characters(full_state: str, filepath: str, current_chapter: int) -> str:
+def _extract_active_characters(store, filepath: str, current_chapter: int) -> str:
     """
     提取活跃角色状态（用于状态文件过大时）
     活跃定义：最近30章内出现过的角色
     
     参数:
-        full_state: 完整的角色状态文本
+        store: 结构化角色状态（见 character_store）
         filepath: 小说保存路径
         current_chapter: 当前章节号
     
     返回:
         活跃角色的状态文本
     """
+    full_state = store.text
     index_file = os.path.join(filepath, "character_index.json")
     
     # 如果没有索引文件，返回状态文本的后3000字（假设最近更新的角色更相关）
@@ -175,40 +139,13 @@ def _extract_active_characters(full_state: str, filepath: str, current_chapter:
             # 没有活跃角色，返回全部
             return full_state
         
-        # 提取活跃角色状态
-        result = _extract_character_blocks(full_state, active_chars)
-        
-        # 添加新出场角色部分
-        new_chars_section = _extract_new_characters_section(full_state)
-        if new_chars_section and new_chars_section not in result:
-            result += "\n\n" + new_chars_section
-        
-        return result
+        # 提取活跃角色状态（含新出场角色部分）
+        return store.render(active_chars)
         
     except Exception as e:
         logging.warning(f"读取角色索引失败: {e}，使用截取方式")
         return full_state[-3000:] if len(full_state) > 3000 else full_state
 
-
-def _extract_new_characters_section(full_state: str) -> str:
-    """
-    提取"新出场角色"部分
-    
-    参数:
-        full_state: 完整的角色状态文本
-    
-    返回:
-        新出场角色部分文本，如果没有则返回空字符串
-    """
-    markers = ["新出场角色：", "新出场角色:", "新角色：", "新角色:"]
-    
-    for marker in markers:
-        if marker in full_state:
-            idx = full_state.find(marker)
-            return full_state[idx:].strip()
-    
-    return ""
-
 def get_last_n_chapters_text(chapters_dir: str, current_chapter_num: int, n: int = 3) -> list:
     """
     从目录 chapters_dir 中获取最近 n 章的文本内容，返回文本列表。
@@ -386,35 +323,6 @@ def safe_format(template: str, **kwargs) -> str:
         return template
 
 
-def extract_metadata(text: str, tag_name: str) -> str:
-    """提取知识库元数据，支持多种格式
-    
-    参数:
-        text: 包含元数据的文本
-        tag_name: 标签名称（如"类型"、"分类"、"关键词"）
-    
-    返回:
-        提取的元数据值，如果未找到则返回空字符串
-    """
-    if not text or not tag_name:
-        return ""
-    
-    # 支持多种换行符和格式的正则表达式模式
-    patterns = [
-        rf'【{tag_name}】(.+?)[\r\n]+',  # Windows换行符
-        rf'【{tag_name}】(.+?)\n',      # Unix换行符
-        rf'【{tag_name}】(.+?)(?=【|$)',  # 到下一个标签或结尾
-        rf'【{tag_name}】(.+?)\s+',      # 任意空白字符
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(1).strip()
-    
-    return ""
-
-
 def parse_search_keywords(response_text: str) -> list:
     """解析新版关键词格式（示例输入：'科技公司·数据泄露\n地下实验室·基因编辑'）
     
@@ -437,42 +345,105 @@ def parse_search_keywords(response_text: str) -> list:
             keywords.append(line)
     return keywords[:5]  # 最多取5组
 
-def apply_content_rules(texts: list, novel_number: int, chapter_info: dict = None) -> list:
-    """应用内容处理规则
+def retrieve_chapter_and_knowledge(embedding_adapter, filepath: str, queries: list, novel_number: int,
+                                   chapter_k: int, knowledge_k: int, stats: QueryEmbeddingStats = None) -> list:
+    """并行检索知识库与章节历史两个集合，按查询合并结果
+    
+    - 查询向量先统一批量计算一次（经查询向量缓存，命中情况累加到 stats），两个集合的检索直接复用这些向量；
+    - 章节历史排除最近 RECENT_CHAPTERS_EXCLUDED 章，知识库不加过滤；
+    - 两个集合各自混合检索 + MMR，条数分别由 chapter_k / knowledge_k 控制。
+    
+    返回:
+        与 queries 等长的列表，每项为该查询的命中列表（知识库命中在前）
+    """
+    if not queries:
+        return []
+    query_vectors = embed_queries_cached(embedding_adapter, queries, stats=stats)
+
+    def search(collection_name, k, where):
+        if k <= 0:
+            return [[] for _ in queries]
+        return get_relevant_contexts_batch(
+            embedding_adapter=embedding_adapter,
+            queries=queries,
+            filepath=filepath,
+            k=k,
+            where=where,
+            hybrid=True,
+            mmr=True,
+            collection_name=collection_name,
+            query_vectors=query_vectors
+        )
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        knowledge_future = executor.submit(search, KNOWLEDGE_COLLECTION, knowledge_k, None)
+        chapter_future = executor.submit(
+            search, CHAPTER_COLLECTION, chapter_k,
+            build_retrieval_filter(current_chapter=novel_number, exclude_recent=RECENT_CHAPTERS_EXCLUDED)
+        )
+        knowledge_hits = knowledge_future.result()
+        chapter_hits = chapter_future.result()
+    return [k_hits + c_hits for k_hits, c_hits in zip(knowledge_hits, chapter_hits)]
+
+def _source_chapter(text: str, metadata: dict = None, pattern: str = r'第[\d]+章|chapter_[\d]+'):
+    """判断检索片段是否来自历史章节
+    
+    返回:
+        (是否为历史章节, 章节号)。分段带有来源元数据时直接使用元数据；
+        旧数据（无元数据或来源未知）退回到在文本中查找"第N章"的启发式判断。
+    """
+    source_type = (metadata or {}).get("source_type")
+    if source_type == "chapter" and "chapter_number" in metadata:
+        return True, int(metadata["chapter_number"])
+    if source_type == "knowledge":
+        return False, None
+    if re.search(pattern, text):
+        chap_nums = list(map(int, re.findall(r'\d+', text)))
+        return True, max(chap_nums) if chap_nums else 0
+    return False, None
+
+def classify_content_rule(text: str, metadata: dict, novel_number: int) -> str:
+    """按片段来源与章节远近返回内容规则：SKIP（近两章）/ MOD40%（3~5章前）/ OK（更早的章节）/ PRIOR（知识库）"""
+    is_chapter, recent_chap = _source_chapter(text, metadata)
+    if not is_chapter:
+        return "PRIOR"
+    time_distance = novel_number - recent_chap
+    if time_distance <= 2:
+        return "SKIP"
+    if time_distance <= 5:
+        return "MOD40%"
+    return "OK"
+
+def apply_content_rules_with_metadata(texts: list, metadatas: list, novel_number: int,
+                                      chapter_info: dict = None) -> list:
+    """应用内容处理规则，同时保留每条结果对应的分段元数据
     
     参数:
         texts: 待处理的文本列表
+        metadatas: 与 texts 等长的分段元数据列表（可为 None 或含 None 项）
         novel_number: 当前章节编号
         chapter_info: 章节信息字典，包含chapter_role, chapter_purpose等字段
+    
+    返回:
+        [(处理后的文本, 元数据), ...]
     """
+    # 近似重复内容已在检索阶段由 MMR 多样性选择去除，这里不再按文本前缀哈希去重
     processed = []
-    seen_texts = set()  # 用于去重的集合，存储已处理的文本内容
+    metadatas = metadatas or [None] * len(texts)
     
-    for text in texts:
-        # 提取文本核心内容用于去重（去除前缀标记）
-        core_text = text
-        for prefix in ["[TECHNIQUE] ", "[SETTING] ", "[GENERAL] ", "[SKIP] ", "[MOD40%] ", "[OK] ", "[PRIOR] "]:
-            if core_text.startswith(prefix):
-                core_text = core_text[len(prefix):]
-                break
-        
-        # 使用核心文本的哈希值进行去重
-        text_hash = hash(core_text.strip()[:200])  # 使用前200字符进行哈希
-        if text_hash in seen_texts:
-            continue  # 跳过重复内容
-        seen_texts.add(text_hash)
-        
+    for text, chunk_metadata in zip(texts, metadatas):
+        chunk_metadata = chunk_metadata or {}
         # 提取并保留知识库元数据
         metadata = ""
         category_tag = ""  # 用于精细分类标记
         adaptation_score = 0  # 适配度评分（1-10分）
         
-        # 使用容错函数提取元数据
-        type_value = extract_metadata(text, "类型")
+        # 优先使用分段元数据，旧数据退回到从文本中提取标签
+        type_value = chunk_metadata.get("kb_type") or extract_metadata(text, "类型")
         if type_value:
             metadata += f"[类型:{type_value}]"
         
-        category_value = extract_metadata(text, "分类")
+        category_value = chunk_metadata.get("category") or extract_metadata(text, "分类")
         if category_value:
             category = category_value
             metadata += f"[分类:{category}]"
@@ -495,34 +466,53 @@ def apply_content_rules(texts: list, novel_number: int, chapter_info: dict = Non
                 category_tag = "[个人物品及状态盘点]"
 
         # 使用容错函数提取关键词
-        keywords_value = extract_metadata(text, "关键词")
+        keywords_value = chunk_metadata.get("keywords") or extract_metadata(text, "关键词")
         if keywords_value:
             keywords = keywords_value
             metadata += f"[关键词:{keywords}]"
-        if re.search(r'第[\d]+章', text) or re.search(r'chapter_[\d]+', text):
-            chap_nums = list(map(int, re.findall(r'\d+', text)))
-            recent_chap = max(chap_nums) if chap_nums else 0
-            time_distance = novel_number - recent_chap
-            
-            if time_distance <= 2:
-                processed.append(f"{category_tag}{metadata}[SKIP] 跳过近章内容：{text[:120]}...")
-            elif 3 <= time_distance <= 5:
-                processed.append(f"{category_tag}{metadata}[MOD40%] {text}（需修改≥40%）")
-            else:
-                processed.append(f"{category_tag}{metadata}[OK] {text}（可引用核心）")
+        rule = classify_content_rule(text, chunk_metadata, novel_number)
+        if rule == "SKIP":
+            processed.append((f"{category_tag}{metadata}[SKIP] 跳过近章内容：{text[:120]}...", chunk_metadata))
+        elif rule == "MOD40%":
+            processed.append((f"{category_tag}{metadata}[MOD40%] {text}（需修改≥40%）", chunk_metadata))
+        elif rule == "OK":
+            processed.append((f"{category_tag}{metadata}[OK] {text}（可引用核心）", chunk_metadata))
         else:
-            processed.append(f"{category_tag}{metadata}[PRIOR] {text}（优先使用）")
+            processed.append((f"{category_tag}{metadata}[PRIOR] {text}（优先使用）", chunk_metadata))
     return processed
 
-def apply_knowledge_rules(contexts: list, chapter_num: int) -> list:
-    """应用知识库使用规则"""
+def apply_content_rules(texts: list, novel_number: int, chapter_info: dict = None, metadatas: list = None) -> list:
+    """应用内容处理规则
+    
+    参数:
+        texts: 待处理的文本列表
+        novel_number: 当前章节编号
+        chapter_info: 章节信息字典，包含chapter_role, chapter_purpose等字段
+        metadatas: 可选，与 texts 等长的分段元数据；提供时按元数据判断章节远近
+    """
+    return [text for text, _ in apply_content_rules_with_metadata(texts, metadatas, novel_number, chapter_info)]
+
+def apply_knowledge_rules(contexts: list, chapter_num: int, metadatas: list = None) -> list:
+    """应用知识库使用规则
+    
+    metadatas 为与 contexts 等长的分段元数据；提供时按元数据中的来源与章节号判断，
+    否则（或旧数据缺少元数据时）退回到在文本中查找"第…章"的判断。
+    """
     processed = []
-    for text in contexts:
-        # 检测历史章节内容
-        if "第" in text and "章" in text:
-            # 提取章节号判断时间远近
+    metadatas = metadatas or [None] * len(contexts)
+    for text, metadata in zip(contexts, metadatas):
+        if (metadata or {}).get("source_type") in ("chapter", "knowledge"):
+            is_chapter, recent_chap = _source_chapter(text, metadata)
+        elif "第" in text and "章" in text:
+            is_chapter = True
             chap_nums = [int(s) for s in text.split() if s.isdigit()]
             recent_chap = max(chap_nums) if chap_nums else 0
+        else:
+            is_chapter, recent_chap = False, None
+
+        # 检测历史章节内容
+        if is_chapter:
+            # 根据章节号判断时间远近
             time_distance = chapter_num - recent_chap
             
             # 相似度处理规则
@@ -547,31 +537,18 @@ def get_filtered_knowledge_context(
     chapter_info: dict,
     retrieved_texts: list,
     max_tokens: int = 2048,
-    timeout: int = 600
+    timeout: int = 600,
+    retrieved_metadatas: list = None
 ) -> str:
-    """优化后的知识过滤处理"""
+    """优化后的知识过滤处理（retrieved_metadatas 为与 retrieved_texts 等长的分段元数据，可选）"""
     if not retrieved_texts:
         return "（无相关知识库内容）"
 
     try:
-        processed_texts = apply_knowledge_rules(retrieved_texts, chapter_info.get('chapter_number', 0))
-        
-        # 去重处理：基于文本内容的核心部分
-        seen_core_texts = set()
-        unique_processed_texts = []
-        for text in processed_texts:
-            # 提取核心文本内容（去除前缀标记）
-            core_text = text
-            for prefix in ["[历史章节限制] ", "[历史参考] ", "[外部知识] ", "[TECHNIQUE] ", "[SETTING] ", "[GENERAL] "]:
-                if core_text.startswith(prefix):
-                    core_text = core_text[len(prefix):]
-                    break
-            # 使用前150字符进行去重判断
-            core_hash = hash(core_text.strip()[:150])
-            if core_hash not in seen_core_texts:
-                seen_core_texts.add(core_hash)
-                unique_processed_texts.append(text)
-        processed_texts = unique_processed_texts
+        processed_texts = apply_knowledge_rules(
+            retrieved_texts, chapter_info.get('chapter_number', 0), retrieved_metadatas
+        )
+        # 检索结果已经过 MMR 多样性选择，近似重复的片段不会进入这里
         
         llm_adapter = create_llm_adapter(
             interface_format=interface_format,
@@ -585,7 +562,6 @@ def get_filtered_knowledge_context(
         
         # 限制检索文本长度并格式化，同时保留知识库元数据
         formatted_texts = []
-        seen_formatted = set()  # 格式化后的去重集合
         max_text_length = 600
         for i, text in enumerate(processed_texts, 1):
             # 检查并保留知识库元数据
@@ -620,12 +596,6 @@ def get_filtered_knowledge_context(
                 else:
                     full_text = full_text[:max_text_length] + "..."
             
-            # 最终去重检查
-            formatted_hash = hash(full_text.strip()[:200])
-            if formatted_hash in seen_formatted:
-                continue
-            seen_formatted.add(formatted_hash)
-            
             formatted_texts.append(f"[预处理结果{i}]\n{full_text}")
 
         # 使用格式化函数处理章节信息
@@ -680,6 +650,30 @@ def get_filtered_knowledge_context(
         logging.error(f"Error in knowledge filtering: {str(e)}")
         return "（内容过滤过程出错）"
 
+def _build_unit_info_text(unit_info: dict) -> str:
+    """构建提示词中的单元信息文本"""
+    if not unit_info:
+        return "\n[单元信息]\n当前章节未找到所属单元信息。\n"
+    # 获取单元标题和章节范围
+    unit_title = unit_info.get('unit_title', '未知')
+    start_chapter = unit_info.get('start_chapter', 0)
+    end_chapter = unit_info.get('end_chapter', 0)
+
+    # 如果单元标题不包含章节范围信息，则添加
+    if start_chapter > 0 and end_chapter > 0 and "（包含章节" not in unit_title:
+        unit_title = f"{unit_title}（包含章节：{start_chapter}-{end_chapter}章）"
+
+    return f"""
+[单元信息]
+单元标题：{unit_title}
+单元定位：{unit_info.get('unit_location', '未知')}
+核心作用：{unit_info.get('unit_purpose', '未知')}
+内容摘要：{unit_info.get('unit_summary', '未知')}
+修为等级范围：{unit_info.get('cultivation_range', '未知')}
+空间坐标范围：{unit_info.get('spatial_range', '未知')}
+推荐的跨章节写作手法：{unit_info.get('recommended_techniques', '无')}
+"""
+
 def build_chapter_prompt(
     api_key: str,
     base_url: str,
@@ -702,97 +696,90 @@ def build_chapter_prompt(
     max_tokens: int = 2048,
     timeout: int = 600,
     prompt_callback: callable = None,
-    progress_callback: callable = None
-) -> str:
+    progress_callback: callable = None,
+    return_timings: bool = False
+):
     """
     构造当前章节的请求提示词（完整实现版）
     修改重点：
     1. 优化知识库检索流程
     2. 新增内容重复检测机制
     3. 集成提示词应用规则
+    4. 各步骤按依赖关系组成阶段图并发执行（见 stage_graph）：读取文件、解析目录、筛选角色状态互不依赖；
+       前情摘要（LLM）与 embedding 适配器创建、向量库加载同时进行
 
     参数:
         prompt_callback: 提示词构建进度回调函数，接收文本参数
-        progress_callback: 进度更新回调函数，接收(progress, description)参数
+        progress_callback: 进度更新回调函数，接收(progress, description)参数，在每个阶段实际完成时调用
+        return_timings: 为 True 时返回 (提示词, {阶段名: 耗时秒数})，否则只返回提示词
     """
-    # 读取基础文件
+    build_start = time.perf_counter()
     if progress_callback:
-        progress_callback(0.1, "读取基础文件")
-    
-    # 初始化进度跟踪
-    current_progress = 0.1
-    progress_steps = [
-        (0.2, "获取章节和单元信息"),
-        (0.3, "准备生成章节摘要"),
-        (0.4, "正在生成章节摘要"),
-        (0.5, "生成知识库检索提示词"),
-        (0.6, "检索知识库"),
-        (0.7, "处理知识库内容"),
-        (0.8, "过滤知识库内容"),
-        (0.85, "构建完整提示词"),
-        (0.9, "提示词构建完成"),
-        (1.0, "完成")
-    ]
-    current_step = 0
+        progress_callback(0.0, "读取基础文件")
 
     arch_file = os.path.join(filepath, "Novel_architecture.txt")
-    novel_architecture_text = read_file(arch_file)
     directory_file = os.path.join(filepath, "Novel_directory.txt")
+    global_summary_file = os.path.join(filepath, "global_summary.txt")
+    plot_arcs_file = os.path.join(filepath, "plot_arcs.txt")
+    # 创建章节目录
+    chapters_dir = os.path.join(filepath, "chapters")
+    os.makedirs(chapters_dir, exist_ok=True)
+
+    def character_state_stage(inputs):
+        # 使用智能角色筛选功能，只获取相关角色状态（角色取自章节信息）
+        chapter_info = inputs["blueprint"].chapter_info(novel_number)
+        temp_characters = chapter_info.get("characters_involved", characters_involved)
+        return get_relevant_character_state(filepath, temp_characters, novel_number)
+
+    # 第一阶段：读取基础输入，各项互不依赖（角色筛选只依赖目录解析）
+    base_graph = StageGraph()
+    base_graph.add("settings", lambda _: load_novel_settings(filepath), description="读取小说设置")
+    base_graph.add("architecture", lambda _: read_file(arch_file), description="读取小说架构")
+    # 目录按文件缓存解析结果，文件未修改时不会重复解析
+    base_graph.add("blueprint", lambda _: get_blueprint_index(directory_file), description="解析章节目录")
+    base_graph.add("global_summary", lambda _: read_file(global_summary_file), description="读取全局摘要")
+    base_graph.add("plot_arcs", lambda _: read_file(plot_arcs_file) if os.path.exists(plot_arcs_file) else "",
+                   description="读取剧情要点")
+    base_graph.add("character_state", character_state_stage, deps=("blueprint",), description="筛选角色状态")
+    base_graph.add("recent_chapters", lambda _: get_last_n_chapters_text(chapters_dir, novel_number, n=3),
+                   description="读取前文")
+    base, timings = base_graph.run(progress_callback=progress_callback, progress_range=(0.0, 0.2))
+
+    def finish(prompt: str, description: str = "提示词构建完成"):
+        # 调用回调函数显示提示词内容
+        if prompt_callback:
+            prompt_callback(f"\n[完整提示词]\n{prompt}")
+        if progress_callback:
+            progress_callback(1.0, description)
+        timings["total"] = round(time.perf_counter() - build_start, 3)
+        logging.info(
+            f"第{novel_number}章提示词构建耗时 {timings['total']}s："
+            + "，".join(f"{name} {seconds}s" for name, seconds in timings.items() if name != "total")
+        )
+        return (prompt, timings) if return_timings else prompt
+
+    novel_settings = base["settings"]
+    novel_architecture_text = base["architecture"]
+    blueprint = base["blueprint"]
+    global_summary_text = base["global_summary"]
+    plot_arcs_text = base["plot_arcs"]
+    character_state_text = base["character_state"]
+    recent_texts = base["recent_chapters"]
 
     # 检查章节目录文件是否存在
     if not os.path.exists(directory_file):
         print(f"警告: 章节目录文件不存在: {directory_file}")
-        blueprint_text = ""
-    else:
-        blueprint_text = read_file(directory_file)
-        if not blueprint_text.strip():
-            print(f"警告: 章节目录文件为空: {directory_file}")
-        else:
-            pass
-    global_summary_file = os.path.join(filepath, "global_summary.txt")
-    global_summary_text = read_file(global_summary_file)
-    
-    # 使用智能角色筛选功能，只获取相关角色状态
-    # 获取章节信息中的角色信息
-    temp_chapter_info = get_chapter_info_from_blueprint(blueprint_text if 'blueprint_text' in dir() else read_file(directory_file), novel_number)
-    temp_characters = temp_chapter_info.get("characters_involved", characters_involved) if temp_chapter_info else characters_involved
-    character_state_text = get_relevant_character_state(filepath, temp_characters, novel_number)
-    
-    plot_arcs_file = os.path.join(filepath, "plot_arcs.txt")
-    plot_arcs_text = ""
-    if os.path.exists(plot_arcs_file):
-        plot_arcs_text = read_file(plot_arcs_file)
-    
+    elif blueprint.is_empty:
+        print(f"警告: 章节目录文件为空: {directory_file}")
+
+    chapter_info = blueprint.chapter_info(novel_number)
+    temp_characters = chapter_info.get("characters_involved", characters_involved)
     # 获取单元信息
-    unit_info = get_unit_for_chapter(blueprint_text, novel_number)
-    
-    # 构建单元信息文本
-    unit_info_text = ""
-    if unit_info:
-        # 获取单元标题和章节范围
-        unit_title = unit_info.get('unit_title', '未知')
-        start_chapter = unit_info.get('start_chapter', 0)
-        end_chapter = unit_info.get('end_chapter', 0)
-        
-        # 如果单元标题不包含章节范围信息，则添加
-        if start_chapter > 0 and end_chapter > 0 and "（包含章节" not in unit_title:
-            unit_title = f"{unit_title}（包含章节：{start_chapter}-{end_chapter}章）"
-        
-        unit_info_text = f"""
-[单元信息]
-单元标题：{unit_title}
-单元定位：{unit_info.get('unit_location', '未知')}
-核心作用：{unit_info.get('unit_purpose', '未知')}
-内容摘要：{unit_info.get('unit_summary', '未知')}
-修为等级范围：{unit_info.get('cultivation_range', '未知')}
-空间坐标范围：{unit_info.get('spatial_range', '未知')}
-推荐的跨章节写作手法：{unit_info.get('recommended_techniques', '无')}
-"""
-    else:
-        unit_info_text = "\n[单元信息]\n当前章节未找到所属单元信息。\n"
-    
+    unit_info = blueprint.unit_for_chapter(novel_number)
+    unit_info_text = _build_unit_info_text(unit_info)
+
     # 获取章节信息
-    if not blueprint_text or not blueprint_text.strip():
+    if blueprint.is_empty:
         print(f"错误: 章节目录为空，无法获取章节 {novel_number} 的信息")
         print(f"提示: 请先生成章节目录（步骤2）")
         # 构建默认提示词
@@ -827,18 +814,7 @@ def build_chapter_prompt(
             filtered_context="（无知识库内容）",
             unit_info=unit_info_text
         )
-        # 调用回调函数显示提示词内容
-        if prompt_callback:
-            prompt_callback(f"\n[完整提示词]\n{default_prompt}")
-        if progress_callback:
-            progress_callback(1.0, "章节目录为空，使用默认提示词")
-        return default_prompt
-
-    chapter_info = get_chapter_info_from_blueprint(blueprint_text, novel_number)
-
-    if progress_callback:
-        current_step += 1
-        progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
+        return finish(default_prompt, "章节目录为空，使用默认提示词")
 
     chapter_title = chapter_info.get("chapter_title", f"第{novel_number}章")
     chapter_role = chapter_info.get("chapter_role", "未设定")
@@ -853,7 +829,7 @@ def build_chapter_prompt(
 
     # 获取下一章节信息
     next_chapter_number = novel_number + 1
-    next_chapter_info = get_chapter_info_from_blueprint(blueprint_text, next_chapter_number)
+    next_chapter_info = blueprint.next_chapter_info(novel_number)
     next_chapter_title = next_chapter_info.get("chapter_title", "（未命名）")
     next_chapter_role = next_chapter_info.get("chapter_role", "过渡章节")
     next_chapter_purpose = next_chapter_info.get("chapter_purpose", "承上启下")
@@ -865,10 +841,6 @@ def build_chapter_prompt(
     next_scene_location = next_chapter_info.get("scene_location", "未设定")
     next_chapter_summary = next_chapter_info.get("chapter_summary", "衔接过渡内容")
 
-    # 创建章节目录
-    chapters_dir = os.path.join(filepath, "chapters")
-    os.makedirs(chapters_dir, exist_ok=True)
-
     # 第一章特殊处理
     if novel_number == 1:
         first_prompt = safe_format(
@@ -894,106 +866,144 @@ def build_chapter_prompt(
             novel_setting=novel_architecture_text,
             filtered_context="（无知识库内容）"
         )
-        # 调用回调函数显示提示词内容
-        if prompt_callback:
-            prompt_callback(f"\n[完整提示词]\n{first_prompt}")
-        if progress_callback:
-            progress_callback(1.0, "提示词构建完成")
-        return first_prompt
-
-    # 获取前文内容和摘要
-    if progress_callback:
-        current_step += 1
-        progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
-
-    recent_texts = get_last_n_chapters_text(chapters_dir, novel_number, n=3)
-    
-    try:
-        if progress_callback:
-            current_step += 1
-            progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
-
-        logging.info("Attempting to generate summary")
-        short_summary = summarize_recent_chapters(
-            interface_format=interface_format,
-            api_key=api_key,
-            base_url=base_url,
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            chapters_text_list=recent_texts,
-            novel_number=novel_number,
-            chapter_info=chapter_info,
-            next_chapter_info=next_chapter_info,
-            timeout=timeout
-        )
-        logging.info("Summary generated successfully")
-
-        # 添加延时，让用户能看到进度变化
-        time.sleep(1)
-    except Exception as e:
-        logging.error(f"Error in summarize_recent_chapters: {str(e)}")
-        short_summary = "（摘要生成失败）"
+        return finish(first_prompt)
+
+    chapter_info_for_filter = {
+        "chapter_number": novel_number,
+        "chapter_title": chapter_title,
+        "chapter_role": chapter_role,
+        "chapter_purpose": chapter_purpose,
+        "characters_involved": characters_involved,
+        "key_items": key_items,
+        "scene_location": scene_location,
+        "foreshadowing": foreshadowing,
+        "suspense_level": suspense_level,
+        "plot_twist_level": plot_twist_level,
+        "surface_cultivation": surface_cultivation,
+        "actual_cultivation": actual_cultivation,
+        "chapter_summary": chapter_summary,
+        "time_constraint": time_constraint
+    }
+
+    def short_summary_stage(_):
+        recent_numbers = list(range(max(1, novel_number - 3), novel_number))
+        written_numbers = [n for n, text in zip(recent_numbers, recent_texts) if text.strip()]
+        # 定稿时已为每章保存摘要；最近几章的摘要都有效（正文未再修改）时直接拼接，省去一次 LLM 调用
+        stored_summaries = get_fresh_summaries(filepath, dict(zip(recent_numbers, recent_texts)))
+        if written_numbers and all(n in stored_summaries for n in written_numbers):
+            logging.info(f"使用已保存的单章摘要（第{written_numbers[0]}-{written_numbers[-1]}章）")
+            return assemble_short_summary(stored_summaries, novel_number, chapter_info, next_chapter_info)
+        try:
+            logging.info("Attempting to generate summary")
+            summary = summarize_recent_chapters(
+                interface_format=interface_format,
+                api_key=api_key,
+                base_url=base_url,
+                model_name=model_name,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                chapters_text_list=recent_texts,
+                novel_number=novel_number,
+                chapter_info=chapter_info,
+                next_chapter_info=next_chapter_info,
+                timeout=timeout
+            )
+            logging.info("Summary generated successfully")
+            return summary
+        except Exception as e:
+            logging.error(f"Error in summarize_recent_chapters: {str(e)}")
+            return "（摘要生成失败）"
+
+    def embedding_stage(_):
+        # 与前情摘要同时进行：创建 embedding 适配器、等待后台写入队列、预先打开向量库集合
+        try:
+            from embedding_adapters import create_embedding_adapter
+            embedding_adapter = create_embedding_adapter(
+                embedding_interface_format,
+                embedding_api_key,
+                embedding_url,
+                embedding_model_name
+            )
+        except Exception as e:
+            logging.error(f"知识处理流程异常：创建 embedding 适配器失败: {str(e)}")
+            return None
+        # 章节检索只用得到最近 RECENT_CHAPTERS_EXCLUDED 章之前的分段，只有这些章节还在后台写入队列中时才需要等待
+        required_chapter = novel_number - RECENT_CHAPTERS_EXCLUDED - 1
+        if not wait_for_index(filepath, required_chapter, timeout=INDEX_WAIT_TIMEOUT, embedding_adapter=embedding_adapter):
+            logging.warning(f"第{required_chapter}章及之前的章节尚未全部写入向量库，按现有数据检索")
+        if os.path.exists(get_vectorstore_dir(filepath)):
+            for collection_name in (CHAPTER_COLLECTION, KNOWLEDGE_COLLECTION):
+                load_vector_store(embedding_adapter, filepath, collection_name)
+        return embedding_adapter
+
+    def keywords_stage(inputs):
+        short_summary = inputs["short_summary"]
+        try:
+            # 默认在本地由章节信息生成检索关键词（见 keyword_extraction），省去一次 LLM 调用；
+            # novel_settings.json 中 keyword_extractor 为 "llm"，或本地没有生成出关键词时，仍由 LLM 生成
+            keyword_method = novel_settings.get("keyword_extractor") or DEFAULT_KEYWORD_EXTRACTOR
+            keyword_groups = []
+            if keyword_method != "llm":
+                keyword_groups = extract_search_keywords(filepath, {
+                    "chapter_title": chapter_title,
+                    "chapter_role": chapter_role,
+                    "chapter_purpose": chapter_purpose,
+                    "chapter_summary": chapter_summary,
+                    "suspense_level": suspense_level,
+                    "foreshadowing": foreshadowing,
+                    "plot_twist_level": plot_twist_level,
+                    "characters_involved": characters_involved,
+                    "key_items": key_items,
+                    "scene_location": scene_location,
+                    "user_guidance": user_guidance,
+                    "short_summary": short_summary,
+                    "recommended_techniques": unit_info.get('recommended_techniques', '') if unit_info else ''
+                }, keyword_method)
+            if not keyword_groups:
+                llm_adapter = create_llm_adapter(
+                    interface_format=interface_format,
+                    base_url=base_url,
+                    model_name=model_name,
+                    api_key=api_key,
+                    temperature=0.3,
+                    max_tokens=max_tokens,
+                    timeout=timeout
+                )
 
-    # 获取前一章结尾
-    previous_excerpt = ""
-    for text in reversed(recent_texts):
-        if text.strip():
-            previous_excerpt = text[-800:] if len(text) > 800 else text
-            break
+                search_prompt = safe_format(
+                    knowledge_search_prompt,
+                    chapter_number=novel_number,
+                    chapter_title=chapter_title,
+                    chapter_role=chapter_role,
+                    chapter_purpose=chapter_purpose,
+                    plot_type=chapter_purpose,  # Using chapter_purpose as plot_type
+                    tension_level=suspense_level,  # Using suspense_level as tension_level
+                    plot_focus=chapter_role,  # Using chapter_role as plot_focus
+                    foreshadowing_type=foreshadowing,
+                    main_characters=characters_involved,
+                    character_states="",  # Not available in current context
+                    scene_location=scene_location,
+                    scene_features="",  # Not available in current context
+                    time_setting=time_constraint,
+                    atmosphere="",  # Not available in current context
+                    key_items=key_items,
+                    related_technology="",  # Not available in current context
+                    previous_summary="",  # Not available in current context
+                    current_summary=short_summary,
+                    future_expectations="",  # Not available in current context
+                    user_guidance=user_guidance
+                )
 
-    # 知识库检索和处理
-    if progress_callback:
-        current_step += 1
-        progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
+                search_response = invoke_with_cleaning(llm_adapter, search_prompt)
+                keyword_groups = parse_search_keywords(search_response)
+        except Exception as e:
+            logging.error(f"知识处理流程异常：生成检索关键词失败: {str(e)}")
+            keyword_groups = []
 
-    try:
-        # 生成检索关键词
-        if progress_callback:
-            current_step += 1
-            progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
-        llm_adapter = create_llm_adapter(
-            interface_format=interface_format,
-            base_url=base_url,
-            model_name=model_name,
-            api_key=api_key,
-            temperature=0.3,
-            max_tokens=max_tokens,
-            timeout=timeout
-        )
-        
-        search_prompt = safe_format(
-            knowledge_search_prompt,
-            chapter_number=novel_number,
-            chapter_title=chapter_title,
-            chapter_role=chapter_role,
-            chapter_purpose=chapter_purpose,
-            plot_type=chapter_purpose,  # Using chapter_purpose as plot_type
-            tension_level=suspense_level,  # Using suspense_level as tension_level
-            plot_focus=chapter_role,  # Using chapter_role as plot_focus
-            foreshadowing_type=foreshadowing,
-            main_characters=characters_involved,
-            character_states="",  # Not available in current context
-            scene_location=scene_location,
-            scene_features="",  # Not available in current context
-            time_setting=time_constraint,
-            atmosphere="",  # Not available in current context
-            key_items=key_items,
-            related_technology="",  # Not available in current context
-            previous_summary="",  # Not available in current context
-            current_summary=short_summary,
-            future_expectations="",  # Not available in current context
-            user_guidance=user_guidance
-        )
-        
-        search_response = invoke_with_cleaning(llm_adapter, search_prompt)
-        keyword_groups = parse_search_keywords(search_response)
-        
         # 添加单元推荐的写作手法作为额外检索关键词（高优先级）
         if unit_info and unit_info.get('recommended_techniques'):
             techniques = unit_info['recommended_techniques']
             # 处理多种分隔符：逗号、分号、顿号、空格
-            import re
             tech_list = re.split(r'[,，;；、\s]+', techniques)
             for tech in tech_list:
                 tech = tech.strip()
@@ -1001,117 +1011,133 @@ def build_chapter_prompt(
                     # 将单元推荐的技法作为高优先级关键词（在前面添加）
                     keyword_groups.insert(0, f"[单元技法] {tech}")
 
-        # 执行向量检索
-        all_contexts = []
-        seen_contexts = set()  # 用于去重的集合
-        from embedding_adapters import create_embedding_adapter
-        embedding_adapter = create_embedding_adapter(
-            embedding_interface_format,
-            embedding_api_key,
-            embedding_url,
-            embedding_model_name
+        # 本章出场人物、关键道具、场景地点作为精确词检索（由 BM25 负责命中专有名词）
+        entity_query = " ".join(
+            value for value in (characters_involved, key_items, scene_location)
+            if value and value not in ("未指定", "未设定")
         )
-        
-        store = load_vector_store(embedding_adapter, filepath)
-        if store:
-            collection_size = store._collection.count()
-            actual_k = min(embedding_retrieval_k, max(1, collection_size))
-            
-            for group in keyword_groups:
-                context = get_relevant_context_from_vector_store(
-                    embedding_adapter=embedding_adapter,
-                    query=group,
-                    filepath=filepath,
-                    k=actual_k
-                )
-                if context:
-                    # 使用内容的哈希值进行去重
-                    context_hash = hash(context.strip())
-                    if context_hash in seen_contexts:
-                        continue  # 跳过重复内容
-                    seen_contexts.add(context_hash)
-                    
-                    if any(kw in group.lower() for kw in ["技法", "手法", "模板"]):
-                        all_contexts.append(f"[TECHNIQUE] {context}")
-                    elif any(kw in group.lower() for kw in ["设定", "技术", "世界观"]):
-                        all_contexts.append(f"[SETTING] {context}")
-                    else:
-                        all_contexts.append(f"[GENERAL] {context}")
-
-        # 应用内容规则
-        # 先构建chapter_info字典
-        chapter_info_for_rules = {
-            "chapter_number": novel_number,
-            "chapter_title": chapter_title,
-            "chapter_role": chapter_role,
-            "chapter_purpose": chapter_purpose,
-            "characters_involved": characters_involved,
-            "key_items": key_items,
-            "scene_location": scene_location,
-            "foreshadowing": foreshadowing,
-            "suspense_level": suspense_level,
-            "plot_twist_level": plot_twist_level,
-            "surface_cultivation": surface_cultivation,
-            "actual_cultivation": actual_cultivation,
-            "chapter_summary": chapter_summary,
-            "time_constraint": time_constraint
-        }
-        processed_contexts = apply_content_rules(all_contexts, novel_number, chapter_info_for_rules)
-        
-        # 执行知识过滤
-        chapter_info_for_filter = {
-            "chapter_number": novel_number,
-            "chapter_title": chapter_title,
-            "chapter_role": chapter_role,
-            "chapter_purpose": chapter_purpose,
-            "characters_involved": characters_involved,
-            "key_items": key_items,
-            "scene_location": scene_location,
-            "foreshadowing": foreshadowing,  # 修复拼写错误
-            "suspense_level": suspense_level,
-            "plot_twist_level": plot_twist_level,
-            "surface_cultivation": surface_cultivation,
-            "actual_cultivation": actual_cultivation,
-            "chapter_summary": chapter_summary,
-            "time_constraint": time_constraint
-        }
-        
-        filtered_context = get_filtered_knowledge_context(
-            api_key=api_key,
-            base_url=base_url,
-            model_name=model_name,
-            interface_format=interface_format,
-            embedding_adapter=embedding_adapter,
-            filepath=filepath,
-            chapter_info=chapter_info_for_filter,
-            retrieved_texts=processed_contexts,
-            max_tokens=max_tokens,
-            timeout=timeout
-        )
-        
-    except Exception as e:
-        logging.error(f"知识处理流程异常：{str(e)}")
-        filtered_context = "（知识库处理失败）"
+        if entity_query and entity_query not in keyword_groups:
+            keyword_groups.append(entity_query)
+        return keyword_groups
 
+    def retrieval_stage(inputs):
+        keyword_groups = inputs["keywords"]
+        embedding_adapter = inputs["embedding"]
+        all_contexts = []
+        all_metadatas = []
+        all_embeddings = []
+        if embedding_adapter is None or not os.path.exists(get_vectorstore_dir(filepath)):
+            return all_contexts, all_metadatas, all_embeddings
+        try:
+            # 按本次检索统计查询向量缓存的节省情况（不受后台预构建等其他线程的检索影响）
+            embed_stats = QueryEmbeddingStats()
+            # 知识库与章节历史分别检索（各自的条数见 novel_settings.json），两路并行后按关键词组合并；
+            # 每路都是混合检索 + MMR，最近几章的原文已通过前文摘要进入提示词，在检索阶段按元数据排除
+            batch_hits = retrieve_chapter_and_knowledge(
+                embedding_adapter,
+                filepath,
+                keyword_groups,
+                novel_number,
+                chapter_k=novel_settings.get("chapter_retrieval_k") or embedding_retrieval_k,
+                knowledge_k=novel_settings.get("knowledge_retrieval_k") or embedding_retrieval_k,
+                stats=embed_stats
+            )
+            for group, hits in zip(keyword_groups, batch_hits):
+                if any(kw in group.lower() for kw in ["技法", "手法", "模板"]):
+                    prefix = "[TECHNIQUE]"
+                elif any(kw in group.lower() for kw in ["设定", "技术", "世界观"]):
+                    prefix = "[SETTING]"
+                else:
+                    prefix = "[GENERAL]"
+                # 每个命中分段单独成条，以便后续规则按各自的元数据处理
+                for hit in hits:
+                    all_contexts.append(f"{prefix} {hit['text'][:2000]}")
+                    all_metadatas.append(hit["metadata"])
+                    all_embeddings.append(hit.get("embedding"))
+
+            memo_stats = get_query_embedding_stats()
+            logging.info(
+                f"第{novel_number}章查询向量缓存：命中{embed_stats.hits}次（节省embedding调用），"
+                f"未命中{embed_stats.misses}次，缓存条目{memo_stats['size']}/{memo_stats['max_size']}"
+            )
+        except Exception as e:
+            logging.error(f"知识处理流程异常：检索失败: {str(e)}")
+        return all_contexts, all_metadatas, all_embeddings
+
+    def knowledge_filter_stage(inputs):
+        all_contexts, all_metadatas, all_embeddings = inputs["retrieval"]
+        embedding_adapter = inputs["embedding"]
+        try:
+            # 默认在本地按 embedding 相关度筛选（见 knowledge_rerank，片段向量取自检索结果）；
+            # knowledge_filter 为 "llm" 时使用 LLM 过滤
+            if (novel_settings.get("knowledge_filter") or DEFAULT_KNOWLEDGE_FILTER) != "llm":
+                return rerank_knowledge_context(
+                    embedding_adapter,
+                    chapter_info_for_filter,
+                    [(text, metadata, classify_content_rule(text, metadata, novel_number))
+                     for text, metadata in zip(all_contexts, all_metadatas)],
+                    embeddings=all_embeddings
+                )
+            # 应用内容规则
+            processed_pairs = apply_content_rules_with_metadata(
+                all_contexts, all_metadatas, novel_number, chapter_info_for_filter
+            )
+            return get_filtered_knowledge_context(
+                api_key=api_key,
+                base_url=base_url,
+                model_name=model_name,
+                interface_format=interface_format,
+                embedding_adapter=embedding_adapter,
+                filepath=filepath,
+                chapter_info=chapter_info_for_filter,
+                retrieved_texts=[text for text, _ in processed_pairs],
+                max_tokens=max_tokens,
+                timeout=timeout,
+                retrieved_metadatas=[metadata for _, metadata in processed_pairs]
+            )
+        except Exception as e:
+            logging.error(f"知识处理流程异常：{str(e)}")
+            return "（知识库处理失败）"
+
+    # 第二阶段：前情摘要与 embedding/向量库准备并行，随后依次生成关键词、检索、筛选知识
     # 注：不再单独输出知识库内容，避免与最终提示词中的内容重复
     # 知识库内容已包含在最终提示词的"知识库参考"部分
+    knowledge_graph = StageGraph()
+    knowledge_graph.add("short_summary", short_summary_stage, description="生成前情摘要")
+    knowledge_graph.add("embedding", embedding_stage, description="准备向量库")
+    knowledge_graph.add("keywords", keywords_stage, deps=("short_summary",), description="生成检索关键词")
+    knowledge_graph.add("retrieval", retrieval_stage, deps=("keywords", "embedding"), description="检索知识库")
+    knowledge_graph.add("knowledge_filter", knowledge_filter_stage, deps=("retrieval", "embedding"),
+                        description="筛选知识库内容")
+    knowledge, knowledge_timings = knowledge_graph.run(progress_callback=progress_callback, progress_range=(0.2, 0.95))
+    timings.update(knowledge_timings)
+    short_summary = knowledge["short_summary"]
+    filtered_context = knowledge["knowledge_filter"]
 
-    # 返回最终提示词
-    if progress_callback:
-        current_step += 1
-        progress_callback(progress_steps[current_step][0], progress_steps[current_step][1])
-
-    # 添加延时，让用户能看到进度变化
-    time.sleep(1)
+    # 获取前一章结尾
+    previous_excerpt = ""
+    for text in reversed(recent_texts):
+        if text.strip():
+            previous_excerpt = text[-800:] if len(text) > 800 else text
+            break
 
-    final_prompt = safe_format(
-        next_chapter_draft_prompt,
+    assemble_start = time.perf_counter()
+
+    # 可压缩的段落按优先级从低到高：全局摘要 < 知识库参考 < 剧情要点 < 单元信息 < 角色状态 < 上一章结尾 < 前情摘要
+    budget_sections = [
+        PromptSection("global_summary", global_summary_text, 3, 0.10, keep_tail),
+        PromptSection("filtered_context", filtered_context, 4, 0.10, drop_trailing_blocks),
+        PromptSection("plot_arcs", plot_arcs_text if plot_arcs_text else "（无剧情要点）", 5, 0.08, compress_plot_arcs),
+        PromptSection("unit_info", unit_info_text, 6, 0.05, keep_head),
+        PromptSection("character_state", character_state_text, 7, 0.15, make_character_compressor(
+            [c.strip() for c in str(temp_characters).replace('，', ',').split(',') if c.strip()],
+            load_character_recency(filepath)
+        )),
+        PromptSection("previous_chapter_excerpt", previous_excerpt, 8, 0.05, keep_tail),
+        PromptSection("short_summary", short_summary, 9, 0.10, keep_tail),
+    ]
+    prompt_fields = dict(
         user_guidance=user_guidance if user_guidance else "无特殊指导",
-        global_summary=global_summary_text,
-        previous_chapter_excerpt=previous_excerpt,
-        character_state=character_state_text,
-        short_summary=short_summary,
-        plot_arcs=plot_arcs_text if plot_arcs_text else "（无剧情要点）",
         novel_number=novel_number,
         chapter_title=chapter_title,
         chapter_role=chapter_role,
@@ -1138,20 +1164,15 @@ def build_chapter_prompt(
         next_actual_cultivation=next_actual_cultivation,
         next_scene_location=next_scene_location,
         next_chapter_summary=next_chapter_summary,
-        filtered_context=filtered_context,
-        unit_info=unit_info_text
     )
-
-    if prompt_callback:
-        prompt_callback(f"\n[完整提示词]\n{final_prompt}")
-
-    if progress_callback:
-        progress_callback(1.0, "提示词构建完成")
-
-    # 添加延时，让用户能看到最终状态
-    time.sleep(1)
-
-    return final_prompt
+    fixed_tokens = estimate_tokens(safe_format(
+        next_chapter_draft_prompt, **prompt_fields, **{section.name: "" for section in budget_sections}
+    ))
+    budget = get_prompt_token_budget(model_name, max_tokens, novel_settings)
+    allocated = allocate_prompt_budget(budget_sections, budget, fixed_tokens, label=f"第{novel_number}章提示词")
+    final_prompt = safe_format(next_chapter_draft_prompt, **prompt_fields, **allocated)
+    timings["assemble"] = round(time.perf_counter() - assemble_start, 3)
+    return finish(final_prompt)
 
 def generate_chapter_draft(
     api_key: str,
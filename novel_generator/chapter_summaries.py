@@ -0,0 +1,115 @@
+#novel_generator/chapter_summaries.py
+# -*- coding: utf-8 -*-
+"""
+单章摘要存储：定稿时为每章生成一份简短摘要保存到 chapter_summaries.json，
+生成后续章节时直接拼接最近几章的摘要作为"前情回顾"，省去一次读取前三章原文的 LLM 调用。
+每条摘要记录生成时章节正文的哈希，章节定稿后又被修改时视为过期，由调用方回退到 LLM 生成。
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from prompt_definitions import chapter_summary_prompt
+from novel_generator.common import invoke_with_cleaning
+
+CHAPTER_SUMMARIES_FILE = "chapter_summaries.json"
+CHAPTER_SUMMARY_MAX_CHARS = 300
+
+_SUMMARY_MARKERS = ("本章摘要:", "本章摘要：")
+_store_lock = threading.Lock()
+
+
+def _summaries_path(filepath: str) -> str:
+    return os.path.join(filepath, CHAPTER_SUMMARIES_FILE)
+
+def chapter_text_hash(chapter_text: str) -> str:
+    return hashlib.sha1((chapter_text or "").strip().encode("utf-8")).hexdigest()
+
+def load_chapter_summaries(filepath: str) -> dict:
+    """读取全部单章摘要：{章节号(int): {"title", "summary", "text_hash", "updated_at"}}"""
+    summary_file = _summaries_path(filepath)
+    if not os.path.exists(summary_file):
+        return {}
+    try:
+        with open(summary_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {int(number): entry for number, entry in data.get("chapters", {}).items()}
+    except Exception as e:
+        logging.warning(f"读取单章摘要失败: {e}")
+        return {}
+
+def save_chapter_summary(filepath: str, chapter_number: int, summary: str, chapter_text: str,
+                         chapter_title: str = ""):
+    """写入（或替换）一章的摘要，原子写回文件"""
+    with _store_lock:
+        summaries = load_chapter_summaries(filepath)
+        summaries[int(chapter_number)] = {
+            "title": chapter_title,
+            "summary": summary.strip(),
+            "text_hash": chapter_text_hash(chapter_text),
+            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        summary_file = _summaries_path(filepath)
+        tmp_file = summary_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"chapters": {str(n): summaries[n] for n in sorted(summaries)}},
+                      f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, summary_file)
+
+def get_fresh_summaries(filepath: str, chapter_texts: dict) -> dict:
+    """
+    chapter_texts 为 {章节号: 当前正文}，返回其中摘要仍然有效（正文未变）的 {章节号: 摘要条目}。
+    正文为空的章节（尚未写出）不需要摘要，也不返回。
+    """
+    summaries = load_chapter_summaries(filepath)
+    fresh = {}
+    for number, text in chapter_texts.items():
+        entry = summaries.get(int(number))
+        if text and text.strip() and entry and entry.get("text_hash") == chapter_text_hash(text):
+            fresh[int(number)] = entry
+    return fresh
+
+def generate_chapter_summary(llm_adapter, chapter_number: int, chapter_text: str, chapter_info: dict) -> str:
+    """调用 LLM 为一章生成摘要，失败时返回空字符串"""
+    prompt = chapter_summary_prompt.format(
+        chapter_number=chapter_number,
+        chapter_title=chapter_info.get("chapter_title", f"第{chapter_number}章"),
+        chapter_role=chapter_info.get("chapter_role", "常规章节"),
+        chapter_purpose=chapter_info.get("chapter_purpose", "内容推进"),
+        chapter_text=chapter_text,
+        max_chars=CHAPTER_SUMMARY_MAX_CHARS
+    )
+    response = invoke_with_cleaning(llm_adapter, prompt)
+    if not response:
+        return ""
+    for marker in _SUMMARY_MARKERS:
+        if marker in response:
+            response = response.split(marker, 1)[1]
+            break
+    return response.strip()[:CHAPTER_SUMMARY_MAX_CHARS * 2]
+
+def assemble_short_summary(summaries: dict, novel_number: int, chapter_info: dict, next_chapter_info: dict) -> str:
+    """
+    用最近几章的已存摘要拼出当前章节的衔接摘要：前情回顾（按章节顺序）+ 本章与下一章的目录要点。
+    summaries 为 {章节号: 摘要条目}（见 get_fresh_summaries）。
+    """
+    lines = ["【前情回顾】"]
+    for number in sorted(summaries):
+        entry = summaries[number]
+        title = entry.get("title") or f"第{number}章"
+        lines.append(f"第{number}章《{title}》：{entry.get('summary', '')}")
+    lines.append("")
+    lines.append("【本章衔接】")
+    lines.append(
+        f"第{novel_number}章《{chapter_info.get('chapter_title', '未命名')}》"
+        f"（{chapter_info.get('chapter_role', '常规章节')}，{chapter_info.get('chapter_purpose', '内容推进')}）："
+        f"{chapter_info.get('chapter_summary', '')}"
+    )
+    lines.append(
+        f"下一章第{novel_number + 1}章《{next_chapter_info.get('chapter_title', '（未命名）')}》："
+        f"{next_chapter_info.get('chapter_summary', '衔接过渡内容')}"
+    )
+    return "\n".join(lines)
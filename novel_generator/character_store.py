@@ -0,0 +1,286 @@
+#novel_generator/character_store.py
+# -*- coding: utf-8 -*-
+"""
+结构化角色状态存储：character_state.txt 仍是用户可编辑的原文（树形文本），
+这里把它一次性解析为按角色名索引的结构并保存到 character_state.json：
+- 每个角色保留原文块（原样输出，格式与 LLM 生成的一致）与解析出的属性条目；
+- 按角色名直接取块，按需拼出指定角色/活跃角色的状态文本，不再逐行扫描全文；
+- 原文的修改时间与大小记录在 JSON 中，原文在界面里被手工修改后自动重新解析。
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+
+CHARACTER_STATE_FILE = "character_state.txt"
+CHARACTER_STORE_FILE = "character_state.json"
+
+PARSER_VERSION = 2  # 角色名行规则变化时递增，旧版本解析结果会被重新解析
+
+CHARACTER_ATTRIBUTES = ("物品", "能力", "状态", "主要角色间关系网", "触发或加深的事件")
+
+_TREE_CHARS = ("├", "│", "└")
+_HEADER_RE = re.compile(r"^([^\s├│└:：\-]{1,30})\s*[:：]")
+_NEW_SECTION_RE = re.compile(r"^新(?:出场)?角色\s*[:：]")
+
+
+def character_header(lines: list, index: int):
+    """
+    判断 lines[index] 是否为角色名行，是则返回角色名，否则返回 None。
+    角色名行须顶格书写（"角色名："，冒号后可有说明），且下一个非空行是├/│/└开头的属性行；
+    因此"以下是更新后的角色状态："之类的开头说明与"新出场角色："不会被当作角色。
+    """
+    line = lines[index]
+    if not line or line[:1].isspace() or line.startswith(_TREE_CHARS):
+        return None
+    stripped = line.strip()
+    header = _HEADER_RE.match(stripped)
+    if not header or _NEW_SECTION_RE.match(stripped):
+        return None
+    for position in range(index + 1, len(lines)):
+        following = lines[position].strip()
+        if following:
+            return header.group(1) if following.startswith(_TREE_CHARS) else None
+    return None
+
+
+def parse_character_attributes(character_state: str) -> dict:
+    """
+    解析角色状态树形文本，返回 {角色名: {属性名: [条目, ...]}}。
+    角色名行的判断见 character_header，属性为 CHARACTER_ATTRIBUTES 中的预设属性。
+    """
+    characters = {}
+    current_char = None
+    current_attr = None
+
+    lines = character_state.split("\n")
+    for index, line in enumerate(lines):
+        # 不对行进行strip，以保留│前缀
+        original_line = line
+        line = line.strip()
+
+        # 检测角色名称行（与 split_character_blocks 使用同一规则，见 character_header）
+        name = character_header(lines, index)
+        if name:
+            current_char = name
+            characters[current_char] = {attr: [] for attr in CHARACTER_ATTRIBUTES}
+            current_attr = None
+            continue
+        if _NEW_SECTION_RE.match(line):
+            current_char = None
+            continue
+
+        if not current_char:
+            continue
+
+        # 属性行：行首直接是├──或└──（不带│前缀）；条目行：│  ├──内容
+        attr_match = re.match(r"^([├└]──)([^：:：]+)\s*[:：]?$", original_line)
+        if not attr_match:
+            attr_match = re.match(r"^([├└]──)([^：:：]+)\s*[:：]?$", line)
+        if attr_match:
+            attr_name = attr_match.group(2).strip()
+            if attr_name in characters[current_char]:
+                current_attr = attr_name
+            continue
+
+        # 条目支持两种格式：以│开头（标准格式），或缩进后直接以├──/└──开头
+        item_match = re.match(r"^│\s+([├└]──)\s*(.*)", original_line) or \
+            re.match(r"^\s+([├└]──)\s*(.*)", original_line)
+        if item_match and current_attr:
+            content = item_match.group(2).strip()
+            if not content:
+                continue
+            if content in characters[current_char]:
+                # 属性名被写成了条目格式，视为切换属性
+                current_attr = content
+            else:
+                characters[current_char][current_attr].append(content)
+
+    return characters
+
+
+def split_character_blocks(character_state: str) -> tuple:
+    """
+    把角色状态原文切分为 (开头说明, [(角色名, 原文块), ...], 新出场角色部分)。
+    角色块从角色名行（见 character_header）开始，到下一个角色名行或"新出场角色："为止；同名角色以最后一次为准。
+    """
+    preamble, blocks, new_section = [], [], []
+    current = None
+    lines = character_state.split("\n")
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if new_section or _NEW_SECTION_RE.match(stripped):
+            new_section.append(line)
+            continue
+        name = character_header(lines, index)
+        if name:
+            current = (name, [line])
+            blocks.append(current)
+        elif current is not None:
+            current[1].append(line)
+        else:
+            preamble.append(line)
+    return (
+        "\n".join(preamble).strip(),
+        [(name, "\n".join(lines).rstrip()) for name, lines in blocks],
+        "\n".join(new_section).strip()
+    )
+
+
+class CharacterStore:
+    """一份角色状态的结构化表示（见模块说明），由 get_character_store / update_character_store 创建"""
+
+    def __init__(self, text: str, preamble: str, order: list, blocks: dict, attributes: dict,
+                 new_section: str, source: dict = None):
+        self.text = text
+        self.preamble = preamble
+        self.order = order
+        self.blocks = blocks
+        self.attributes = attributes
+        self.new_section = new_section
+        self.source = source or {}
+
+    @classmethod
+    def from_text(cls, text: str, source: dict = None):
+        preamble, pairs, new_section = split_character_blocks(text or "")
+        blocks = {}
+        for name, block in pairs:
+            blocks.pop(name, None)
+            blocks[name] = block
+        order = list(blocks)
+        attributes = {}
+        for name in order:
+            parsed = parse_character_attributes(blocks[name])
+            attributes[name] = parsed.get(name) or {attr: [] for attr in CHARACTER_ATTRIBUTES}
+        return cls(text or "", preamble, order, blocks, attributes, new_section, source)
+
+    @classmethod
+    def from_dict(cls, data: dict, text: str):
+        return cls(text, data.get("preamble", ""), data.get("order", []), data.get("blocks", {}),
+                   data.get("attributes", {}), data.get("new_section", ""), data.get("source"))
+
+    def to_dict(self) -> dict:
+        return {
+            "parser": PARSER_VERSION,
+            "source": self.source,
+            "preamble": self.preamble,
+            "order": self.order,
+            "blocks": self.blocks,
+            "attributes": self.attributes,
+            "new_section": self.new_section
+        }
+
+    def names(self) -> list:
+        return list(self.order)
+
+    def __contains__(self, name) -> bool:
+        return name in self.blocks
+
+    def get_block(self, name: str) -> str:
+        return self.blocks.get(name, "")
+
+    def block_hash(self, name: str) -> str:
+        return hashlib.sha1(self.get_block(name).encode("utf-8")).hexdigest()
+
+    def render(self, names=None, include_new_section: bool = True) -> str:
+        """
+        拼出角色状态文本：names 为 None 时输出全部角色，否则只输出其中存在的角色（按原文顺序）；
+        include_new_section 为 True 时在末尾附上"新出场角色"部分。
+        """
+        wanted = None if names is None else set(names)
+        parts = [self.blocks[name] for name in self.order if wanted is None or name in wanted]
+        if include_new_section and self.new_section:
+            parts.append(self.new_section)
+        return "\n\n".join(parts)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _state_signature(state_file: str):
+    try:
+        stat = os.stat(state_file)
+    except OSError:
+        return None
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+def _save_store(filepath: str, store: CharacterStore):
+    store_file = os.path.join(filepath, CHARACTER_STORE_FILE)
+    tmp_file = store_file + ".tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(store.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, store_file)
+    except OSError as e:
+        logging.warning(f"保存结构化角色状态失败: {e}")
+
+def get_character_store(filepath: str):
+    """
+    返回小说当前角色状态的结构化存储；character_state.txt 不存在时返回 None。
+    进程内按文件缓存；原文未变化时直接使用 character_state.json，变化后重新解析并写回。
+    """
+    state_file = os.path.join(filepath, CHARACTER_STATE_FILE)
+    signature = _state_signature(state_file)
+    if signature is None:
+        return None
+    key = os.path.normcase(os.path.abspath(filepath))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is not None and store.source == signature:
+            return store
+
+    with open(state_file, "r", encoding="utf-8") as f:
+        text = f.read()
+    store = None
+    store_file = os.path.join(filepath, CHARACTER_STORE_FILE)
+    if os.path.exists(store_file):
+        try:
+            with open(store_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("source") == signature and data.get("parser") == PARSER_VERSION:
+                store = CharacterStore.from_dict(data, text)
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取结构化角色状态失败，将重新解析: {e}")
+    if store is None:
+        store = CharacterStore.from_text(text, signature)
+        _save_store(filepath, store)
+    with _stores_lock:
+        _stores[key] = store
+    return store
+
+def update_character_store(filepath: str, character_state: str) -> tuple:
+    """
+    定稿写入新的 character_state.txt 之后调用：解析新文本并写回结构化存储。
+    返回 (新存储, 内容有变化的角色名列表)；变化以角色原文块的哈希比较。
+    """
+    previous = get_character_store_cached(filepath)
+    state_file = os.path.join(filepath, CHARACTER_STATE_FILE)
+    store = CharacterStore.from_text(character_state, _state_signature(state_file))
+    _save_store(filepath, store)
+    with _stores_lock:
+        _stores[os.path.normcase(os.path.abspath(filepath))] = store
+    if previous is None:
+        changed = store.names()
+    else:
+        changed = [name for name in store.names()
+                   if name not in previous or previous.block_hash(name) != store.block_hash(name)]
+    return store, changed
+
+def get_character_store_cached(filepath: str):
+    """返回进程内缓存或磁盘上的上一份结构化存储（不检查原文是否已变化）"""
+    key = os.path.normcase(os.path.abspath(filepath))
+    with _stores_lock:
+        store = _stores.get(key)
+    if store is not None:
+        return store
+    store_file = os.path.join(filepath, CHARACTER_STORE_FILE)
+    if not os.path.exists(store_file):
+        return None
+    try:
+        with open(store_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return CharacterStore.from_dict(data, "")
+    except (OSError, ValueError):
+        return None
@@ -3,6 +3,8 @@
 """
 通用重试、清洗、日志工具
 """
+import os
+import json
 import logging
 import re
 import time
@@ -34,6 +36,34 @@ def remove_think_tags(text: str) -> str:
     """移除 <think>...</think> 包裹的内容"""
     return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
 
+def extract_metadata(text: str, tag_name: str) -> str:
+    """提取知识库元数据，支持多种格式
+    
+    参数:
+        text: 包含元数据的文本
+        tag_name: 标签名称（如"类型"、"分类"、"关键词"）
+    
+    返回:
+        提取的元数据值，如果未找到则返回空字符串
+    """
+    if not text or not tag_name:
+        return ""
+    
+    # 支持多种换行符和格式的正则表达式模式
+    patterns = [
+        rf'【{tag_name}】(.+?)[\r\n]+',  # Windows换行符
+        rf'【{tag_name}】(.+?)\n',      # Unix换行符
+        rf'【{tag_name}】(.+?)(?=【|$)',  # 到下一个标签或结尾
+        rf'【{tag_name}】(.+?)\s+',      # 任意空白字符
+    ]
+    
+    for pattern in patterns:
+        match = re.search(pattern, text)
+        if match:
+            return match.group(1).strip()
+    
+    return ""
+
 def debug_log(prompt: str, response_content: str):
     logging.info(
         f"\n[#########################################  Prompt  #########################################]\n{prompt}\n"
@@ -75,3 +105,30 @@ def invoke_with_cleaning(llm_adapter, prompt: str, max_retries: int = 3) -> str:
     
     return result
 
+
+# ============== 单本小说的生成设置 ==============
+# 保存在小说目录下的 novel_settings.json，缺失的键使用默认值
+NOVEL_SETTINGS_FILE = "novel_settings.json"
+DEFAULT_NOVEL_SETTINGS = {
+    "chapter_retrieval_k": None,     # 每个检索词从章节历史中取的条数（None 时使用界面上的检索数量）
+    "knowledge_retrieval_k": None,   # 每个检索词从知识库中取的条数（None 时使用界面上的检索数量）
+    "chapter_history_window": 0,     # 章节历史向量库只保留最近 N 章的分段（0 为全部保留）
+    "semantic_chunking": False,      # 章节写入向量库时按语义边界分段（每次定稿都要对全章逐句 embedding，默认按长度分段）
+    "keyword_extractor": "tfidf",    # 知识库检索关键词的生成方式：tfidf / keybert（本地）或 llm
+    "knowledge_filter": "local",     # 检索结果的筛选方式：local（本地相关度排序）或 llm（LLM 过滤，较慢）
+    "prompt_token_budget": None,     # 章节提示词的 token 上限（None 时按模型上下文窗口自动计算，最多 24000）
+    "prebuild_next_prompt": False,   # 定稿后是否在后台预构建下一章的提示词
+    "prompt_cache_size": 20,         # 提示词构建结果缓存的条数（0 为不缓存）
+}
+
+def load_novel_settings(filepath: str) -> dict:
+    """读取小说目录下的 novel_settings.json，与默认值合并后返回"""
+    settings = dict(DEFAULT_NOVEL_SETTINGS)
+    path = os.path.join(filepath, NOVEL_SETTINGS_FILE)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                settings.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取小说设置失败，使用默认设置: {e}")
+    return settings
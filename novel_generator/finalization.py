@@ -7,13 +7,18 @@ import os
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from llm_adapters import create_llm_adapter
 from embedding_adapters import create_embedding_adapter
 from prompt_definitions import summary_prompt, update_character_state_prompt, update_plot_arcs_prompt
-from novel_generator.common import invoke_with_cleaning
+from novel_generator.common import invoke_with_cleaning, load_novel_settings
 from utils import read_file, clear_file_content, save_string_to_txt
 from novel_generator.vectorstore_utils import update_vector_store
-from chapter_directory_parser import get_chapter_info_from_blueprint
+from novel_generator.index_queue import enqueue_chapter_index
+from novel_generator.chapter_summaries import generate_chapter_summary, save_chapter_summary
+from novel_generator.character_store import update_character_store
+from novel_generator.role_index import update_role_index
+from chapter_directory_parser import get_blueprint_index
 
 def finalize_chapter(
     novel_number: int,
@@ -30,7 +35,8 @@ def finalize_chapter(
     interface_format: str,
     max_tokens: int,
     timeout: int = 600,
-    log_func=None
+    log_func=None,
+    background_index: bool = True
 ):
     """
     对指定章节做最终处理：更新前文摘要、更新角色状态、插入向量库等。
@@ -38,6 +44,8 @@ def finalize_chapter(
     
     参数:
         log_func: 可选的日志函数，用于将日志输出到UI。如果为None，则使用logging模块。
+        background_index: 为True时向量库写入交给后台队列（见 index_queue），定稿立即返回；
+            为False时在本函数内同步写入。
     """
     def log(message):
         if log_func:
@@ -82,8 +90,8 @@ def finalize_chapter(
     # 步骤2.5: 获取章节信息（用于摘要生成）
     log("📋 步骤2.5/7: 获取章节信息")
     directory_file = os.path.join(filepath, "Novel_directory.txt")
-    blueprint_text = read_file(directory_file)
-    chapter_info = get_chapter_info_from_blueprint(blueprint_text, novel_number)
+    blueprint = get_blueprint_index(directory_file)
+    chapter_info = blueprint.chapter_info(novel_number)
     
     chapter_title = chapter_info.get("chapter_title", f"第{novel_number}章")
     chapter_role = chapter_info.get("chapter_role", "未设定")
@@ -114,6 +122,13 @@ def finalize_chapter(
         log(f"❌ LLM适配器创建失败: {e}")
         return
 
+    # 单章摘要与后续步骤互不依赖，在后台与它们并行生成，供后续章节直接拼接前情回顾
+    summary_executor = ThreadPoolExecutor(max_workers=1)
+    chapter_summary_future = summary_executor.submit(
+        generate_chapter_summary, llm_adapter, novel_number, chapter_text, chapter_info
+    )
+    summary_executor.shutdown(wait=False)
+
     # 步骤4: 更新前文摘要
     log("📋 步骤4/7: 更新前文摘要")
     log("📝 正在生成新的前文摘要...")
@@ -205,43 +220,95 @@ def finalize_chapter(
     save_string_to_txt(new_char_state, character_state_file)
     clear_file_content(plot_arcs_file)
     save_string_to_txt(new_plot_arcs, plot_arcs_file)
-    
-    # 同步角色库
-    log("👥 正在同步角色库...")
+
+    # 保存单章摘要
+    log("📝 正在保存本章摘要...")
     try:
-        _sync_character_library(filepath, new_char_state)
-        log("✓ 角色库同步完成")
+        chapter_summary = chapter_summary_future.result()
+        if chapter_summary:
+            save_chapter_summary(filepath, novel_number, chapter_summary, chapter_text, chapter_title)
+            log(f"✓ 本章摘要已保存（共{len(chapter_summary)}字）")
+        else:
+            log("⚠️ 本章摘要生成失败，生成后续章节时将临时汇总前文")
     except Exception as e:
-        log(f"❌ 同步角色库时出错: {e}")
-        log("⚠️ 角色库同步失败，但继续流程")
-
-    # 更新角色索引（用于智能筛选）
-    log("📇 正在更新角色索引...")
+        log(f"❌ 生成本章摘要时出错: {e}")
+        log("⚠️ 本章摘要生成失败，但继续流程")
+    
+    # 更新结构化角色状态（一次解析，角色库同步、角色索引与向量库元数据共用）
+    char_store = None
     try:
-        _update_character_index(filepath, novel_number, chapter_text, new_char_state)
-        log("✓ 角色索引更新完成")
+        char_store, changed_chars = update_character_store(filepath, new_char_state)
+        log(f"✓ 结构化角色状态已更新（共{len(char_store.names())}个角色，本章变化{len(changed_chars)}个）")
     except Exception as e:
-        log(f"❌ 更新角色索引时出错: {e}")
-        log("⚠️ 角色索引更新失败，但继续流程")
+        logging.warning(f"更新结构化角色状态失败: {e}")
+        log(f"❌ 更新结构化角色状态时出错: {e}")
+        log("⚠️ 结构化角色状态更新失败，跳过角色库同步与角色索引更新，但继续流程")
+
+    if char_store is not None:
+        # 同步角色库（只重写状态有变化或文件缺失的角色）
+        log("👥 正在同步角色库...")
+        try:
+            written = _sync_character_library(filepath, char_store, changed_chars)
+            log(f"✓ 角色库同步完成（写入{written}个角色文件）")
+        except Exception as e:
+            log(f"❌ 同步角色库时出错: {e}")
+            log("⚠️ 角色库同步失败，但继续流程")
+
+        # 更新角色索引（用于智能筛选）
+        log("📇 正在更新角色索引...")
+        try:
+            _update_character_index(filepath, novel_number, char_store.names())
+            log("✓ 角色索引更新完成")
+        except Exception as e:
+            log(f"❌ 更新角色索引时出错: {e}")
+            log("⚠️ 角色索引更新失败，但继续流程")
 
     # 步骤7: 更新向量库
     log("📋 步骤7/7: 更新向量库")
     log("🔍 正在更新向量库...")
     try:
-        updated_count = update_vector_store(
-            embedding_adapter=create_embedding_adapter(
-                embedding_interface_format,
-                embedding_api_key,
-                embedding_url,
-                embedding_model_name
-            ),
-            new_chapter=chapter_text,
-            filepath=filepath
+        # 分段元数据：所属单元、候选角色（角色状态中的全部角色 + 本章蓝图中的出场角色）
+        unit = blueprint.unit_for_chapter(novel_number)
+        character_names = char_store.names() if char_store is not None else []
+        if characters_involved and characters_involved != "未指定":
+            character_names.extend(
+                name.strip() for name in re.split(r'[,，;；、\s]+', characters_involved) if name.strip()
+            )
+        embedding_adapter = create_embedding_adapter(
+            embedding_interface_format,
+            embedding_api_key,
+            embedding_url,
+            embedding_model_name
         )
-        if updated_count > 0:
-            log(f"✓ 向量库更新成功，本次更新{updated_count}条数据")
+        novel_settings = load_novel_settings(filepath)
+        history_window = novel_settings.get("chapter_history_window", 0)
+        semantic_chunking = bool(novel_settings.get("semantic_chunking"))
+        if background_index:
+            enqueue_chapter_index(
+                filepath,
+                novel_number,
+                embedding_adapter,
+                unit_number=unit["unit_number"] if unit else None,
+                character_names=character_names,
+                history_window=history_window,
+                semantic_chunking=semantic_chunking
+            )
+            log("✓ 已加入后台向量库写入队列，写入完成前生成后续章节时会按需等待")
         else:
-            log("⚠️ 向量库更新失败或无数据更新")
+            updated_count = update_vector_store(
+                embedding_adapter=embedding_adapter,
+                new_chapter=chapter_text,
+                filepath=filepath,
+                chapter_number=novel_number,
+                unit_number=unit["unit_number"] if unit else None,
+                character_names=character_names,
+                history_window=history_window,
+                semantic_chunking=semantic_chunking
+            )
+            if updated_count > 0:
+                log(f"✓ 向量库更新成功，本次更新{updated_count}条数据")
+            else:
+                log("⚠️ 向量库更新失败或无数据更新")
     except Exception as e:
         log(f"❌ 更新向量库时出错: {e}")
         log("⚠️ 向量库更新失败，但继续流程")
@@ -277,12 +344,17 @@ def enrich_chapter_text(
     return enriched_text
 
 
-def _sync_character_library(filepath: str, character_state: str):
+def _sync_character_library(filepath: str, char_store, changed_names=None) -> int:
     """
     将角色状态同步到角色库
-    """
-    import re
     
+    参数:
+        char_store: 结构化角色状态（见 character_store）
+        changed_names: 状态有变化的角色；为None时重写全部角色。角色文件缺失时总会写入
+    
+    返回:
+        写入的角色文件数
+    """
     # 角色库路径
     library_path = os.path.join(filepath, "角色库")
     os.makedirs(library_path, exist_ok=True)
@@ -291,12 +363,15 @@ def _sync_character_library(filepath: str, character_state: str):
     all_category = os.path.join(library_path, "全部")
     os.makedirs(all_category, exist_ok=True)
     
-    # 解析角色状态
-    characters = _parse_character_state(character_state)
+    changed = None if changed_names is None else set(changed_names)
+    written_files = []
     
     # 更新或创建角色文件
-    for char_name, char_data in characters.items():
+    for char_name in char_store.names():
         char_file = os.path.join(all_category, f"{char_name}.txt")
+        if changed is not None and char_name not in changed and os.path.exists(char_file):
+            continue
+        char_data = char_store.attributes.get(char_name, {})
         
         # 构建角色文件内容
         content_lines = [f"{char_name}："]
@@ -309,110 +384,20 @@ def _sync_character_library(filepath: str, character_state: str):
         # 写入文件
         with open(char_file, "w", encoding="utf-8") as f:
             f.write("\n".join(content_lines))
+        written_files.append(char_file)
+    # 只更新写入过的角色在角色库索引中的条目
+    if written_files:
+        update_role_index(filepath, written_files)
+    return len(written_files)
 
 
-def _parse_character_state(character_state: str) -> dict:
-    """
-    解析角色状态文本，返回角色字典
-    """
-    import re
-    
-    characters = {}
-    current_char = None
-    current_attr = None
-    
-    for line in character_state.split("\n"):
-        # 不对行进行strip，以保留│前缀
-        original_line = line
-        line = line.strip()
-        
-        # 检测角色名称行（兼容中英文冒号和前后空格）
-        role_match = re.match(r"^([\u4e00-\u9fa5a-zA-Z0-9]+)\s*[:：]\s*$", line)
-        if role_match:
-            current_char = role_match.group(1).strip()
-            characters[current_char] = {
-                "物品": [],
-                "能力": [],
-                "状态": [],
-                "主要角色间关系网": [],
-                "触发或加深的事件": []
-            }
-            current_attr = None
-            continue
-        
-        if not current_char:
-            continue
-        
-        # 解析属性（支持子属性）
-        # 关键区分：
-        # - 属性行格式：├──属性名（没有│前缀）
-        # - 条目行格式：│  ├──内容（有│前缀）
-        # 所以属性匹配应该只匹配行首就是├──或└──的行（不带│前缀）
-        
-        # 匹配属性行：行首直接是├──或└──（不带│前缀）
-        attr_match = re.match(r"^([├└]──)([^：:：]+)\s*[:：]?$", original_line)
-        if not attr_match:
-            # 尝试strip后的行
-            attr_match = re.match(r"^([├└]──)([^：:：]+)\s*[:：]?$", line)
-        
-        if attr_match:
-            prefix, attr_name = attr_match.groups()
-            attr_name = attr_name.strip()
-            # 匹配预设属性
-            for preset_attr in characters[current_char]:
-                if attr_name == preset_attr:
-                    current_attr = preset_attr
-                    break
-            continue
-        
-        # 解析属性条目 - 支持两种格式：
-        # 1. 以│开头的条目（标准格式）
-        # 2. 直接以├──或└──开头的条目（非标准格式）
-        # 注意：必须确保不将属性分类行误识别为条目
-        item_match = re.match(r"^│\s+([├└]──)\s*(.*)", original_line)
-        if item_match and current_attr:
-            prefix, content = item_match.groups()
-            content = content.strip()
-            if content:
-                # 首先检查内容是否是属性分类名称
-                is_attr_name = False
-                for preset_attr in characters[current_char]:
-                    if content == preset_attr:
-                        # 这是属性行，切换当前属性
-                        current_attr = preset_attr
-                        is_attr_name = True
-                        break
-                
-                # 如果不是属性名称，才作为条目添加
-                if not is_attr_name:
-                    characters[current_char][current_attr].append(content)
-        else:
-            # 尝试解析不以│开头的条目
-            direct_item_match = re.match(r"^\s+([├└]──)\s*(.*)", original_line)
-            if direct_item_match and current_attr:
-                prefix, content = direct_item_match.groups()
-                content = content.strip()
-                if content:
-                    # 首先检查内容是否是属性分类名称
-                    is_attr_name = False
-                    for preset_attr in characters[current_char]:
-                        if content == preset_attr:
-                            # 这是属性行，切换当前属性
-                            current_attr = preset_attr
-                            is_attr_name = True
-                            break
-                    
-                    # 如果不是属性名称，才作为条目添加
-                    if not is_attr_name:
-                        characters[current_char][current_attr].append(content)
-    
-    return characters
-
-
-def _update_character_index(filepath: str, chapter_num: int, chapter_text: str, character_state: str):
+def _update_character_index(filepath: str, chapter_num: int, character_names: list):
     """
     更新角色出场索引
     
+    参数:
+        character_names: 当前角色状态中的角色名（结构化角色状态中的全部角色）
+    
     索引结构:
     {
         "角色名": {
@@ -436,18 +421,7 @@ def _update_character_index(filepath: str, chapter_num: int, chapter_text: str,
     else:
         index = {}
     
-    # 从角色状态中解析当前章节涉及的角色名
-    current_chars = set()
-    for line in character_state.split('\n'):
-        stripped = line.strip()
-        # 跳过属性行和空行
-        if not stripped or stripped.startswith('├') or stripped.startswith('│') or stripped.startswith('└'):
-            continue
-        # 检测角色名行（角色名 + 冒号）
-        if '：' in stripped or ':' in stripped:
-            char_name = stripped.split('：')[0].split(':')[0].strip()
-            if char_name and not char_name.startswith('新'):  # 排除"新出场角色"等标题
-                current_chars.add(char_name)
+    current_chars = {name for name in character_names if not name.startswith('新')}  # 排除"新出场角色"等标题
     
     # 更新索引
     for char_name in current_chars:
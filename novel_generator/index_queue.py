@@ -0,0 +1,246 @@
+#novel_generator/index_queue.py
+# -*- coding: utf-8 -*-
+"""
+定稿后的向量库更新队列：finalize_chapter 只把"第N章待写入向量库"登记进队列即返回，
+由后台线程分批完成分段、embedding 与写入，失败自动重试。
+- 队列持久化在小说目录下的 index_queue.json 中，程序中途退出后，下次提供 embedding 适配器时继续处理；
+- 任务只记录章节号与元数据，章节正文在处理时从 chapters/chapter_N.txt 读取，
+  同一章重复登记（重新定稿）只保留最后一次；
+- wait_for_index(filepath, N) 等待第N章及之前的章节全部写入完成，
+  生成下一章提示词时只在确实需要这些章节的分段时才阻塞。
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from novel_generator.vectorstore_utils import update_vector_store
+
+INDEX_QUEUE_FILE = "index_queue.json"
+
+BATCH_SIZE = 8          # 每轮最多处理的章节数
+MAX_ATTEMPTS = 3        # 单章最多尝试次数，超过后记为失败，不再阻塞等待
+RETRY_BASE_DELAY = 2.0  # 重试间隔（秒），按 2^(尝试次数-1) 递增
+
+
+class IndexQueue:
+    """
+    单本小说的向量库写入队列。
+    pending: {章节号: 任务}，任务为 {"chapter_number", "unit_number", "character_names",
+             "history_window", "semantic_chunking", "attempts", "next_attempt"}
+    failed:  {章节号: 任务}，重试耗尽的任务（附 "error"），重新登记同一章时移出
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.queue_file = os.path.join(filepath, INDEX_QUEUE_FILE)
+        self._cond = threading.Condition()
+        self._embedding_adapter = None
+        self._worker = None
+        self._in_flight = set()
+        self.pending = {}
+        self.failed = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.queue_file):
+            return
+        try:
+            with open(self.queue_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.pending = {int(job["chapter_number"]): job for job in data.get("pending", [])}
+            self.failed = {int(job["chapter_number"]): job for job in data.get("failed", [])}
+            for job in self.pending.values():
+                job["next_attempt"] = 0
+            if self.pending:
+                logging.info(f"向量库写入队列中有{len(self.pending)}章未完成，将在提供 embedding 配置后继续处理")
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"读取向量库写入队列失败: {e}")
+
+    def _save(self):
+        """原子地写回队列文件（调用方持有 self._cond）"""
+        if not self.pending and not self.failed:
+            if os.path.exists(self.queue_file):
+                try:
+                    os.remove(self.queue_file)
+                except OSError as e:
+                    logging.warning(f"删除向量库写入队列文件失败: {e}")
+            return
+        tmp_file = self.queue_file + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({
+                    "pending": [self.pending[n] for n in sorted(self.pending)],
+                    "failed": [self.failed[n] for n in sorted(self.failed)]
+                }, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.queue_file)
+        except OSError as e:
+            logging.warning(f"保存向量库写入队列失败: {e}")
+
+    def enqueue(self, chapter_number: int, embedding_adapter, unit_number: int = None,
+                character_names=None, history_window: int = 0, semantic_chunking: bool = False):
+        """登记一章待写入向量库（同一章未处理的旧任务被替换），并确保后台线程在运行"""
+        chapter_number = int(chapter_number)
+        with self._cond:
+            self.pending[chapter_number] = {
+                "chapter_number": chapter_number,
+                "unit_number": unit_number,
+                "character_names": sorted(set(character_names or [])),
+                "history_window": int(history_window or 0),
+                "semantic_chunking": bool(semantic_chunking),
+                "attempts": 0,
+                "next_attempt": 0
+            }
+            self.failed.pop(chapter_number, None)
+            self._save()
+            self._embedding_adapter = embedding_adapter
+            self._ensure_worker()
+            self._cond.notify_all()
+
+    def resume(self, embedding_adapter):
+        """用给定的 embedding 适配器继续处理遗留任务（已在运行时只更新适配器）"""
+        with self._cond:
+            if self._embedding_adapter is None:
+                self._embedding_adapter = embedding_adapter
+            if self.pending:
+                self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._embedding_adapter is None or (self._worker is not None and self._worker.is_alive()):
+            return
+        self._worker = threading.Thread(target=self._run, name="vector-index-queue", daemon=True)
+        self._worker.start()
+
+    def _blocking(self, chapter_number: int) -> list:
+        """尚未写入完成、且章节号不大于 chapter_number 的章节（调用方持有 self._cond）"""
+        return sorted(n for n in set(self.pending) | self._in_flight if n <= chapter_number)
+
+    def is_indexed(self, chapter_number: int) -> bool:
+        with self._cond:
+            return not self._blocking(chapter_number)
+
+    def wait_for(self, chapter_number: int, timeout: float = None, embedding_adapter=None) -> bool:
+        """
+        阻塞直到第 chapter_number 章及之前的章节全部写入（或重试耗尽记为失败）。
+        提供 embedding_adapter 时顺带启动遗留任务的处理。超时返回 False。
+        """
+        if embedding_adapter is not None:
+            self.resume(embedding_adapter)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._blocking(chapter_number):
+                if self._worker is None or not self._worker.is_alive():
+                    logging.warning(f"向量库写入队列未在运行，第{self._blocking(chapter_number)}章尚未写入")
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _next_batch(self) -> list:
+        """取出到期的任务（按章节号升序，最多 BATCH_SIZE 个）；没有任务时返回 None 让线程退出"""
+        with self._cond:
+            while True:
+                if not self.pending:
+                    self._worker = None
+                    return None
+                now = time.monotonic()
+                due = sorted(n for n, job in self.pending.items() if job["next_attempt"] <= now)
+                if due:
+                    batch = [self.pending.pop(n) for n in due[:BATCH_SIZE]]
+                    self._in_flight.update(job["chapter_number"] for job in batch)
+                    return batch
+                self._cond.wait(min(job["next_attempt"] for job in self.pending.values()) - now)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            embedding_adapter = self._embedding_adapter
+            results = [(job, self._index_chapter(job, embedding_adapter)) for job in batch]
+            with self._cond:
+                for job, error in results:
+                    chapter_number = job["chapter_number"]
+                    self._in_flight.discard(chapter_number)
+                    if error is None or chapter_number in self.pending:
+                        # 成功，或处理期间同一章又被重新登记（以新任务为准）
+                        continue
+                    job["attempts"] += 1
+                    if job["attempts"] >= MAX_ATTEMPTS:
+                        job["error"] = error
+                        self.failed[chapter_number] = job
+                        logging.error(f"第{chapter_number}章写入向量库失败（已重试{job['attempts']}次）: {error}")
+                    else:
+                        job["next_attempt"] = time.monotonic() + RETRY_BASE_DELAY * 2 ** (job["attempts"] - 1)
+                        self.pending[chapter_number] = job
+                        logging.warning(f"第{chapter_number}章写入向量库失败，稍后重试: {error}")
+                self._save()
+                self._cond.notify_all()
+
+    def _index_chapter(self, job: dict, embedding_adapter):
+        """写入一章，成功返回 None，失败返回错误描述"""
+        chapter_number = job["chapter_number"]
+        chapter_file = os.path.join(self.filepath, "chapters", f"chapter_{chapter_number}.txt")
+        try:
+            with open(chapter_file, "r", encoding="utf-8") as f:
+                chapter_text = f.read()
+        except OSError as e:
+            return f"无法读取章节文件 {chapter_file}: {e}"
+        if not chapter_text.strip():
+            logging.warning(f"第{chapter_number}章内容为空，跳过向量库写入")
+            return None
+        try:
+            count = update_vector_store(
+                embedding_adapter=embedding_adapter,
+                new_chapter=chapter_text,
+                filepath=self.filepath,
+                chapter_number=chapter_number,
+                unit_number=job.get("unit_number"),
+                character_names=job.get("character_names"),
+                history_window=job.get("history_window", 0),
+                semantic_chunking=job.get("semantic_chunking", False)
+            )
+        except Exception as e:
+            return str(e)
+        if count <= 0:
+            return "向量库更新失败或无数据写入"
+        logging.info(f"✓ 第{chapter_number}章已写入向量库（{count}段）")
+        return None
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+def get_index_queue(filepath: str) -> IndexQueue:
+    """获取（或创建）小说目录对应的写入队列（同一目录共享一个实例）"""
+    key = os.path.normcase(os.path.abspath(filepath))
+    with _queues_lock:
+        queue = _queues.get(key)
+        if queue is None:
+            queue = IndexQueue(filepath)
+            _queues[key] = queue
+        return queue
+
+def enqueue_chapter_index(filepath: str, chapter_number: int, embedding_adapter, unit_number: int = None,
+                          character_names=None, history_window: int = 0, semantic_chunking: bool = False):
+    """登记第 chapter_number 章待写入向量库，立即返回"""
+    get_index_queue(filepath).enqueue(
+        chapter_number, embedding_adapter,
+        unit_number=unit_number, character_names=character_names, history_window=history_window,
+        semantic_chunking=semantic_chunking
+    )
+
+def wait_for_index(filepath: str, chapter_number: int, timeout: float = None, embedding_adapter=None) -> bool:
+    """
+    等待第 chapter_number 章及之前的章节写入向量库。
+    没有相关待处理任务时立即返回 True；超时或队列无法处理时返回 False（调用方按现有数据继续）。
+    """
+    if chapter_number is None or chapter_number < 1:
+        return True
+    if not os.path.exists(os.path.join(filepath, INDEX_QUEUE_FILE)) and \
+            os.path.normcase(os.path.abspath(filepath)) not in _queues:
+        return True
+    return get_index_queue(filepath).wait_for(chapter_number, timeout=timeout, embedding_adapter=embedding_adapter)
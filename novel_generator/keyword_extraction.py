@@ -0,0 +1,198 @@
+#novel_generator/keyword_extraction.py
+# -*- coding: utf-8 -*-
+"""
+本地生成知识库检索关键词，代替每章一次的 knowledge_search_prompt LLM 调用：
+- 候选短语取自章节目录字段（标题、定位、作用、简述、伏笔等）、单元推荐写作手法、用户指导与前情摘要，
+  按标点与虚词切分，不依赖分词库；
+- tfidf：按字段权重统计词频，IDF 取自本书章节历史的 BM25 倒排索引（本书越少见的词越有区分度）；
+- keybert：用 KeyBERT（多语种句向量模型）按与章节信息的语义相关度排序候选，未安装或加载失败时回退到 tfidf；
+- 排好序的短语与本章人物/道具/地点组合成与 LLM 输出相同的"A·B"格式，交给 parse_search_keywords 之后的流程。
+方式在 novel_settings.json 的 keyword_extractor 中选择（tfidf / keybert / llm），本地结果为空时由调用方回退到 LLM。
+"""
+import re
+import math
+import logging
+import threading
+from collections import Counter
+
+from novel_generator.sparse_index import tokenize, get_sparse_index, sparse_index_exists
+from novel_generator.vectorstore_utils import get_vectorstore_dir, CHAPTER_COLLECTION
+
+KEYWORD_EXTRACTORS = ("tfidf", "keybert", "llm")
+DEFAULT_KEYWORD_EXTRACTOR = "tfidf"
+MAX_KEYWORD_GROUPS = 5  # 与 parse_search_keywords 的上限一致
+KEYBERT_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+# 各字段在词频统计中的权重
+FIELD_WEIGHTS = {
+    "user_guidance": 3.0,
+    "chapter_title": 2.0,
+    "chapter_purpose": 2.0,
+    "chapter_summary": 1.5,
+    "foreshadowing": 1.5,
+    "chapter_role": 1.0,
+    "plot_twist_level": 1.0,
+    "recommended_techniques": 1.0,
+    "short_summary": 1.0,
+}
+
+# 按章节信息提示知识库分类（与知识库中的【分类】字段对应）
+_CATEGORY_HINTS = (
+    ("foreshadowing", None, "伏笔的长线铺设"),
+    ("suspense_level", ("紧凑", "爆发"), "悬念营造手法"),
+    ("key_items", None, "个人物品及状态盘点"),
+)
+
+_PLACEHOLDERS = {"", "无", "未指定", "未设定", "未知", "常规章节", "内容推进", "无特殊指导",
+                 "前情回顾", "本章衔接", "摘要生成失败", "衔接过渡内容"}
+_SPLIT_RE = re.compile(r"[\s，。！？；：、,.!?;:（）()\[\]【】《》<>\"“”'‘’·|/\\\-—…~～]+")
+# 常见虚词：在候选短语内部断开，避免整句成为一个候选
+_FUNCTION_CHAR_RE = re.compile(r"[的了着与及并被把从而却在又都]")
+_CHAPTER_REF_RE = re.compile(r"^第[\d一二三四五六七八九十百千]+章")
+_ENTITY_SPLIT_RE = re.compile(r"[,，;；、/\s]+")
+
+MIN_PHRASE_CHARS = 2
+MAX_PHRASE_CHARS = 8
+
+
+def _candidate_phrases(text: str) -> list:
+    """把一段文本切成候选短语（2~8 个字符，去除占位词与"第N章"之类的引用）"""
+    phrases = []
+    for segment in _SPLIT_RE.split(text or ""):
+        for piece in _FUNCTION_CHAR_RE.split(segment):
+            piece = _CHAPTER_REF_RE.sub("", piece.strip())
+            if piece in _PLACEHOLDERS or piece.isdigit():
+                continue
+            if MIN_PHRASE_CHARS <= len(piece) <= MAX_PHRASE_CHARS:
+                phrases.append(piece)
+    return phrases
+
+def split_entities(*values) -> list:
+    """拆分人物/道具/地点字段（逗号、顿号等分隔），去重并去掉占位值"""
+    entities = []
+    for value in values:
+        for name in _ENTITY_SPLIT_RE.split(value or ""):
+            name = name.strip()
+            if name and name not in _PLACEHOLDERS and name not in entities:
+                entities.append(name)
+    return entities
+
+def _weighted_counts(fields: dict) -> Counter:
+    counts = Counter()
+    for name, weight in FIELD_WEIGHTS.items():
+        for phrase in _candidate_phrases(fields.get(name, "")):
+            counts[phrase] += weight
+    return counts
+
+def _novel_idf(filepath: str, phrases) -> dict:
+    """
+    用本书章节历史的稀疏索引计算短语的 IDF（短语内各检索词 IDF 的平均值）。
+    向量库或索引不存在时返回空字典，调用方按 IDF=1 处理。
+    """
+    store_dir = get_vectorstore_dir(filepath)
+    if not sparse_index_exists(store_dir, CHAPTER_COLLECTION):
+        return {}
+    terms = {phrase: tokenize(phrase) for phrase in phrases}
+    try:
+        total_docs, df = get_sparse_index(store_dir, CHAPTER_COLLECTION).document_frequencies(
+            [t for tokens in terms.values() for t in tokens]
+        )
+    except Exception as e:
+        logging.warning(f"读取章节历史词频失败，按等权处理: {e}")
+        return {}
+    if total_docs == 0:
+        return {}
+    idf = {}
+    for phrase, tokens in terms.items():
+        if tokens:
+            idf[phrase] = sum(
+                math.log(1 + (total_docs - df.get(t, 0) + 0.5) / (df.get(t, 0) + 0.5)) for t in tokens
+            ) / len(tokens)
+    return idf
+
+def rank_phrases_tfidf(filepath: str, fields: dict) -> list:
+    """按 加权词频 × 本书IDF 排序候选短语（较长的短语略微加分）"""
+    counts = _weighted_counts(fields)
+    if not counts:
+        return []
+    idf = _novel_idf(filepath, counts)
+    scores = {
+        phrase: tf * idf.get(phrase, 1.0) * (1 + 0.1 * min(len(phrase), 6))
+        for phrase, tf in counts.items()
+    }
+    return sorted(scores, key=lambda phrase: (-scores[phrase], phrase))
+
+
+_keybert_model = None
+_keybert_lock = threading.Lock()
+
+def _get_keybert():
+    global _keybert_model
+    with _keybert_lock:
+        if _keybert_model is None:
+            from keybert import KeyBERT
+            _keybert_model = KeyBERT(KEYBERT_MODEL)
+        return _keybert_model
+
+def rank_phrases_keybert(fields: dict) -> list:
+    """用 KeyBERT 按候选短语与章节信息的语义相关度排序（MMR 去除近义重复）"""
+    from sklearn.feature_extraction.text import CountVectorizer
+    counts = _weighted_counts(fields)
+    if not counts:
+        return []
+    candidates = list(counts)
+    doc = "\n".join(fields.get(name, "") for name in FIELD_WEIGHTS if fields.get(name))
+    # 中文没有空格分词，直接把候选短语作为"分词结果"交给 KeyBERT
+    vectorizer = CountVectorizer(analyzer=lambda _: candidates)
+    pairs = _get_keybert().extract_keywords(
+        doc, vectorizer=vectorizer, top_n=min(len(candidates), MAX_KEYWORD_GROUPS * 2),
+        use_mmr=True, diversity=0.5
+    )
+    return [phrase for phrase, _ in pairs]
+
+def _category_hint(fields: dict) -> str:
+    for field, values, category in _CATEGORY_HINTS:
+        value = (fields.get(field) or "").strip()
+        if value in _PLACEHOLDERS:
+            continue
+        if values is None or any(v in value for v in values):
+            return category
+    return ""
+
+def build_keyword_groups(phrases: list, entities: list, category: str = "") -> list:
+    """把排好序的短语与人物/道具/地点组合为"A·B"关键词组，最多 MAX_KEYWORD_GROUPS 组"""
+    attributes = [p for p in phrases if not any(p in e or e in p for e in entities)]
+    groups = []
+    if entities:
+        for i, attribute in enumerate(attributes[:MAX_KEYWORD_GROUPS]):
+            groups.append(f"{entities[i % len(entities)]}·{attribute}")
+    else:
+        for i in range(0, min(len(attributes), MAX_KEYWORD_GROUPS * 2) - 1, 2):
+            groups.append(f"{attributes[i]}·{attributes[i + 1]}")
+    if category and attributes:
+        group = f"{category}·{attributes[0]}"
+        if len(groups) >= MAX_KEYWORD_GROUPS:
+            groups[-1] = group
+        else:
+            groups.append(group)
+    return groups[:MAX_KEYWORD_GROUPS]
+
+def extract_search_keywords(filepath: str, fields: dict, method: str = DEFAULT_KEYWORD_EXTRACTOR) -> list:
+    """
+    本地生成检索关键词组。fields 为章节信息（chapter_info 各字段，另加 user_guidance、short_summary、
+    recommended_techniques）。返回 ["A·B", ...]；无法生成时返回空列表，调用方回退到 LLM。
+    """
+    phrases = []
+    if method == "keybert":
+        try:
+            phrases = rank_phrases_keybert(fields)
+        except Exception as e:
+            logging.warning(f"KeyBERT 关键词提取不可用，改用 TF-IDF: {e}")
+    if not phrases:
+        phrases = rank_phrases_tfidf(filepath, fields)
+    entities = split_entities(fields.get("characters_involved"), fields.get("key_items"),
+                              fields.get("scene_location"))
+    groups = build_keyword_groups(phrases, entities, _category_hint(fields))
+    if groups:
+        logging.info(f"本地生成检索关键词（{method}）：{groups}")
+    return groups
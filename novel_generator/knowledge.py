@@ -1,52 +1,208 @@
 #novel_generator/knowledge.py
 # -*- coding: utf-8 -*-
 """
-知识文件导入至向量库（advanced_split_content、import_knowledge_file）
+知识文件导入至向量库（advanced_split_content、import_knowledge_file，支持增量去重与断点续传）
 """
 import os
+import json
+import hashlib
 import logging
 import re
 import traceback
-import nltk
 import warnings
-from utils import read_file
-from novel_generator.vectorstore_utils import load_vector_store, init_vector_store
-try:
-    from langchain_core.documents import Document
-except ImportError:
-    from langchain.docstore.document import Document
+from novel_generator.vectorstore_utils import (
+    load_vector_store,
+    get_vectorstore_dir,
+    get_vector_store_lock,
+    content_hash,
+    split_text_for_vectorstore,
+    index_sparse_documents,
+    set_default_vector_backend,
+    SOURCE_KNOWLEDGE,
+    KNOWLEDGE_COLLECTION
+)
+from novel_generator.common import extract_metadata
 
 # 禁用特定的Torch警告
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-def advanced_split_content(content: str, similarity_threshold: float = 0.7, max_length: int = 500) -> list:
-    """使用基本分段策略"""
-    nltk.download('punkt', quiet=True)
-    nltk.download('punkt_tab', quiet=True)
-    sentences = nltk.sent_tokenize(content)
-    if not sentences:
+def advanced_split_content(content: str, similarity_threshold: float = 0.7, max_length: int = 500,
+                           overlap_tokens: int = 0, embedding_adapter=None) -> list:
+    """使用内置中文分句器分段；传入 embedding_adapter 时按语义边界（similarity_threshold）合并"""
+    return split_text_for_vectorstore(
+        content,
+        max_length=max_length,
+        similarity_threshold=similarity_threshold,
+        overlap_tokens=overlap_tokens,
+        embedding_adapter=embedding_adapter
+    )
+
+KNOWLEDGE_MANIFEST_FILE = "knowledge_manifest.json"
+KNOWLEDGE_BLOCK_CHARS = 64 * 1024   # 流式读取时每个文本块的字符数上限
+KNOWLEDGE_BATCH_SIZE = 64           # 每次 embedding + 写入的分段数（即检查点粒度）
+KNOWLEDGE_SEGMENT_TOKENS = 500      # 知识分段的长度上限
+# 检查点记录的分段方式：块内偏移只在同一种确定性分段下有意义（按长度分段，不依赖 embedding 服务）
+KNOWLEDGE_SPLIT_MODE = f"length-{KNOWLEDGE_SEGMENT_TOKENS}"
+
+def _segment_hash(text: str) -> str:
+    """分段内容哈希（忽略空白差异），用作知识分段的文档ID"""
+    return content_hash(text)
+
+def _file_hash(file_path: str) -> str:
+    """流式计算文件内容哈希，内存占用与文件大小无关"""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _manifest_path(filepath: str) -> str:
+    # 清单与向量库放在一起：清空向量库时清单一并删除，不会误判为"已导入"
+    return os.path.join(get_vectorstore_dir(filepath), KNOWLEDGE_MANIFEST_FILE)
+
+def load_knowledge_manifest(filepath: str) -> dict:
+    """读取知识导入清单：{"files": {文件内容哈希: {...导入进度...}}}"""
+    manifest_file = _manifest_path(filepath)
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            manifest.setdefault("files", {})
+            return manifest
+        except Exception as e:
+            logging.warning(f"读取知识导入清单失败，将重新创建: {e}")
+    return {"files": {}}
+
+def _save_knowledge_manifest(filepath: str, manifest: dict):
+    """原子写入清单，避免中途崩溃留下损坏的JSON"""
+    manifest_file = _manifest_path(filepath)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+def detect_file_encoding(file_path: str, sample_bytes: int = 64 * 1024) -> str:
+    """
+    仅读取文件开头 sample_bytes 字节判断编码（BOM → UTF-8 → GB18030），不整文件反复试读。
+    GB18030 兼容 GBK/GB2312；均失败时返回 utf-8（读取时以替换字符容错）。
+    """
+    import codecs
+    with open(file_path, "rb") as f:
+        sample = f.read(sample_bytes)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16"
+    for encoding in ("utf-8", "gb18030"):
+        # 增量解码：样本末尾被截断的多字节字符不会导致误判
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            decoder.decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "utf-8"
+
+def _get_manifest_entry(manifest: dict, file_key: str, file_path: str) -> dict:
+    """获取（或新建）某个文件在清单中的导入进度记录"""
+    entry = manifest["files"].get(file_key)
+    if not entry:
+        entry = {
+            "path": os.path.abspath(file_path),
+            "size": os.path.getsize(file_path),
+            "status": "in_progress",
+            "block_index": 0,
+            "block_offset": 0,
+            "split": KNOWLEDGE_SPLIT_MODE,
+            "inserted": 0,
+            "skipped": 0
+        }
+        manifest["files"][file_key] = entry
+    elif entry.get("split") != KNOWLEDGE_SPLIT_MODE:
+        # 旧检查点的块内偏移按其他分段方式记录，无法对应到当前分段：从该块开头重新导入（已写入的分段按哈希去重）
+        entry["block_offset"] = 0
+        entry["split"] = KNOWLEDGE_SPLIT_MODE
+    return entry
+
+def split_knowledge_block(block: str) -> list:
+    """
+    把一个文本块切分为知识分段：只按长度分段，结果只取决于文本内容，
+    因此检查点中的块内偏移在续传时总能对应到同样的分段（单文件与批量导入共用）。
+    """
+    return [seg for seg in split_text_for_vectorstore(block, max_length=KNOWLEDGE_SEGMENT_TOKENS) if seg.strip()]
+
+_KNOWLEDGE_TAGS = (("类型", "kb_type"), ("分类", "category"), ("关键词", "keywords"))
+
+def knowledge_chunk_metadata(segments: list, sources: list = None) -> list:
+    """
+    知识库分段的元数据：来源类型、来源文件，以及条目中【类型】【分类】【关键词】标签的值。
+    标签通常只写在条目开头，被切到后续分段的正文沿用同一来源文件中上一个带标签分段的值。
+    """
+    metadatas = []
+    last_tags = {}
+    for i, seg in enumerate(segments):
+        source = sources[i] if sources else ""
+        found = {key: extract_metadata(seg, tag) for tag, key in _KNOWLEDGE_TAGS}
+        if any(found.values()):
+            last_tags[source] = {key: value for key, value in found.items() if value}
+        metadata = {"source_type": SOURCE_KNOWLEDGE}
+        if source:
+            metadata["source_file"] = source
+        metadata.update(last_tags.get(source, {}))
+        metadatas.append(metadata)
+    return metadatas
+
+def _write_knowledge_batch(store, segments: list, sources: list = None, filepath: str = None) -> list:
+    """
+    按内容哈希去重后批量 embedding 并写入（附带分段元数据），返回新写入分段的文档ID列表。
+    提供 filepath 时同步写入该小说的 BM25 稀疏索引。
+    """
+    metadatas = knowledge_chunk_metadata(segments, sources)
+    unique = {}
+    for seg, metadata in zip(segments, metadatas):
+        unique.setdefault(f"kb_{_segment_hash(seg)}", (seg, metadata))
+    if not unique:
         return []
+    existing = _filter_existing_ids(store, list(unique.keys()))
+    new_ids = [doc_id for doc_id in unique if doc_id not in existing]
+    if new_ids:
+        store.add_texts(
+            [unique[doc_id][0] for doc_id in new_ids],
+            metadatas=[unique[doc_id][1] for doc_id in new_ids],
+            ids=new_ids
+        )
+        if filepath:
+            index_sparse_documents(store, filepath, new_ids, [unique[doc_id][0] for doc_id in new_ids])
+    return new_ids
 
-    final_segments = []
-    current_segment = []
-    current_length = 0
-    
-    for sentence in sentences:
-        sentence_length = len(sentence)
-        if current_length + sentence_length > max_length:
-            if current_segment:
-                final_segments.append(" ".join(current_segment))
-            current_segment = [sentence]
-            current_length = sentence_length
-        else:
-            current_segment.append(sentence)
-            current_length += sentence_length
-    
-    if current_segment:
-        final_segments.append(" ".join(current_segment))
-    
-    return final_segments
+def iter_text_blocks(file_path: str, encoding: str = "utf-8", block_chars: int = KNOWLEDGE_BLOCK_CHARS):
+    """
+    流式读取文本文件，按段落边界产出不超过约 block_chars 字符的文本块。
+    块的划分只取决于文件内容，因此可作为断点续传的定位单位。
+    """
+    buffer = []
+    buffer_len = 0
+    with open(file_path, "r", encoding=encoding, errors="replace") as f:
+        for line in f:
+            buffer.append(line)
+            buffer_len += len(line)
+            # 优先在空行（段落边界）处切块；单段过长时在行边界处强制切块
+            if (buffer_len >= block_chars and not line.strip()) or buffer_len >= block_chars * 2:
+                yield "".join(buffer)
+                buffer, buffer_len = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+def _filter_existing_ids(store, ids: list) -> set:
+    """返回 ids 中已存在于向量库的部分"""
+    try:
+        existing = store._collection.get(ids=ids, include=[])
+        return set(existing.get("ids", []))
+    except Exception as e:
+        logging.warning(f"查询已存在的知识分段失败，将按新分段处理: {e}")
+        return set()
 
 def import_knowledge_file(
     embedding_api_key: str,
@@ -54,17 +210,36 @@ def import_knowledge_file(
     embedding_interface_format: str,
     embedding_model_name: str,
     file_path: str,
-    filepath: str
-):
+    filepath: str,
+    encoding: str = None
+) -> int:
+    """
+    增量、去重、可断点续传地导入知识库文件。
+    - 流式按块读取，内存占用与文件大小无关；
+    - 每个分段以内容哈希作为文档ID，已存在的分段不会重复 embedding/写入；
+    - 每写入一批（KNOWLEDGE_BATCH_SIZE 段）记录一次检查点到 knowledge_manifest.json，
+      中途失败后重新导入同一文件会从检查点继续；已完整导入的文件直接跳过；
+    - 按长度确定性分段（split_knowledge_block），续传时检查点偏移总能对应到同样的分段。
+    encoding 为空时根据文件开头自动检测编码。
+    返回值：本次新写入的分段数
+    """
     logging.info(f"开始导入知识库文件: {file_path}, 接口格式: {embedding_interface_format}, 模型: {embedding_model_name}")
     if not os.path.exists(file_path):
         logging.warning(f"知识库文件不存在: {file_path}")
-        return
-    content = read_file(file_path)
-    if not content.strip():
+        return 0
+    if os.path.getsize(file_path) == 0:
         logging.warning("知识库文件内容为空。")
-        return
-    paragraphs = advanced_split_content(content)
+        return 0
+
+    file_key = _file_hash(file_path)
+    manifest = load_knowledge_manifest(filepath)
+    entry = _get_manifest_entry(manifest, file_key, file_path)
+    if entry.get("status") == "done":
+        logging.info(f"知识库文件内容已导入过（{entry.get('path')}），跳过。")
+        return 0
+    if entry["block_index"] or entry["block_offset"]:
+        logging.info(f"检测到未完成的导入，从第{entry['block_index'] + 1}块第{entry['block_offset']}段继续。")
+
     from embedding_adapters import create_embedding_adapter
     embedding_adapter = create_embedding_adapter(
         embedding_interface_format,
@@ -72,19 +247,298 @@ def import_knowledge_file(
         embedding_url if embedding_url else "http://localhost:11434/api",
         embedding_model_name
     )
-    store = load_vector_store(embedding_adapter, filepath)
+
+    os.makedirs(get_vectorstore_dir(filepath), exist_ok=True)
+    store = load_vector_store(embedding_adapter, filepath, KNOWLEDGE_COLLECTION)
     if not store:
-        logging.info("Vector store does not exist or load failed. Initializing a new one for knowledge import...")
-        store = init_vector_store(embedding_adapter, paragraphs, filepath)
-        if store:
-            logging.info("知识库文件已成功导入至向量库(新初始化)。")
+        logging.warning("知识库导入失败：无法打开向量库，跳过。")
+        return 0
+
+    if not encoding:
+        encoding = detect_file_encoding(file_path)
+
+    source_name = os.path.basename(file_path)
+    inserted_this_run = 0
+    try:
+        for block_index, block in enumerate(iter_text_blocks(file_path, encoding=encoding)):
+            if block_index < entry["block_index"]:
+                continue
+            if not block.strip():
+                entry["block_index"], entry["block_offset"] = block_index + 1, 0
+                continue
+
+            segments = split_knowledge_block(block)
+            start = entry["block_offset"] if block_index == entry["block_index"] else 0
+            for batch_start in range(start, len(segments), KNOWLEDGE_BATCH_SIZE):
+                batch = segments[batch_start:batch_start + KNOWLEDGE_BATCH_SIZE]
+                with get_vector_store_lock(filepath):
+                    inserted = len(_write_knowledge_batch(store, batch, [source_name] * len(batch), filepath))
+                inserted_this_run += inserted
+                entry["inserted"] += inserted
+                entry["skipped"] += len(batch) - inserted
+                entry["block_index"] = block_index
+                entry["block_offset"] = batch_start + len(batch)
+                _save_knowledge_manifest(filepath, manifest)
+
+            entry["block_index"], entry["block_offset"] = block_index + 1, 0
+            _save_knowledge_manifest(filepath, manifest)
+
+        entry["status"] = "done"
+        _save_knowledge_manifest(filepath, manifest)
+        logging.info(
+            f"知识库文件已成功导入至向量库：新增{entry['inserted']}段，去重跳过{entry['skipped']}段。"
+        )
+    except Exception as e:
+        _save_knowledge_manifest(filepath, manifest)
+        logging.warning(f"知识库导入中断（已保存检查点，可重新导入以继续）: {e}")
+        traceback.print_exc()
+    return inserted_this_run
+
+
+# ============== 批量并行导入（目录 / 通配符） ==============
+
+KNOWLEDGE_FILE_EXTENSIONS = (".txt", ".md")
+
+def collect_knowledge_files(paths) -> list:
+    """
+    展开待导入的路径：目录（递归查找 .txt/.md）、通配符或单个文件，去重并保持顺序。
+    """
+    import glob
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = []
+            for root, _, names in os.walk(path):
+                candidates.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.lower().endswith(KNOWLEDGE_FILE_EXTENSIONS)
+                )
+        elif any(ch in path for ch in "*?["):
+            candidates = sorted(glob.glob(path, recursive=True))
         else:
-            logging.warning("知识库导入失败，跳过。")
-    else:
-        try:
-            docs = [Document(page_content=str(p)) for p in paragraphs]
-            store.add_documents(docs)
-            logging.info("知识库文件已成功导入至向量库(追加模式)。")
-        except Exception as e:
-            logging.warning(f"知识库导入失败: {e}")
-            traceback.print_exc()
+            candidates = [path]
+        for candidate in candidates:
+            full = os.path.abspath(candidate)
+            if os.path.isfile(full) and full not in seen:
+                seen.add(full)
+                files.append(full)
+    return files
+
+def _split_block_worker(block: str) -> list:
+    """进程池中执行的分段任务（纯CPU计算，不访问网络）"""
+    return split_knowledge_block(block)
+
+def import_knowledge_files(
+    embedding_api_key: str,
+    embedding_url: str,
+    embedding_interface_format: str,
+    embedding_model_name: str,
+    paths,
+    filepath: str,
+    max_workers: int = None,
+    batch_size: int = KNOWLEDGE_BATCH_SIZE,
+    progress_callback: callable = None
+) -> dict:
+    """
+    批量导入知识库：paths 可以是目录、通配符或文件列表。
+    - 每个文件只读取开头部分检测编码，不再生成临时 UTF-8 副本；
+    - 文件按块流式读取，分段计算分发到进程池；同时在途的块数有上限，内存占用有界；
+    - 分段结果按顺序汇入同一个批次缓冲区，跨文件批量 embedding 和写入向量库；
+    - 与 import_knowledge_file 共用内容哈希去重和 knowledge_manifest.json 检查点。
+    注：与 import_knowledge_file 相同，只做按长度分段（split_knowledge_block），不做依赖 embedding 的语义分段。
+
+    参数:
+        progress_callback: 进度回调，接收 (progress, description)，progress 按已处理字节数计算
+    返回:
+        {"files": 文件数, "skipped_files": 已导入而跳过的文件数, "inserted": 新写入分段数, "duplicates": 去重跳过分段数}
+    """
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = collect_knowledge_files(paths)
+    stats = {"files": len(files), "skipped_files": 0, "inserted": 0, "duplicates": 0}
+    if not files:
+        logging.warning("未找到可导入的知识库文件。")
+        return stats
+
+    def report(progress, description):
+        logging.info(description)
+        if progress_callback:
+            progress_callback(min(progress, 1.0), description)
+
+    from embedding_adapters import create_embedding_adapter
+    embedding_adapter = create_embedding_adapter(
+        embedding_interface_format,
+        embedding_api_key,
+        embedding_url if embedding_url else "http://localhost:11434/api",
+        embedding_model_name
+    )
+    os.makedirs(get_vectorstore_dir(filepath), exist_ok=True)
+    store = load_vector_store(embedding_adapter, filepath, KNOWLEDGE_COLLECTION)
+    if not store:
+        logging.warning("知识库导入失败：无法打开向量库，跳过。")
+        return stats
+
+    manifest = load_knowledge_manifest(filepath)
+    total_bytes = sum(os.path.getsize(f) for f in files) or 1
+    done_bytes = 0
+
+    # 待写入的分段缓冲：(file_key, segment)
+    buffer = []
+    # 按顺序记录每个块尚未写入的分段数，只有连续完成的块才推进文件检查点
+    pending_blocks = deque()
+    remaining = {}
+
+    def advance_checkpoints():
+        while pending_blocks and remaining[pending_blocks[0]] == 0:
+            file_key, block_index, block_bytes = pending_blocks.popleft()
+            del remaining[(file_key, block_index, block_bytes)]
+            entry = manifest["files"][file_key]
+            entry["block_index"] = max(entry["block_index"], block_index + 1)
+            entry["block_offset"] = 0
+
+    def flush(force=False):
+        nonlocal buffer
+        while buffer and (force or len(buffer) >= batch_size):
+            batch, buffer = buffer[:batch_size], buffer[batch_size:]
+            with get_vector_store_lock(filepath):
+                new_ids = set(_write_knowledge_batch(
+                    store,
+                    [seg for _, seg, _ in batch],
+                    [os.path.basename(manifest["files"][file_key]["path"]) for file_key, _, _ in batch],
+                    filepath
+                ))
+            stats["inserted"] += len(new_ids)
+            stats["duplicates"] += len(batch) - len(new_ids)
+            for file_key, seg, block_key in batch:
+                entry = manifest["files"][file_key]
+                doc_id = f"kb_{_segment_hash(seg)}"
+                if doc_id in new_ids:
+                    new_ids.discard(doc_id)
+                    entry["inserted"] += 1
+                else:
+                    entry["skipped"] += 1
+                remaining[block_key] -= 1
+            advance_checkpoints()
+            _save_knowledge_manifest(filepath, manifest)
+
+    def consume(block_key, segments):
+        # 同一块只能登记一次，否则剩余计数被覆盖，检查点无法推进
+        if block_key in remaining:
+            logging.warning(f"知识库导入：分块{block_key[1]}已在处理中，忽略重复提交")
+            return
+        remaining[block_key] = len(segments)
+        pending_blocks.append(block_key)
+        buffer.extend((block_key[0], seg, block_key) for seg in segments)
+        flush()
+        if not segments:
+            advance_checkpoints()
+
+    workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+    max_in_flight = workers * 2
+    in_flight = deque()
+    # 内容相同的文件（例如复制到不同目录的同一份笔记）共用一个清单条目，只导入第一个
+    seen_keys = set()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for file_index, file_path in enumerate(files, 1):
+                file_size = os.path.getsize(file_path)
+                if file_size == 0:
+                    stats["skipped_files"] += 1
+                    continue
+                file_key = _file_hash(file_path)
+                if file_key in seen_keys:
+                    stats["skipped_files"] += 1
+                    done_bytes += file_size
+                    report(done_bytes / total_bytes, f"[{file_index}/{len(files)}] 与已选文件内容相同，跳过: {file_path}")
+                    continue
+                seen_keys.add(file_key)
+                entry = _get_manifest_entry(manifest, file_key, file_path)
+                if entry.get("status") == "done":
+                    stats["skipped_files"] += 1
+                    done_bytes += file_size
+                    report(done_bytes / total_bytes, f"[{file_index}/{len(files)}] 已导入过，跳过: {file_path}")
+                    continue
+
+                encoding = detect_file_encoding(file_path)
+                report(done_bytes / total_bytes, f"[{file_index}/{len(files)}] 正在导入({encoding}): {file_path}")
+                for block_index, block in enumerate(iter_text_blocks(file_path, encoding=encoding)):
+                    if block_index < entry["block_index"]:
+                        continue
+                    block_key = (file_key, block_index, len(block.encode(encoding, errors="ignore")))
+                    in_flight.append((block_key, pool.submit(_split_block_worker, block)))
+                    while len(in_flight) >= max_in_flight:
+                        key, future = in_flight.popleft()
+                        consume(key, future.result())
+                        done_bytes += key[2]
+                        report(done_bytes / total_bytes, f"知识库导入进度：新增{stats['inserted']}段，去重跳过{stats['duplicates']}段")
+                # 文件的块全部提交后，标记完成时机由检查点推进决定
+                entry["blocks_submitted"] = True
+
+            while in_flight:
+                key, future = in_flight.popleft()
+                consume(key, future.result())
+                done_bytes += key[2]
+                report(done_bytes / total_bytes, f"知识库导入进度：新增{stats['inserted']}段，去重跳过{stats['duplicates']}段")
+            flush(force=True)
+            advance_checkpoints()
+
+        for entry in manifest["files"].values():
+            if entry.pop("blocks_submitted", False):
+                entry["status"] = "done"
+        _save_knowledge_manifest(filepath, manifest)
+        report(1.0, f"知识库批量导入完成：{stats['files']}个文件（跳过{stats['skipped_files']}个），"
+                    f"新增{stats['inserted']}段，去重跳过{stats['duplicates']}段")
+    except Exception as e:
+        for entry in manifest["files"].values():
+            entry.pop("blocks_submitted", None)
+        _save_knowledge_manifest(filepath, manifest)
+        logging.warning(f"知识库批量导入中断（已保存检查点，可重新导入以继续）: {e}")
+        traceback.print_exc()
+    return stats
+
+def _main(argv=None):
+    """命令行入口：python -m novel_generator.knowledge <目录/文件/通配符...> --filepath <小说目录>"""
+    import argparse
+    parser = argparse.ArgumentParser(description="批量导入知识库文件到小说向量库")
+    parser.add_argument("paths", nargs="+", help="目录、通配符或文件")
+    parser.add_argument("--filepath", required=True, help="小说保存路径（向量库位于其下的 vectorstore 目录）")
+    parser.add_argument("--config", default="config.json", help="读取 embedding 配置的 config.json")
+    parser.add_argument("--interface-format", help="覆盖 embedding 接口格式")
+    parser.add_argument("--api-key", help="覆盖 embedding API Key")
+    parser.add_argument("--url", help="覆盖 embedding 接口地址")
+    parser.add_argument("--model", help="覆盖 embedding 模型名")
+    parser.add_argument("--workers", type=int, default=None, help="分段进程数")
+    parser.add_argument("--batch-size", type=int, default=KNOWLEDGE_BATCH_SIZE, help="每批 embedding 的分段数")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    from config_manager import load_config
+    config = load_config(args.config)
+    set_default_vector_backend(config.get("vectorstore_backend", "chroma"))
+    interface_format = args.interface_format or config.get("last_embedding_interface_format", "OpenAI")
+    emb_conf = config.get("embedding_configs", {}).get(interface_format, {})
+
+    def print_progress(progress, description):
+        print(f"[{progress * 100:5.1f}%] {description}", flush=True)
+
+    stats = import_knowledge_files(
+        embedding_api_key=args.api_key or emb_conf.get("api_key", ""),
+        embedding_url=args.url or emb_conf.get("base_url", ""),
+        embedding_interface_format=interface_format,
+        embedding_model_name=args.model or emb_conf.get("model_name", ""),
+        paths=args.paths,
+        filepath=args.filepath,
+        max_workers=args.workers,
+        batch_size=args.batch_size,
+        progress_callback=print_progress
+    )
+    return 0 if stats["files"] else 1
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(_main())
@@ -0,0 +1,416 @@
+#novel_generator/npy_vectorstore.py
+# -*- coding: utf-8 -*-
+"""
+轻量向量库后端：float32 向量保存在内存映射的 .npy 文件中，文档与元数据保存在追加写的 JSONL 旁路文件中，
+检索为精确 top-k（一次矩阵-向量乘法）。适合几万个分段以内的小说，不依赖 chromadb。
+
+对外提供与 Chroma 相同形状的接口（NpyVectorStore._collection 的 count/get/query/add/update/delete），
+vectorstore_utils 中的加载、写入、检索函数无需区分后端。
+
+目录结构（以集合名 novel_collection 为例）：
+    novel_collection.json          当前代数（generation）与向量维度
+    novel_collection.<g>.npy       第 g 代向量矩阵（容量按倍数增长，已用行数以记录为准）
+    novel_collection.<g>.jsonl     第 g 代记录：add / del / upd 操作日志（upd 可同时替换文档内容与元数据）
+压缩（compact）时写出第 g+1 代文件后原子替换 .json，再删除旧文件，中途崩溃不会损坏已有数据。
+"""
+import os
+import json
+import uuid
+import logging
+import threading
+import numpy as np
+
+INITIAL_CAPACITY = 1024
+# 已删除行超过该比例（且不少于 AUTO_COMPACT_MIN_DEAD 行）时自动压缩
+AUTO_COMPACT_RATIO = 0.3
+AUTO_COMPACT_MIN_DEAD = 256
+
+
+def match_where(metadata: dict, where: dict) -> bool:
+    """按 Chroma 的 where 语法判断元数据是否满足条件（支持 $and/$or 与 $eq/$ne/$gt/$gte/$lt/$lte/$in/$nin）"""
+    if not where:
+        return True
+    metadata = metadata or {}
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(match_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, expected in condition.items():
+                if op == "$eq":
+                    ok = value == expected
+                elif op == "$ne":
+                    ok = value != expected
+                elif op == "$in":
+                    ok = value in expected
+                elif op == "$nin":
+                    ok = value not in expected
+                elif value is None:
+                    ok = False
+                elif op == "$gt":
+                    ok = value > expected
+                elif op == "$gte":
+                    ok = value >= expected
+                elif op == "$lt":
+                    ok = value < expected
+                elif op == "$lte":
+                    ok = value <= expected
+                else:
+                    raise ValueError(f"Unsupported where operator: {op}")
+                if not ok:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class NpyCollection:
+    """内存映射向量集合，接口与 chromadb Collection 的常用子集一致（距离为余弦距离 1 - cos）"""
+
+    def __init__(self, store_dir: str, name: str):
+        self.store_dir = store_dir
+        self.name = name
+        self.metadata = {"hnsw:space": "cosine", "backend": "numpy"}
+        self._lock = threading.RLock()
+        self._vectors = None      # np.memmap，形状 (容量, 维度)
+        self._dim = None
+        self._generation = 0
+        self._ids = []            # 行号 -> 文档ID（已删除行为 None）
+        self._texts = []
+        self._metadatas = []
+        self._row_of = {}         # 文档ID -> 行号
+        self._dead = 0
+        os.makedirs(store_dir, exist_ok=True)
+        self._load()
+
+    # ---------- 文件 ----------
+    def _manifest_path(self) -> str:
+        return os.path.join(self.store_dir, f"{self.name}.json")
+
+    def _vectors_path(self, generation: int) -> str:
+        return os.path.join(self.store_dir, f"{self.name}.{generation}.npy")
+
+    def _records_path(self, generation: int) -> str:
+        return os.path.join(self.store_dir, f"{self.name}.{generation}.jsonl")
+
+    def _write_manifest(self):
+        path = self._manifest_path()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"generation": self._generation, "dim": self._dim}, f)
+        os.replace(tmp_path, path)
+
+    def _load(self):
+        path = self._manifest_path()
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self._generation = manifest.get("generation", 0)
+        self._dim = manifest.get("dim")
+        vectors_path = self._vectors_path(self._generation)
+        if os.path.exists(vectors_path):
+            self._vectors = np.load(vectors_path, mmap_mode="r+")
+        records_path = self._records_path(self._generation)
+        if not os.path.exists(records_path):
+            return
+        with open(records_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写到一半的最后一行（进程中断）直接忽略
+                    continue
+                self._apply_record(record)
+
+    def _apply_record(self, record: dict):
+        op = record.get("op")
+        if op == "add":
+            row = record["row"]
+            if row < len(self._ids) and self._ids[row] is None:
+                # 旧版本以删除+新增记录文档内容更新：复用已删除的行，不再计入待压缩的空行
+                self._dead -= 1
+            while len(self._ids) <= row:
+                self._ids.append(None)
+                self._texts.append(None)
+                self._metadatas.append(None)
+            self._ids[row] = record["id"]
+            self._texts[row] = record.get("text")
+            self._metadatas[row] = record.get("meta")
+            self._row_of[record["id"]] = row
+        elif op == "del":
+            row = self._row_of.pop(record["id"], None)
+            if row is not None:
+                self._ids[row] = None
+                self._texts[row] = None
+                self._metadatas[row] = None
+                self._dead += 1
+        elif op == "upd":
+            row = self._row_of.get(record["id"])
+            if row is not None:
+                if "text" in record:
+                    self._texts[row] = record["text"]
+                if "meta" in record:
+                    self._metadatas[row] = record["meta"]
+
+    def _append_records(self, records: list):
+        with open(self._records_path(self._generation), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._apply_record(record)
+
+    def _ensure_capacity(self, rows: int):
+        if self._vectors is not None and self._vectors.shape[0] >= rows:
+            return
+        capacity = INITIAL_CAPACITY
+        if self._vectors is not None:
+            capacity = self._vectors.shape[0]
+        while capacity < rows:
+            capacity *= 2
+        path = self._vectors_path(self._generation)
+        tmp_path = path + ".tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, self._dim))
+        used = len(self._ids)
+        if self._vectors is not None and used:
+            grown[:used] = self._vectors[:used]
+        grown.flush()
+        del grown
+        self._release_vectors()
+        os.replace(tmp_path, path)
+        self._vectors = np.load(path, mmap_mode="r+")
+        if not os.path.exists(self._manifest_path()):
+            self._write_manifest()
+
+    def _release_vectors(self):
+        if self._vectors is None:
+            return
+        self._vectors.flush()
+        mapping = getattr(self._vectors, "_mmap", None)
+        self._vectors = None
+        # 释放映射，Windows 下才能替换/删除文件；仍有视图引用时交给垃圾回收
+        if mapping is not None:
+            try:
+                mapping.close()
+            except (BufferError, ValueError):
+                pass
+
+    def close(self):
+        with self._lock:
+            self._release_vectors()
+
+    # ---------- Chroma 兼容接口 ----------
+    def count(self) -> int:
+        return len(self._row_of)
+
+    def add(self, ids: list, embeddings: list, documents: list = None, metadatas: list = None):
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(ids) or vectors.shape[1] == 0:
+            raise ValueError("Embeddings must be a non-empty 2D array with one row per id")
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+        with self._lock:
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimension {self._dim}")
+            # 与 Chroma 一致：已存在的ID忽略，不覆盖
+            fresh = []
+            seen = set()
+            for i, doc_id in enumerate(ids):
+                if doc_id in self._row_of or doc_id in seen:
+                    logging.warning(f"Add of existing embedding ID: {doc_id}")
+                    continue
+                seen.add(doc_id)
+                fresh.append(i)
+            if not fresh:
+                return
+            start = len(self._ids)
+            self._ensure_capacity(start + len(fresh))
+            self._vectors[start:start + len(fresh)] = _normalize(vectors[fresh])
+            self._vectors.flush()
+            self._append_records([
+                {"op": "add", "id": ids[i], "row": start + n, "text": documents[i], "meta": metadatas[i]}
+                for n, i in enumerate(fresh)
+            ])
+
+    def update(self, ids: list, metadatas: list = None, embeddings: list = None, documents: list = None):
+        with self._lock:
+            records = []
+            for i, doc_id in enumerate(ids):
+                row = self._row_of.get(doc_id)
+                if row is None:
+                    continue
+                if embeddings is not None:
+                    vector = np.asarray(embeddings[i], dtype=np.float32)
+                    if self._dim is None or vector.shape != (self._dim,):
+                        raise ValueError(f"Embedding dimension mismatch for {doc_id}")
+                    self._vectors[row] = _normalize(vector[None, :])[0]
+                record = {"op": "upd", "id": doc_id}
+                if documents is not None:
+                    record["text"] = documents[i]
+                if metadatas is not None:
+                    record["meta"] = metadatas[i]
+                if len(record) > 2:
+                    records.append(record)
+            if embeddings is not None and self._vectors is not None:
+                self._vectors.flush()
+            if records:
+                self._append_records(records)
+
+    def delete(self, ids: list = None, where: dict = None):
+        with self._lock:
+            if ids is None and where is None:
+                return
+            targets = [doc_id for doc_id in (ids if ids is not None else list(self._row_of))
+                       if doc_id in self._row_of]
+            if where:
+                targets = [doc_id for doc_id in targets if match_where(self._metadatas[self._row_of[doc_id]], where)]
+            if not targets:
+                return
+            self._append_records([{"op": "del", "id": doc_id} for doc_id in targets])
+            if self._dead >= AUTO_COMPACT_MIN_DEAD and self._dead > AUTO_COMPACT_RATIO * len(self._ids):
+                self.compact()
+
+    def _alive_rows(self, ids: list = None, where: dict = None) -> list:
+        if ids is not None:
+            rows = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+        else:
+            rows = [row for row, doc_id in enumerate(self._ids) if doc_id is not None]
+        if where:
+            rows = [row for row in rows if match_where(self._metadatas[row], where)]
+        return rows
+
+    def get(self, ids: list = None, where: dict = None, include: list = None,
+            limit: int = None, offset: int = None) -> dict:
+        include = ["documents", "metadatas"] if include is None else include
+        with self._lock:
+            rows = self._alive_rows(ids, where)
+            start = offset or 0
+            rows = rows[start:start + limit] if limit is not None else rows[start:]
+            result = {"ids": [self._ids[row] for row in rows]}
+            if "documents" in include:
+                result["documents"] = [self._texts[row] for row in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [self._metadatas[row] for row in rows]
+            if "embeddings" in include:
+                result["embeddings"] = [np.array(self._vectors[row]) for row in rows]
+            return result
+
+    def query(self, query_embeddings: list, n_results: int = 10, where: dict = None,
+              include: list = None) -> dict:
+        include = ["documents", "metadatas", "distances"] if include is None else include
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if "embeddings" in include:
+            result["embeddings"] = []
+        with self._lock:
+            used = len(self._ids)
+            queries = _normalize(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+            if used == 0 or self._dim is None:
+                for key in result:
+                    result[key] = [[] for _ in range(len(queries))]
+                return result
+            if queries.shape[1] != self._dim:
+                raise ValueError(f"Query dimension {queries.shape[1]} does not match collection dimension {self._dim}")
+
+            # 精确检索：所有查询与全部向量一次矩阵乘法
+            scores = queries @ self._vectors[:used].T
+            allowed = np.zeros(used, dtype=bool)
+            allowed[self._alive_rows(where=where)] = True
+            scores[:, ~allowed] = -np.inf
+            k = int(min(n_results, allowed.sum()))
+
+            for row_scores in scores:
+                if k > 0:
+                    top = np.argpartition(-row_scores, k - 1)[:k]
+                    top = top[np.argsort(-row_scores[top])]
+                else:
+                    top = np.array([], dtype=int)
+                result["ids"].append([self._ids[row] for row in top])
+                result["documents"].append([self._texts[row] for row in top])
+                result["metadatas"].append([self._metadatas[row] for row in top])
+                result["distances"].append([float(1.0 - row_scores[row]) for row in top])
+                if "embeddings" in result:
+                    result["embeddings"].append([np.array(self._vectors[row]) for row in top])
+            return result
+
+    def compact(self):
+        """压缩：去掉已删除的行，写出新一代文件后切换，并删除旧文件"""
+        with self._lock:
+            rows = self._alive_rows()
+            old_generation = self._generation
+            new_generation = old_generation + 1
+            vectors_path = self._vectors_path(new_generation)
+            records_path = self._records_path(new_generation)
+            capacity = max(INITIAL_CAPACITY, len(rows))
+            if self._dim is not None:
+                compacted = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32,
+                                                      shape=(capacity, self._dim))
+                for start in range(0, len(rows), 4096):
+                    chunk = rows[start:start + 4096]
+                    compacted[start:start + len(chunk)] = self._vectors[chunk]
+                compacted.flush()
+                del compacted
+            with open(records_path, "w", encoding="utf-8") as f:
+                for new_row, row in enumerate(rows):
+                    f.write(json.dumps({"op": "add", "id": self._ids[row], "row": new_row,
+                                        "text": self._texts[row], "meta": self._metadatas[row]},
+                                       ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._release_vectors()
+            self._generation = new_generation
+            self._write_manifest()
+            for stale in (self._vectors_path(old_generation), self._records_path(old_generation)):
+                try:
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                except OSError as e:
+                    logging.warning(f"Failed to remove old vector file {stale}: {e}")
+
+            removed = self._dead
+            self._ids, self._texts, self._metadatas, self._row_of = [], [], [], {}
+            self._dead = 0
+            self._load()
+            logging.info(f"向量库压缩完成：移除{removed}个已删除行，保留{len(rows)}条")
+            return removed
+
+
+class NpyVectorStore:
+    """与 LangChain Chroma 用法一致的最小封装：add_texts / add_documents / _collection / embeddings"""
+
+    def __init__(self, store_dir: str, collection_name: str, embedding_function):
+        self._collection = NpyCollection(store_dir, collection_name)
+        self.embeddings = embedding_function
+
+    def add_texts(self, texts, metadatas: list = None, ids: list = None) -> list:
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        vectors = self.embeddings.embed_documents(texts)
+        if not vectors or len(vectors) != len(texts) or any(not v for v in vectors):
+            raise ValueError("Embedding failed for one or more texts")
+        self._collection.add(ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+        return ids
+
+    def add_documents(self, documents) -> list:
+        return self.add_texts(
+            [doc.page_content for doc in documents],
+            metadatas=[doc.metadata or None for doc in documents]
+        )
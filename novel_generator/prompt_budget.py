@@ -0,0 +1,252 @@
+#novel_generator/prompt_budget.py
+# -*- coding: utf-8 -*-
+"""
+章节提示词的 token 预算分配：
+- 按模型上下文窗口与输出长度算出提示词可用的 token 数（novel_settings.json 中可用 prompt_token_budget 覆盖）；
+- 提示词由模板固定部分与若干可压缩段落组成，每段有优先级与保底份额；
+- 总长超出预算时从优先级最低的段落开始压缩（较早的全局摘要、非本章角色、已解决的剧情要点……），
+  每段使用适合其格式的压缩方式，压到保底份额为止；
+- 最终每段的 token 分配写入日志，便于排查提示词被截断的问题。
+"""
+import os
+import re
+import json
+import logging
+
+from novel_generator.vectorstore_utils import estimate_tokens
+from novel_generator.character_store import split_character_blocks
+
+# 常见模型的上下文窗口（按模型名包含的关键字匹配，靠前的优先）
+MODEL_CONTEXT_WINDOWS = (
+    ("gpt-4.1", 1000000),
+    ("gpt-4o", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4", 8192),
+    ("gpt-3.5", 16385),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("gemini", 1000000),
+    ("deepseek", 64000),
+    ("qwen", 128000),
+    ("glm", 128000),
+    ("moonshot", 128000),
+    ("kimi", 128000),
+    ("doubao", 128000),
+)
+DEFAULT_CONTEXT_WINDOW = 32000
+# 即使模型窗口很大，提示词也不超过该值（过长的提示词会拖慢生成并稀释重点）
+DEFAULT_PROMPT_BUDGET = 24000
+# 为模板估算误差与接口附加内容预留的 token 数
+CONTEXT_RESERVE = 1000
+
+_TRUNCATED_HEAD = "……（前文已省略）\n"
+_TRUNCATED_TAIL = "\n……（后文已省略）"
+_TREE_CHARS = ("├", "│", "└")
+# 剧情要点按重要程度由低到高的删除顺序
+_ARC_LEVELS_LOW_FIRST = ("🟢", "🟡", "🟠", "🔴")
+
+
+def get_model_context_window(model_name: str) -> int:
+    """按模型名估计上下文窗口大小，未知模型返回 DEFAULT_CONTEXT_WINDOW"""
+    name = (model_name or "").lower()
+    for keyword, window in MODEL_CONTEXT_WINDOWS:
+        if keyword in name:
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+def get_prompt_token_budget(model_name: str, max_tokens: int, settings: dict = None) -> int:
+    """
+    返回提示词可用的 token 数：min(设定上限, 模型窗口 - 输出长度 - 预留)。
+    settings 为 load_novel_settings 的结果，其中 prompt_token_budget 为设定上限（为空时使用 DEFAULT_PROMPT_BUDGET）。
+    """
+    cap = (settings or {}).get("prompt_token_budget") or DEFAULT_PROMPT_BUDGET
+    available = get_model_context_window(model_name) - int(max_tokens or 0) - CONTEXT_RESERVE
+    return max(1000, min(int(cap), available))
+
+
+# ============== 各类段落的压缩方式 ==============
+# 压缩函数签名统一为 (text, target_tokens) -> text，结果不超过 target_tokens（估算值）
+
+def _longest_fitting(text: str, target_tokens: int, from_end: bool) -> str:
+    """二分查找不超过 target_tokens 的最长前缀（from_end 为 True 时为后缀）"""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        piece = text[-mid:] if from_end else text[:mid]
+        if estimate_tokens(piece) <= target_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    if lo == 0:
+        return ""
+    return text[-lo:] if from_end else text[:lo]
+
+def keep_tail(text: str, target_tokens: int) -> str:
+    """保留末尾（最近的内容），用于按时间顺序累积的摘要"""
+    if estimate_tokens(text) <= target_tokens:
+        return text
+    room = target_tokens - estimate_tokens(_TRUNCATED_HEAD)
+    if room <= 0:
+        return ""
+    return _TRUNCATED_HEAD + _longest_fitting(text, room, from_end=True).lstrip()
+
+def keep_head(text: str, target_tokens: int) -> str:
+    """保留开头，用于重要内容在前的段落"""
+    if estimate_tokens(text) <= target_tokens:
+        return text
+    room = target_tokens - estimate_tokens(_TRUNCATED_TAIL)
+    if room <= 0:
+        return ""
+    return _longest_fitting(text, room, from_end=False).rstrip() + _TRUNCATED_TAIL
+
+def drop_trailing_blocks(text: str, target_tokens: int) -> str:
+    """按空行分块，从末尾整块删除（检索结果按相关度排序，末尾最不相关），仍超出时截断"""
+    if estimate_tokens(text) <= target_tokens:
+        return text
+    blocks = [b for b in re.split(r"\n\s*\n", text) if b.strip()]
+    while len(blocks) > 1 and estimate_tokens("\n\n".join(blocks)) > target_tokens:
+        blocks.pop()
+    return keep_head("\n\n".join(blocks), target_tokens)
+
+def _split_arc_entries(text: str) -> tuple:
+    """把剧情要点文本切分为 (开头说明, [条目文本, ...])，条目从非树形行开始"""
+    preamble, entries = [], []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith(_TREE_CHARS) and entries:
+            entries[-1].append(line)
+        elif stripped.startswith("[") or stripped.startswith(_ARC_LEVELS_LOW_FIRST) or entries:
+            entries.append([line])
+        else:
+            preamble.append(line)
+    return "\n".join(preamble), ["\n".join(lines) for lines in entries]
+
+def _arc_drop_rank(entry: str) -> int:
+    """剧情要点的删除顺序：已解决的最先删除，其余按重要程度由低到高"""
+    if re.search(r"当前状态\s*[:：]\s*已解决", entry):
+        return 0
+    first_line = entry.split("\n", 1)[0]
+    for rank, level in enumerate(_ARC_LEVELS_LOW_FIRST, start=1):
+        if level in first_line:
+            return rank
+    return 2  # 未标注重要程度的按"中"处理
+
+def compress_plot_arcs(text: str, target_tokens: int) -> str:
+    """先删除已解决的剧情要点，再从低重要程度开始删除（同级从末尾删），保持原有顺序"""
+    if estimate_tokens(text) <= target_tokens:
+        return text
+    preamble, entries = _split_arc_entries(text)
+    if not entries:
+        return keep_head(text, target_tokens)
+    kept = list(range(len(entries)))
+    drop_order = sorted(kept, key=lambda i: (_arc_drop_rank(entries[i]), -i))
+
+    def render(indices):
+        return "\n".join(([preamble] if preamble else []) + [entries[i] for i in indices])
+
+    for index in drop_order:
+        if len(kept) <= 1 or estimate_tokens(render(kept)) <= target_tokens:
+            break
+        kept.remove(index)
+    return keep_head(render(kept), target_tokens)
+
+def make_character_compressor(keep_names=(), recency: dict = None):
+    """
+    生成角色状态的压缩函数：本章涉及的角色（keep_names）最后删除，
+    其余角色按最近出场章节（recency: {角色名: 最近章节号}）由远到近删除，"新出场角色"部分保留。
+    """
+    keep_names = set(keep_names or ())
+    recency = recency or {}
+
+    def compress(text: str, target_tokens: int) -> str:
+        if estimate_tokens(text) <= target_tokens:
+            return text
+        preamble, blocks, new_section = split_character_blocks(text)
+        if not blocks:
+            return keep_tail(text, target_tokens)
+        kept = list(range(len(blocks)))
+        drop_order = sorted(kept, key=lambda i: (blocks[i][0] in keep_names, recency.get(blocks[i][0], 0), i))
+
+        def render(indices):
+            parts = ([preamble] if preamble else []) + [blocks[i][1] for i in indices]
+            if new_section:
+                parts.append(new_section)
+            return "\n\n".join(parts)
+
+        for index in drop_order:
+            if len(kept) <= 1 or estimate_tokens(render(kept)) <= target_tokens:
+                break
+            kept.remove(index)
+        return keep_head(render(kept), target_tokens)
+
+    return compress
+
+def load_character_recency(filepath: str) -> dict:
+    """读取 character_index.json 中各角色最近出场的章节号，文件不存在时返回空字典"""
+    index_file = os.path.join(filepath, "character_index.json")
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return {name: int(info.get("last_chapter", 0) or 0) for name, info in index.items()}
+    except (OSError, ValueError, AttributeError) as e:
+        logging.warning(f"读取角色索引失败: {e}")
+        return {}
+
+
+# ============== 预算分配 ==============
+
+class PromptSection:
+    """
+    提示词中的一个可压缩段落。
+    priority 越小越先被压缩；min_share 为该段至少保留的预算份额（占可用预算的比例）；
+    compressor 为 (text, target_tokens) -> text 的压缩函数。
+    """
+
+    def __init__(self, name: str, text: str, priority: int, min_share: float = 0.0, compressor=keep_head):
+        self.name = name
+        self.text = text or ""
+        self.priority = priority
+        self.min_share = min_share
+        self.compressor = compressor
+        self.original_tokens = estimate_tokens(self.text)
+        self.tokens = self.original_tokens
+
+def allocate_prompt_budget(sections: list, budget: int, fixed_tokens: int, label: str = "提示词") -> dict:
+    """
+    在 budget 内为各段分配 token：固定部分（模板与其它字段）占用 fixed_tokens，
+    超出时按优先级从低到高压缩各段，直到总量不超过预算或各段都压到保底份额。
+    返回 {段落名: 压缩后的文本}，并把每段的分配情况写入日志。
+    """
+    available = max(0, budget - fixed_tokens)
+    overflow = sum(s.tokens for s in sections) - available
+
+    for section in sorted(sections, key=lambda s: s.priority):
+        if overflow <= 0:
+            break
+        floor = min(section.tokens, int(section.min_share * available))
+        cut = min(section.tokens - floor, overflow)
+        if cut <= 0:
+            continue
+        try:
+            section.text = section.compressor(section.text, section.tokens - cut)
+        except Exception as e:
+            logging.warning(f"压缩{section.name}失败，改为直接截断: {e}")
+            section.text = keep_head(section.text, section.tokens - cut)
+        new_tokens = estimate_tokens(section.text)
+        overflow -= section.tokens - new_tokens
+        section.tokens = new_tokens
+
+    total = fixed_tokens + sum(s.tokens for s in sections)
+    logging.info(f"{label}预算 {budget} tokens，实际约 {total} tokens（固定部分 {fixed_tokens}）")
+    for section in sorted(sections, key=lambda s: -s.priority):
+        if section.tokens < section.original_tokens:
+            logging.info(f"  {section.name}: {section.original_tokens} → {section.tokens}")
+        else:
+            logging.info(f"  {section.name}: {section.tokens}")
+    if overflow > 0:
+        logging.warning(f"{label}各段已压缩到保底长度，仍超出预算约 {overflow} tokens")
+    return {s.name: s.text for s in sections}
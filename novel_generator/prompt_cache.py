@@ -0,0 +1,145 @@
+#novel_generator/prompt_cache.py
+# -*- coding: utf-8 -*-
+"""
+章节提示词构建结果的缓存（按输入指纹记忆）：
+- 指纹由各输入文件（架构、目录、全局摘要、角色状态、剧情要点、单章摘要、角色索引、设置、最近三章正文）的内容哈希、
+  构建参数（章节参数、用户指导、模型配置等）的哈希以及向量库内容版本组成，任何一项变化都视为失效；
+- 输入完全相同的重复构建直接返回缓存结果，不再调用 LLM 与 embedding；需要重新生成时以 force=True 跳过缓存；
+- 结果保存在小说目录下的 prompt_cache.json，按最近使用保留 prompt_cache_size 条（novel_settings.json）。
+构建参数只以哈希形式参与计算，API Key 等不会写入缓存文件。
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from novel_generator.common import load_novel_settings
+from novel_generator.chapter import build_chapter_prompt
+from novel_generator.vectorstore_utils import get_vector_store_version
+
+PROMPT_CACHE_FILE = "prompt_cache.json"
+
+# 参与指纹计算的输入文件（相对小说目录）
+PROMPT_INPUT_FILES = (
+    "Novel_architecture.txt",
+    "Novel_directory.txt",
+    "global_summary.txt",
+    "character_state.txt",
+    "plot_arcs.txt",
+    "chapter_summaries.json",
+    "character_index.json",
+    "novel_settings.json",
+)
+RECENT_CHAPTER_COUNT = 3  # 与 build_chapter_prompt 读取的前文章数一致
+
+
+def _file_hash(path: str):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def prompt_input_fingerprint(filepath: str, chapter_number: int, build_kwargs: dict) -> str:
+    """
+    计算构建第 chapter_number 章提示词的输入指纹。
+    build_kwargs 为传给 build_chapter_prompt 的参数（回调函数不参与计算）；参数只以哈希形式参与，不保存原文。
+    """
+    parts = {name: _file_hash(os.path.join(filepath, name)) for name in PROMPT_INPUT_FILES}
+    for n in range(max(1, chapter_number - RECENT_CHAPTER_COUNT), chapter_number):
+        name = f"chapters/chapter_{n}.txt"
+        parts[name] = _file_hash(os.path.join(filepath, "chapters", f"chapter_{n}.txt"))
+    parts["vectorstore"] = get_vector_store_version(filepath)
+    params = {key: value for key, value in build_kwargs.items() if not callable(value)}
+    parts["params"] = hashlib.sha1(
+        json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+_cache_lock = threading.Lock()
+
+def _read_cache(filepath: str) -> dict:
+    path = os.path.join(filepath, PROMPT_CACHE_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"读取提示词缓存失败: {e}")
+        return {}
+
+def _write_cache(filepath: str, cache: dict):
+    path = os.path.join(filepath, PROMPT_CACHE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def load_cached_prompt(filepath: str, chapter_number: int, fingerprint: str):
+    """返回指纹一致的缓存提示词，没有时返回 None"""
+    with _cache_lock:
+        cache = _read_cache(filepath)
+        entry = cache.get(fingerprint)
+        if not entry or entry.get("chapter_number") != chapter_number:
+            return None
+        entry["used_at"] = time.time()
+        try:
+            _write_cache(filepath, cache)
+        except OSError as e:
+            logging.warning(f"更新提示词缓存失败: {e}")
+        return entry.get("prompt")
+
+def save_cached_prompt(filepath: str, chapter_number: int, fingerprint: str, prompt: str, timings: dict = None):
+    """保存构建结果；超过 prompt_cache_size 条时丢弃最久未使用的条目"""
+    max_entries = int(load_novel_settings(filepath).get("prompt_cache_size") or 0)
+    if max_entries <= 0:
+        return
+    with _cache_lock:
+        cache = _read_cache(filepath)
+        now = time.time()
+        cache[fingerprint] = {
+            "chapter_number": chapter_number,
+            "prompt": prompt,
+            "timings": timings or {},
+            "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "used_at": now
+        }
+        if len(cache) > max_entries:
+            for key in sorted(cache, key=lambda k: cache[k].get("used_at", 0))[:len(cache) - max_entries]:
+                del cache[key]
+        try:
+            _write_cache(filepath, cache)
+        except OSError as e:
+            logging.warning(f"保存提示词缓存失败: {e}")
+
+def build_chapter_prompt_cached(build_kwargs: dict, force: bool = False, prompt_callback=None,
+                                progress_callback=None) -> str:
+    """
+    带缓存的 build_chapter_prompt。build_kwargs 为其参数（不含回调）；输入与之前某次构建完全相同时直接返回缓存结果，
+    同样通过 prompt_callback / progress_callback 通知界面。force=True 时忽略缓存重新构建（结果仍会写入缓存）。
+    """
+    filepath, chapter_number = build_kwargs["filepath"], build_kwargs["novel_number"]
+    fingerprint = prompt_input_fingerprint(filepath, chapter_number, build_kwargs)
+    if not force:
+        prompt = load_cached_prompt(filepath, chapter_number, fingerprint)
+        if prompt is not None:
+            logging.info(f"第{chapter_number}章提示词输入未变化，使用缓存结果")
+            if prompt_callback:
+                prompt_callback(f"\n[完整提示词]\n{prompt}")
+            if progress_callback:
+                progress_callback(1.0, "输入未变化，已使用缓存的提示词")
+            return prompt
+    prompt, timings = build_chapter_prompt(
+        **build_kwargs, prompt_callback=prompt_callback, progress_callback=progress_callback, return_timings=True
+    )
+    # 构建期间输入被修改（例如用户又改了角色状态、后台索引写入了新分段）时结果已经过期，不缓存
+    if prompt_input_fingerprint(filepath, chapter_number, build_kwargs) == fingerprint:
+        save_cached_prompt(filepath, chapter_number, fingerprint, prompt, timings)
+    else:
+        logging.info(f"第{chapter_number}章提示词构建期间输入已变化，结果未缓存")
+    return prompt
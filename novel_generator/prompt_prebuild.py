@@ -0,0 +1,89 @@
+#novel_generator/prompt_prebuild.py
+# -*- coding: utf-8 -*-
+"""
+定稿后预构建下一章提示词（需在 novel_settings.json 中开启 prebuild_next_prompt）：
+- 第N章定稿完成后，在后台线程中用当前界面参数为第N+1章执行 build_chapter_prompt，结果按输入指纹写入提示词缓存
+  （见 prompt_cache：输入文件、构建参数或向量库内容任何一项变化都视为失效）；
+- 预构建先等待刚定稿章节写入向量库，再计算指纹并构建，避免构建期间后台索引改变向量库版本导致结果作废；
+- 生成草稿时先取预构建结果，指纹一致则直接使用；预构建仍在进行时最多等待 PREBUILD_WAIT_TIMEOUT 秒，
+  超时（例如预构建还在等待向量库写入）则不再等待，直接构建。
+"""
+import os
+import logging
+import threading
+
+from novel_generator.chapter import build_chapter_prompt
+from novel_generator.index_queue import wait_for_index
+from novel_generator.prompt_cache import prompt_input_fingerprint, load_cached_prompt, save_cached_prompt
+
+INDEX_WAIT_TIMEOUT = 600  # 等待刚定稿章节写入向量库的最长时间（秒）
+PREBUILD_WAIT_TIMEOUT = 5  # 生成草稿时等待仍在进行的预构建的最长时间（秒），超时后自行构建
+
+class _PrebuildJob:
+    def __init__(self, chapter_number: int):
+        self.chapter_number = chapter_number
+        self.done = threading.Event()
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def _novel_key(filepath: str) -> str:
+    return os.path.normcase(os.path.abspath(filepath))
+
+def _run_prebuild(filepath: str, job: _PrebuildJob, build_kwargs: dict, log_func=None):
+    log = log_func or logging.info
+    try:
+        if not wait_for_index(filepath, job.chapter_number - 1, timeout=INDEX_WAIT_TIMEOUT):
+            logging.warning(f"第{job.chapter_number - 1}章尚未写入向量库，按现有数据预构建提示词")
+        fingerprint = prompt_input_fingerprint(filepath, job.chapter_number, build_kwargs)
+        if load_cached_prompt(filepath, job.chapter_number, fingerprint) is not None:
+            return
+        prompt, timings = build_chapter_prompt(**build_kwargs, return_timings=True)
+        # 构建期间输入被修改（例如用户又改了角色状态）时，结果已经过期，不保存
+        if prompt_input_fingerprint(filepath, job.chapter_number, build_kwargs) != fingerprint:
+            log(f"第{job.chapter_number}章提示词预构建期间输入已变化，结果未保存")
+            return
+        save_cached_prompt(filepath, job.chapter_number, fingerprint, prompt, timings)
+        log(f"✓ 第{job.chapter_number}章提示词已在后台预构建（耗时{timings.get('total', 0)}秒）")
+    except Exception as e:
+        logging.error(f"第{job.chapter_number}章提示词预构建失败: {e}")
+    finally:
+        job.done.set()
+        with _jobs_lock:
+            if _jobs.get(_novel_key(filepath)) is job:
+                del _jobs[_novel_key(filepath)]
+
+def start_prompt_prebuild(filepath: str, chapter_number: int, build_kwargs: dict, log_func=None) -> bool:
+    """
+    在后台预构建第 chapter_number 章的提示词。build_kwargs 为 build_chapter_prompt 的参数（不含回调）。
+    同一章的预构建正在进行时不重复启动；返回是否启动了新的预构建。
+    """
+    key = _novel_key(filepath)
+    with _jobs_lock:
+        running = _jobs.get(key)
+        if running is not None and running.chapter_number == chapter_number:
+            return False
+        job = _PrebuildJob(chapter_number)
+        _jobs[key] = job
+    threading.Thread(
+        target=_run_prebuild, args=(filepath, job, dict(build_kwargs), log_func),
+        name="prompt-prebuild", daemon=True
+    ).start()
+    return True
+
+def is_prebuild_running(filepath: str, chapter_number: int) -> bool:
+    with _jobs_lock:
+        job = _jobs.get(_novel_key(filepath))
+    return job is not None and job.chapter_number == chapter_number and not job.done.is_set()
+
+def get_prebuilt_prompt(filepath: str, chapter_number: int, build_kwargs: dict, wait_timeout: float = None):
+    """
+    返回与当前输入一致的预构建提示词，没有或已失效时返回 None。
+    同一章的预构建仍在进行时，最多等待 wait_timeout 秒（None 为一直等待），完成后再按当前输入计算指纹。
+    """
+    with _jobs_lock:
+        job = _jobs.get(_novel_key(filepath))
+    if job is not None and job.chapter_number == chapter_number:
+        job.done.wait(wait_timeout)
+    return load_cached_prompt(filepath, chapter_number, prompt_input_fingerprint(filepath, chapter_number, build_kwargs))
@@ -0,0 +1,227 @@
+#novel_generator/role_index.py
+# -*- coding: utf-8 -*-
+"""
+角色库索引：记录 角色库/分类/角色名.txt 的 角色名 → 文件路径、内容哈希与解析出的属性，保存到 role_index.json：
+- 按分类目录的修改时间增量刷新，只重新扫描有文件增删的分类目录，只重新读取修改时间或大小变化的文件；
+- 角色库管理窗口与定稿时的角色库同步在写入/删除角色文件后直接更新对应条目；
+- 构建提示词时只读取本章涉及的角色文件，不再遍历整个角色库。
+同名角色存在于多个分类时，优先使用"全部"分类中的文件（与角色库管理窗口一致）。
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from novel_generator.character_store import parse_character_attributes
+
+ROLE_LIBRARY_DIR = "角色库"
+ROLE_INDEX_FILE = "role_index.json"
+PREFERRED_CATEGORY = "全部"
+
+
+def get_role_library_dir(filepath: str) -> str:
+    return os.path.join(filepath, ROLE_LIBRARY_DIR)
+
+def _signature(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+def read_role_file(path: str) -> str:
+    """读取角色文件（兼容 UTF-8 BOM 与 GBK 编码）"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    for encoding in ("utf-8-sig", "gbk"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode("utf-8", errors="replace")
+
+
+class RoleIndex:
+    """
+    单本小说的角色库索引（由 get_role_index 创建）。
+    roles: {角色名: {分类: {"path", "mtime_ns", "size", "hash", "attributes"}}}；dirs: {分类: 目录修改时间}
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.library_dir = get_role_library_dir(filepath)
+        self.index_file = os.path.join(filepath, ROLE_INDEX_FILE)
+        self.roles = {}
+        self.dirs = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.roles = data.get("roles", {})
+            self.dirs = data.get("dirs", {})
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取角色库索引失败，将重新建立: {e}")
+            self.roles, self.dirs = {}, {}
+
+    def _save(self):
+        if not self._dirty:
+            return
+        tmp_file = self.index_file + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"dirs": self.dirs, "roles": self.roles}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, self.index_file)
+            self._dirty = False
+        except OSError as e:
+            logging.warning(f"保存角色库索引失败: {e}")
+
+    def _drop(self, name: str, category: str):
+        entries = self.roles.get(name)
+        if entries and entries.pop(category, None) is not None:
+            if not entries:
+                del self.roles[name]
+            self._dirty = True
+
+    def _index_file(self, category: str, name: str, content: str = None):
+        """更新单个角色文件的条目；文件不存在时删除条目。content 为已读出的文件内容（可省去一次读取）"""
+        path = os.path.join(self.library_dir, category, f"{name}.txt")
+        signature = _signature(path)
+        if signature is None:
+            self._drop(name, category)
+            return None
+        entry = self.roles.get(name, {}).get(category)
+        if entry and entry.get("mtime_ns") == signature["mtime_ns"] and entry.get("size") == signature["size"]:
+            return entry
+        if content is None:
+            try:
+                content = read_role_file(path)
+            except OSError as e:
+                logging.warning(f"读取角色文件 {path} 失败: {e}")
+                return None
+        parsed = parse_character_attributes(content)
+        entry = dict(
+            signature,
+            path=os.path.join(category, f"{name}.txt"),
+            hash=hashlib.sha1(content.encode("utf-8")).hexdigest(),
+            attributes=parsed.get(name) or next(iter(parsed.values()), {})
+        )
+        self.roles.setdefault(name, {})[category] = entry
+        self._dirty = True
+        return entry
+
+    def _scan_category(self, category: str):
+        category_dir = os.path.join(self.library_dir, category)
+        try:
+            names = {os.path.splitext(f)[0] for f in os.listdir(category_dir) if f.endswith(".txt")}
+        except OSError:
+            names = set()
+        for name in [n for n, entries in self.roles.items() if category in entries and n not in names]:
+            self._drop(name, category)
+        for name in names:
+            self._index_file(category, name)
+
+    def refresh(self):
+        """只重新扫描修改时间变化（有文件增删或改名）的分类目录，并去掉已不存在的分类"""
+        with self._lock:
+            try:
+                categories = {d: _signature(os.path.join(self.library_dir, d))
+                              for d in os.listdir(self.library_dir)
+                              if os.path.isdir(os.path.join(self.library_dir, d))}
+            except OSError:
+                categories = {}
+            for category in [c for c in self.dirs if c not in categories]:
+                for name in [n for n, entries in self.roles.items() if category in entries]:
+                    self._drop(name, category)
+                del self.dirs[category]
+                self._dirty = True
+            for category, signature in categories.items():
+                mtime_ns = signature["mtime_ns"] if signature else None
+                if self.dirs.get(category) != mtime_ns:
+                    self._scan_category(category)
+                    self.dirs[category] = mtime_ns
+                    self._dirty = True
+            self._save()
+
+    def update_files(self, paths):
+        """角色文件被写入、删除或移动后调用，按文件路径更新对应条目（不在角色库内的路径忽略）"""
+        library_dir = os.path.normcase(os.path.abspath(self.library_dir))
+        with self._lock:
+            for path in paths:
+                full = os.path.normcase(os.path.abspath(path))
+                if not full.endswith(".txt") or os.path.dirname(os.path.dirname(full)) != library_dir:
+                    continue
+                category = os.path.basename(os.path.dirname(path))
+                self._index_file(category, os.path.splitext(os.path.basename(path))[0])
+            self._save()
+
+    def _preferred(self, name: str):
+        entries = self.roles.get(name) or {}
+        for category in [PREFERRED_CATEGORY] + sorted(c for c in entries if c != PREFERRED_CATEGORY):
+            if category in entries:
+                return category
+        return None
+
+    def read_roles(self, names) -> dict:
+        """
+        批量读取指定角色的文件内容，返回 {角色名: 内容}（角色库中没有的角色不出现在结果中）。
+        只打开这些角色的文件；读取到的内容同时用于校验并更新索引条目。
+        """
+        contents = {}
+        with self._lock:
+            self.refresh()
+            for name in dict.fromkeys(n.strip() for n in names if n and n.strip()):
+                category = self._preferred(name)
+                while category is not None:
+                    path = os.path.join(self.library_dir, category, f"{name}.txt")
+                    try:
+                        content = read_role_file(path)
+                    except OSError:
+                        # 文件在上次扫描后被删除或移走：去掉条目后改用其他分类中的同名角色
+                        self._drop(name, category)
+                        category = self._preferred(name)
+                        continue
+                    self._index_file(category, name, content)
+                    contents[name] = content.strip()
+                    break
+            self._save()
+        return contents
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_role_index(filepath: str) -> RoleIndex:
+    """返回小说的角色库索引（进程内按小说目录缓存）"""
+    key = os.path.normcase(os.path.abspath(filepath))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = RoleIndex(filepath)
+            _indexes[key] = index
+        return index
+
+def read_role_contents(filepath: str, names) -> list:
+    """按 names 的顺序返回角色库中这些角色的文件内容（找不到的角色跳过）"""
+    contents = get_role_index(filepath).read_roles(names)
+    return [contents[name] for name in dict.fromkeys(n.strip() for n in names if n and n.strip()) if name in contents]
+
+def update_role_index(filepath: str, paths):
+    """写入、删除或移动角色文件后更新索引中对应的条目"""
+    try:
+        get_role_index(filepath).update_files(paths)
+    except Exception as e:
+        logging.warning(f"更新角色库索引失败: {e}")
+
+def refresh_role_index(filepath: str):
+    """分类目录增删、改名后刷新索引"""
+    try:
+        get_role_index(filepath).refresh()
+    except Exception as e:
+        logging.warning(f"刷新角色库索引失败: {e}")
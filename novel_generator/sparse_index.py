@@ -0,0 +1,223 @@
+#novel_generator/sparse_index.py
+# -*- coding: utf-8 -*-
+"""
+与向量库并存的稀疏倒排索引（BM25），用于弥补纯向量检索对人名、物品名、地名等精确词的遗漏。
+- 中文按相邻二字切分（bigram），英文/数字按词切分，不依赖分词库；
+- 索引保存在向量库目录下的 SQLite 文件中，按文档ID增量写入/删除，无需整体重建。
+"""
+import os
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+SPARSE_INDEX_FILE = "sparse_index.db"
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CJK_RUN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+def tokenize(text: str) -> list:
+    """
+    切分为检索词：连续中文按二字滑窗切分（单字片段保留单字），英文/数字按词小写化。
+    例如 "林动进入古墓" -> ["林动", "动进", "进入", "入古", "古墓"]
+    """
+    if not text:
+        return []
+    tokens = []
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD_RE.findall(text))
+    return tokens
+
+
+class SparseIndex:
+    """
+    基于 SQLite 的 BM25 倒排索引。
+    表结构：
+        docs(doc_id, length)            每个文档的词数
+        postings(term, doc_id, tf)      倒排表
+    每次操作使用独立连接，可在多线程/多进程间安全共享同一文件。
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._ready:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS docs (doc_id TEXT PRIMARY KEY, length INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL, doc_id TEXT NOT NULL, tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, doc_id)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc_id);
+                """
+            )
+            self._ready = True
+        return conn
+
+    def add(self, ids: list, texts: list):
+        """写入（或替换）一批文档"""
+        if not ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self._delete(conn, ids)
+                    for doc_id, text in zip(ids, texts):
+                        counts = Counter(tokenize(text))
+                        conn.execute(
+                            "INSERT INTO docs(doc_id, length) VALUES (?, ?)",
+                            (doc_id, sum(counts.values()))
+                        )
+                        conn.executemany(
+                            "INSERT INTO postings(term, doc_id, tf) VALUES (?, ?, ?)",
+                            [(term, doc_id, tf) for term, tf in counts.items()]
+                        )
+            finally:
+                conn.close()
+
+    def remove(self, ids: list):
+        """删除一批文档"""
+        if not ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    self._delete(conn, ids)
+            finally:
+                conn.close()
+
+    @staticmethod
+    def _delete(conn, ids: list):
+        for start in range(0, len(ids), 500):
+            chunk = list(ids[start:start + 500])
+            marks = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM postings WHERE doc_id IN ({marks})", chunk)
+            conn.execute(f"DELETE FROM docs WHERE doc_id IN ({marks})", chunk)
+
+    def doc_ids(self) -> set:
+        """已索引的全部文档ID"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                return {row[0] for row in conn.execute("SELECT doc_id FROM docs")}
+            finally:
+                conn.close()
+
+    def count(self) -> int:
+        with self._lock:
+            conn = self._connect()
+            try:
+                return conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            finally:
+                conn.close()
+
+    def document_frequencies(self, terms) -> tuple:
+        """返回 (文档总数, {检索词: 包含该词的文档数})，用于按本书语料计算 IDF"""
+        terms = list(set(terms))
+        with self._lock:
+            conn = self._connect()
+            try:
+                total_docs = conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+                df = {}
+                for start in range(0, len(terms), 500):
+                    chunk = terms[start:start + 500]
+                    marks = ",".join("?" * len(chunk))
+                    df.update(conn.execute(
+                        f"SELECT term, COUNT(*) FROM postings WHERE term IN ({marks}) GROUP BY term", chunk
+                    ))
+                return total_docs, df
+            finally:
+                conn.close()
+
+    def search(self, query: str, k: int = 10) -> list:
+        """
+        BM25 检索，返回按分数降序的 [(doc_id, score), ...]，最多 k 条。
+        查询中重复出现的词按出现次数加权。
+        """
+        query_terms = Counter(tokenize(query))
+        if not query_terms or k <= 0:
+            return []
+        with self._lock:
+            conn = self._connect()
+            try:
+                total_docs, total_length = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs"
+                ).fetchone()
+                if total_docs == 0:
+                    return []
+                avg_length = (total_length / total_docs) or 1.0
+                terms = list(query_terms)
+                marks = ",".join("?" * len(terms))
+                df = dict(conn.execute(
+                    f"SELECT term, COUNT(*) FROM postings WHERE term IN ({marks}) GROUP BY term", terms
+                ))
+                rows = conn.execute(
+                    f"SELECT p.term, p.doc_id, p.tf, d.length FROM postings p "
+                    f"JOIN docs d ON d.doc_id = p.doc_id WHERE p.term IN ({marks})",
+                    terms
+                ).fetchall()
+            finally:
+                conn.close()
+
+        scores = {}
+        for term, doc_id, tf, length in rows:
+            idf = math.log(1 + (total_docs - df[term] + 0.5) / (df[term] + 0.5))
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            scores[doc_id] = scores.get(doc_id, 0.0) + query_terms[term] * idf * tf * (BM25_K1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def _index_path(store_dir: str, collection_name: str = None) -> str:
+    name = f"sparse_index.{collection_name}.db" if collection_name else SPARSE_INDEX_FILE
+    return os.path.join(os.path.normcase(os.path.abspath(store_dir)), name)
+
+def get_sparse_index(store_dir: str, collection_name: str = None) -> SparseIndex:
+    """获取向量库目录中某个集合对应的稀疏索引（同一集合共享一个实例，每个集合一个索引文件）"""
+    path = _index_path(store_dir, collection_name)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = SparseIndex(path)
+            _indexes[path] = index
+        return index
+
+def sparse_index_exists(store_dir: str, collection_name: str = None) -> bool:
+    """该集合的索引文件是否已存在（只读场景下用于避免创建空索引）"""
+    return os.path.exists(_index_path(store_dir, collection_name))
+
+def discard_sparse_index(store_dir: str):
+    """丢弃该目录下所有缓存的索引实例（向量库目录被删除/替换时调用）"""
+    prefix = os.path.join(os.path.normcase(os.path.abspath(store_dir)), "")
+    with _indexes_lock:
+        for path in [p for p in _indexes if p.startswith(prefix)]:
+            del _indexes[path]
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> dict:
+    """
+    倒数排名融合（RRF）：rankings 为若干个按相关度排好序的文档ID列表，
+    返回 {doc_id: 融合分数}，分数 = Σ 1 / (k + 排名)。
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return fused
@@ -0,0 +1,71 @@
+#novel_generator/stage_graph.py
+# -*- coding: utf-8 -*-
+"""
+按依赖关系并发执行的阶段图：每个阶段声明它依赖的阶段，依赖全部完成后立即提交到线程池，
+互不依赖的阶段（读文件、解析目录、创建 embedding 适配器、LLM 摘要……）同时进行。
+每个阶段完成时按完成数推进进度回调，并记录各阶段实际耗时（秒）。
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageGraph:
+    """
+    阶段图。add(name, func, deps) 登记阶段，func 接收 {依赖阶段名: 结果} 并返回本阶段结果；
+    run() 执行全部阶段，返回 (results, timings)。阶段抛出的异常会在 run() 中重新抛出。
+    """
+
+    def __init__(self):
+        self._stages = {}
+
+    def add(self, name: str, func, deps=(), description: str = ""):
+        """登记阶段；依赖必须是之前已登记的阶段（因此不会出现环）"""
+        if name in self._stages:
+            raise ValueError(f"阶段 {name} 重复登记")
+        unknown = [dep for dep in deps if dep not in self._stages]
+        if unknown:
+            raise ValueError(f"阶段 {name} 依赖了未登记的阶段: {unknown}")
+        self._stages[name] = (func, tuple(deps), description or name)
+
+    @staticmethod
+    def _timed(func, inputs: dict):
+        start = time.perf_counter()
+        value = func(inputs)
+        return value, time.perf_counter() - start
+
+    def run(self, max_workers: int = 4, progress_callback=None, progress_range: tuple = (0.0, 1.0)) -> tuple:
+        """
+        执行全部阶段。progress_callback(progress, description) 在每个阶段完成时调用，
+        进度按完成的阶段数在 progress_range 内线性推进。
+        返回 ({阶段名: 结果}, {阶段名: 耗时秒数})。
+        """
+        results, timings = {}, {}
+        pending = dict(self._stages)
+        running = {}
+        low, high = progress_range
+        total = len(pending) or 1
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prompt-stage") as executor:
+            while pending or running:
+                ready = [name for name, (_, deps, _) in pending.items() if all(dep in results for dep in deps)]
+                for name in ready:
+                    func, deps, description = pending.pop(name)
+                    future = executor.submit(self._timed, func, {dep: results[dep] for dep in deps})
+                    running[future] = (name, description)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, description = running.pop(future)
+                    try:
+                        value, elapsed = future.result()
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        logging.error(f"阶段 {name}（{description}）执行失败")
+                        raise
+                    results[name] = value
+                    timings[name] = round(elapsed, 3)
+                    if progress_callback:
+                        progress_callback(low + (high - low) * len(results) / total, f"{description}完成")
+        return results, timings
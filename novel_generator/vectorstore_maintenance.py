@@ -0,0 +1,426 @@
+#novel_generator/vectorstore_maintenance.py
+# -*- coding: utf-8 -*-
+"""
+向量库维护工具：快照导出/导入、压缩、完整性检查与定向修复。
+- 快照是一个 zip 文件，包含每个集合的向量矩阵（.npy）、文本与元数据（.jsonl）以及清单（manifest.json），
+  与后端无关：Chroma 导出的快照可以导入为 NumPy 后端，反之亦然，导入时不重新 embedding；
+- 完整性检查找出空向量、维度不符、含 NaN/全零的向量（embedding 接口失败时的空结果可能被写入），
+  修复时只对这些条目重新 embedding，不必清空整个向量库。
+所有操作都持有该小说向量库的写锁，并在开始前释放缓存的句柄，独占访问向量库文件。
+"""
+import os
+import io
+import json
+import time
+import sqlite3
+import zipfile
+import logging
+from collections import Counter
+
+import numpy as np
+
+from novel_generator.sparse_index import get_sparse_index
+from novel_generator.npy_vectorstore import NpyCollection
+from novel_generator.vectorstore_utils import (
+    CHAPTER_COLLECTION,
+    KNOWLEDGE_COLLECTION,
+    get_vectorstore_dir,
+    get_vector_store_lock,
+    get_vector_backend,
+    invalidate_vector_store,
+    bump_vector_store_version,
+    clear_vector_store,
+    load_vector_store,
+    sync_sparse_index,
+    _normalize_store_dir,
+    _get_chroma_client,
+    _embedding_model_key
+)
+
+SNAPSHOT_FORMAT = 1
+MAINTAINED_COLLECTIONS = (CHAPTER_COLLECTION, KNOWLEDGE_COLLECTION)
+PAGE_SIZE = 500
+
+
+def _open_collection(filepath: str, name: str, create: bool = False):
+    """绕过句柄注册表直接打开集合（调用方已持有写锁并已 invalidate）；集合不存在且 create=False 时返回 None"""
+    store_dir = _normalize_store_dir(filepath)
+    if get_vector_backend(filepath) == "numpy":
+        if not create and not os.path.exists(os.path.join(store_dir, f"{name}.json")):
+            return None
+        return NpyCollection(store_dir, name)
+    client = _get_chroma_client(store_dir)
+    if create:
+        return client.get_or_create_collection(name)
+    try:
+        return client.get_collection(name)
+    except Exception:
+        return None
+
+def _close_collection(collection):
+    if isinstance(collection, NpyCollection):
+        collection.close()
+
+def _iter_pages(collection, include: list, page_size: int = PAGE_SIZE):
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=page_size, offset=offset)
+        ids = page.get("ids", [])
+        if not ids:
+            return
+        yield page
+        offset += len(ids)
+
+def _vector_problem(vector, expected_dim: int):
+    """返回向量的问题类型（"empty" / "wrong_dim" / "invalid"），正常时返回 None"""
+    if vector is None:
+        return "empty"
+    array = np.asarray(vector, dtype=np.float32).reshape(-1)
+    if array.size == 0:
+        return "empty"
+    if expected_dim and array.size != expected_dim:
+        return "wrong_dim"
+    if not np.all(np.isfinite(array)) or not np.any(array):
+        return "invalid"
+    return None
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+# ============== 快照导出 / 导入 ==============
+def export_vector_store(filepath: str, snapshot_path: str, embedding_adapter=None) -> dict:
+    """
+    把小说向量库的各集合导出为一个可移植的快照文件（zip）。
+    提供 embedding_adapter 时在清单中记录模型标识，导入时据此检查模型是否一致。
+    向量异常的条目只导出文本与元数据（导入时重新 embedding）。
+    返回清单内容。
+    """
+    store_dir = get_vectorstore_dir(filepath)
+    if not os.path.exists(store_dir):
+        raise FileNotFoundError(f"向量库不存在: {store_dir}")
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "backend": get_vector_backend(filepath),
+        "embedding_model": _embedding_model_key(embedding_adapter) if embedding_adapter is not None else None,
+        "collections": {}
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+    tmp_path = snapshot_path + ".tmp"
+    with get_vector_store_lock(filepath):
+        invalidate_vector_store(filepath)
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for name in MAINTAINED_COLLECTIONS:
+                collection = _open_collection(filepath, name)
+                if collection is None:
+                    continue
+                try:
+                    vectors, records, dims = [], [], Counter()
+                    pages = list(_iter_pages(collection, ["embeddings", "documents", "metadatas"]))
+                    for page in pages:
+                        dims.update(len(v) for v in page["embeddings"] if v is not None and len(v))
+                    dim = dims.most_common(1)[0][0] if dims else 0
+                    for page in pages:
+                        metadatas = page.get("metadatas") or [None] * len(page["ids"])
+                        for doc_id, vector, text, metadata in zip(page["ids"], page["embeddings"],
+                                                                  page["documents"], metadatas):
+                            row = None
+                            if _vector_problem(vector, dim) is None:
+                                row = len(vectors)
+                                vectors.append(np.asarray(vector, dtype=np.float32))
+                            records.append({"id": doc_id, "row": row, "text": text, "meta": metadata})
+                finally:
+                    _close_collection(collection)
+
+                matrix = np.vstack(vectors) if vectors else np.zeros((0, dim), dtype=np.float32)
+                buffer = io.BytesIO()
+                np.save(buffer, matrix)
+                archive.writestr(f"{name}.npy", buffer.getvalue())
+                archive.writestr(f"{name}.jsonl", "".join(
+                    json.dumps(record, ensure_ascii=False) + "\n" for record in records
+                ))
+                manifest["collections"][name] = {
+                    "count": len(records),
+                    "dim": dim,
+                    "missing_vectors": len(records) - len(vectors)
+                }
+            archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    os.replace(tmp_path, snapshot_path)
+    logging.info(f"向量库快照已导出到 {snapshot_path}: " + "，".join(
+        f"{name} {info['count']}条" for name, info in manifest["collections"].items()
+    ))
+    return manifest
+
+def import_vector_store(embedding_adapter, filepath: str, snapshot_path: str, replace: bool = True,
+                        allow_model_mismatch: bool = False) -> dict:
+    """
+    从快照导入向量库，直接写入快照中的向量，不重新 embedding（快照中缺失向量的条目除外）。
+    replace=True 时先清空现有向量库；否则合并写入（已存在的ID保持不变）。
+    快照记录的 embedding 模型与当前模型不一致时拒绝导入（检索结果会失去意义），
+    除非 allow_model_mismatch=True。导入后重建各集合的稀疏索引。
+    返回 {集合名: 写入条数}。
+    """
+    with zipfile.ZipFile(snapshot_path, "r") as archive:
+        manifest = json.loads(archive.read("manifest.json").decode("utf-8"))
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"不支持的快照格式: {manifest.get('format')}")
+        snapshot_model = manifest.get("embedding_model")
+        current_model = _embedding_model_key(embedding_adapter)
+        if snapshot_model and snapshot_model != current_model and not allow_model_mismatch:
+            raise ValueError(f"快照的 embedding 模型（{snapshot_model}）与当前模型（{current_model}）不一致")
+
+        imported = {}
+        with get_vector_store_lock(filepath):
+            if replace:
+                clear_vector_store(filepath)
+            os.makedirs(get_vectorstore_dir(filepath), exist_ok=True)
+            invalidate_vector_store(filepath)
+            for name in manifest.get("collections", {}):
+                matrix = np.load(io.BytesIO(archive.read(f"{name}.npy")))
+                records = [json.loads(line) for line in archive.read(f"{name}.jsonl").decode("utf-8").splitlines() if line]
+                collection = _open_collection(filepath, name, create=True)
+                try:
+                    for start in range(0, len(records), PAGE_SIZE):
+                        page = records[start:start + PAGE_SIZE]
+                        with_vectors = [r for r in page if r["row"] is not None]
+                        without_vectors = [r for r in page if r["row"] is None and r["text"]]
+                        embeddings = [matrix[r["row"]].tolist() for r in with_vectors]
+                        if without_vectors:
+                            embeddings.extend(embedding_adapter.embed_documents([r["text"] for r in without_vectors]))
+                        rows = with_vectors + without_vectors
+                        existing = set(collection.get(ids=[r["id"] for r in rows], include=[]).get("ids", []))
+                        fresh = [(r, e) for r, e in zip(rows, embeddings) if r["id"] not in existing and e]
+                        if fresh:
+                            collection.add(
+                                ids=[r["id"] for r, _ in fresh],
+                                embeddings=[list(e) for _, e in fresh],
+                                documents=[r["text"] for r, _ in fresh],
+                                metadatas=[r["meta"] or None for r, _ in fresh]
+                            )
+                        imported[name] = imported.get(name, 0) + len(fresh)
+                finally:
+                    _close_collection(collection)
+            invalidate_vector_store(filepath)
+            for name in manifest.get("collections", {}):
+                store = load_vector_store(embedding_adapter, filepath, name)
+                if store is not None:
+                    sync_sparse_index(store, filepath)
+            bump_vector_store_version(filepath)
+    logging.info(f"向量库快照已导入: {imported}")
+    return imported
+
+
+# ============== 压缩 ==============
+def compact_vector_store(filepath: str) -> dict:
+    """
+    压缩向量库：NumPy 后端去掉已删除的行，Chroma 后端对 SQLite 执行 VACUUM；
+    同时清理稀疏索引中已不存在的文档并 VACUUM 索引文件。
+    返回 {"before": 压缩前字节数, "after": 压缩后字节数, "orphaned": 清理的稀疏索引条目数}
+    """
+    store_dir = _normalize_store_dir(filepath)
+    if not os.path.exists(store_dir):
+        raise FileNotFoundError(f"向量库不存在: {store_dir}")
+    before = _dir_size(store_dir)
+    orphaned = 0
+    with get_vector_store_lock(filepath):
+        invalidate_vector_store(filepath)
+        backend = get_vector_backend(filepath)
+        if backend == "chroma":
+            chroma_db = os.path.join(store_dir, "chroma.sqlite3")
+            if os.path.exists(chroma_db):
+                conn = sqlite3.connect(chroma_db, timeout=30)
+                try:
+                    conn.execute("VACUUM")
+                finally:
+                    conn.close()
+        for name in MAINTAINED_COLLECTIONS:
+            collection = _open_collection(filepath, name)
+            if collection is None:
+                continue
+            try:
+                if isinstance(collection, NpyCollection):
+                    collection.compact()
+                present = set()
+                for page in _iter_pages(collection, []):
+                    present.update(page["ids"])
+            finally:
+                _close_collection(collection)
+            index = get_sparse_index(store_dir, name)
+            stale = list(index.doc_ids() - present)
+            index.remove(stale)
+            orphaned += len(stale)
+            conn = sqlite3.connect(index.db_path, timeout=30)
+            try:
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+        invalidate_vector_store(filepath)
+    after = _dir_size(store_dir)
+    logging.info(f"向量库压缩完成：{before / 1048576:.1f}MB -> {after / 1048576:.1f}MB，清理稀疏索引{orphaned}条")
+    return {"before": before, "after": after, "orphaned": orphaned}
+
+
+# ============== 完整性检查与修复 ==============
+def check_vector_store(filepath: str, expected_dim: int = None) -> dict:
+    """
+    检查各集合中的向量：
+        empty      空向量
+        wrong_dim  维度与 expected_dim（未指定时取全库最常见的维度）不符
+        invalid    含 NaN/Inf 或全零
+        empty_text 文本为空（无法重新 embedding）
+    返回 {"dim": 判定用的维度, "collections": {集合名: {"count": 条数, "empty": [ID...], ...}}}
+    """
+    report = {"dim": expected_dim, "collections": {}}
+    if not os.path.exists(get_vectorstore_dir(filepath)):
+        return report
+    pages_by_collection = {}
+    dims = Counter()
+    with get_vector_store_lock(filepath):
+        invalidate_vector_store(filepath)
+        for name in MAINTAINED_COLLECTIONS:
+            collection = _open_collection(filepath, name)
+            if collection is None:
+                continue
+            try:
+                pages = []
+                for page in _iter_pages(collection, ["embeddings", "documents"]):
+                    vectors = [None if v is None else np.asarray(v, dtype=np.float32).reshape(-1) for v in page["embeddings"]]
+                    pages.append((page["ids"], vectors, page["documents"]))
+                    dims.update(v.size for v in vectors if v is not None and v.size)
+                pages_by_collection[name] = pages
+            finally:
+                _close_collection(collection)
+    dim = expected_dim or (dims.most_common(1)[0][0] if dims else None)
+    report["dim"] = dim
+    for name, pages in pages_by_collection.items():
+        entry = {"count": 0, "empty": [], "wrong_dim": [], "invalid": [], "empty_text": []}
+        for ids, vectors, texts in pages:
+            entry["count"] += len(ids)
+            for doc_id, vector, text in zip(ids, vectors, texts):
+                problem = _vector_problem(vector, dim)
+                if problem:
+                    entry[problem].append(doc_id)
+                if not (text or "").strip():
+                    entry["empty_text"].append(doc_id)
+        report["collections"][name] = entry
+        bad = sum(len(entry[key]) for key in ("empty", "wrong_dim", "invalid"))
+        if bad or entry["empty_text"]:
+            logging.warning(f"向量库集合 {name} 共{entry['count']}条，向量异常{bad}条，空文本{len(entry['empty_text'])}条")
+    return report
+
+def repair_vector_store(embedding_adapter, filepath: str, report: dict = None, batch_size: int = 32) -> dict:
+    """
+    只对完整性检查发现的异常条目重新 embedding 并写回（文本为空的条目直接删除）。
+    以当前 embedding 模型的输出维度为准：先用一条探测文本确定维度再检查，
+    新向量仍不合格时保留原状并记录日志。返回 {集合名: 修复条数}。
+    """
+    probe = embedding_adapter.embed_query("维度检测")
+    if not probe:
+        raise RuntimeError("Embedding 接口不可用，无法修复向量库")
+    dim = len(probe)
+    if report is None or report.get("dim") != dim:
+        report = check_vector_store(filepath, expected_dim=dim)
+    repaired = {}
+    with get_vector_store_lock(filepath):
+        invalidate_vector_store(filepath)
+        for name, entry in report.get("collections", {}).items():
+            bad_ids = [doc_id for key in ("empty", "wrong_dim", "invalid") for doc_id in entry.get(key, [])]
+            if not bad_ids and not entry.get("empty_text"):
+                continue
+            collection = _open_collection(filepath, name)
+            if collection is None:
+                continue
+            try:
+                if entry.get("empty_text"):
+                    collection.delete(ids=list(entry["empty_text"]))
+                    get_sparse_index(_normalize_store_dir(filepath), name).remove(list(entry["empty_text"]))
+                empty_text = set(entry.get("empty_text", []))
+                bad_ids = [doc_id for doc_id in bad_ids if doc_id not in empty_text]
+                count = 0
+                for start in range(0, len(bad_ids), batch_size):
+                    page = collection.get(ids=bad_ids[start:start + batch_size], include=["documents"])
+                    vectors = embedding_adapter.embed_documents(page["documents"])
+                    if not vectors or len(vectors) != len(page["ids"]):
+                        logging.warning(f"重新 embedding 失败，跳过{len(page['ids'])}条")
+                        continue
+                    fixed = [(doc_id, vector) for doc_id, vector in zip(page["ids"], vectors)
+                             if _vector_problem(vector, dim) is None]
+                    if fixed:
+                        collection.update(ids=[doc_id for doc_id, _ in fixed],
+                                          embeddings=[list(vector) for _, vector in fixed])
+                    count += len(fixed)
+                repaired[name] = count
+            finally:
+                _close_collection(collection)
+        invalidate_vector_store(filepath)
+        if repaired:
+            bump_vector_store_version(filepath)
+    logging.info(f"向量库修复完成: {repaired}")
+    return repaired
+
+
+def _main(argv=None):
+    """命令行入口：python -m novel_generator.vectorstore_maintenance <export|import|compact|check|repair> --filepath <小说目录>"""
+    import argparse
+    parser = argparse.ArgumentParser(description="小说向量库维护：快照导出/导入、压缩、完整性检查与修复")
+    parser.add_argument("command", choices=["export", "import", "compact", "check", "repair"])
+    parser.add_argument("--filepath", required=True, help="小说保存路径（向量库位于其下的 vectorstore 目录）")
+    parser.add_argument("--snapshot", help="快照文件路径（export / import）")
+    parser.add_argument("--merge", action="store_true", help="import 时合并到现有向量库而不是替换")
+    parser.add_argument("--allow-model-mismatch", action="store_true", help="import 时忽略 embedding 模型不一致")
+    parser.add_argument("--config", default="config.json", help="读取 embedding 配置的 config.json")
+    parser.add_argument("--interface-format", help="覆盖 embedding 接口格式")
+    parser.add_argument("--api-key", help="覆盖 embedding API Key")
+    parser.add_argument("--url", help="覆盖 embedding 接口地址")
+    parser.add_argument("--model", help="覆盖 embedding 模型名")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command in ("export", "import") and not args.snapshot:
+        parser.error("export / import 需要 --snapshot")
+
+    from config_manager import load_config
+    from novel_generator.vectorstore_utils import set_default_vector_backend
+    config = load_config(args.config)
+    set_default_vector_backend(config.get("vectorstore_backend", "chroma"))
+
+    def embedding_adapter():
+        from embedding_adapters import create_embedding_adapter
+        interface_format = args.interface_format or config.get("last_embedding_interface_format", "OpenAI")
+        emb_conf = config.get("embedding_configs", {}).get(interface_format, {})
+        return create_embedding_adapter(
+            interface_format,
+            args.api_key or emb_conf.get("api_key", ""),
+            args.url or emb_conf.get("base_url", ""),
+            args.model or emb_conf.get("model_name", "")
+        )
+
+    if args.command == "export":
+        result = export_vector_store(args.filepath, args.snapshot, embedding_adapter())
+    elif args.command == "import":
+        result = import_vector_store(embedding_adapter(), args.filepath, args.snapshot,
+                                     replace=not args.merge, allow_model_mismatch=args.allow_model_mismatch)
+    elif args.command == "compact":
+        result = compact_vector_store(args.filepath)
+    elif args.command == "check":
+        report = check_vector_store(args.filepath)
+        result = {"dim": report["dim"], "collections": {
+            name: {key: len(value) if isinstance(value, list) else value for key, value in entry.items()}
+            for name, entry in report["collections"].items()
+        }}
+    else:
+        result = repair_vector_store(embedding_adapter(), args.filepath)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(_main())
@@ -4,32 +4,63 @@
 向量库相关操作（初始化、更新、检索、清空、文本切分等）
 """
 import os
+import atexit
+import hashlib
 import logging
 import traceback
-import nltk
 import numpy as np
 import re
 import ssl
 import requests
+import threading
+import uuid
 import warnings
-from langchain_chroma import Chroma
+import json
+from collections import OrderedDict
 
 # 禁用特定的Torch警告
 warnings.filterwarnings('ignore', message='.*Torch was not compiled with flash attention.*')
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # 禁用tokenizer并行警告
 
-from chromadb.config import Settings
 try:
     from langchain_core.documents import Document
 except ImportError:
     from langchain.docstore.document import Document  # type: ignore
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.metrics.pairwise import cosine_similarity, paired_cosine_distances
 from .common import call_with_retry
+from .sparse_index import get_sparse_index, discard_sparse_index, reciprocal_rank_fusion
+from .npy_vectorstore import NpyVectorStore, NpyCollection
 
 def get_vectorstore_dir(filepath: str) -> str:
     """获取 vectorstore 路径"""
     return os.path.join(filepath, "vectorstore")
 
+STORE_VERSION_FILE = "store_version.txt"
+
+def get_vector_store_version(filepath: str) -> str:
+    """
+    向量库内容版本号：每次写入/删除分段后都会更换为新的随机值，供提示词缓存等判断检索结果是否可能变化。
+    向量库不存在或从未写入时返回空字符串。
+    """
+    try:
+        with open(os.path.join(get_vectorstore_dir(filepath), STORE_VERSION_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def bump_vector_store_version(filepath: str):
+    """向量库内容变化后更换版本号（失败只记录日志，不影响写入本身）"""
+    store_dir = get_vectorstore_dir(filepath)
+    path = os.path.join(store_dir, STORE_VERSION_FILE)
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Failed to update vector store version: {e}")
+
 def clear_vector_store(filepath: str) -> bool:
     """清空 清空向量库"""
     import shutil
@@ -38,7 +69,10 @@ def clear_vector_store(filepath: str) -> bool:
         logging.info("No vector store found to clear.")
         return False
     try:
-        shutil.rmtree(store_dir)
+        with get_vector_store_lock(filepath):
+            # 先释放缓存的客户端和句柄，否则 Windows 下 SQLite 文件被占用无法删除
+            invalidate_vector_store(filepath)
+            shutil.rmtree(store_dir)
         logging.info(f"Vector store directory '{store_dir}' removed.")
         return True
     except Exception as e:
@@ -46,201 +80,1309 @@ def clear_vector_store(filepath: str) -> bool:
         traceback.print_exc()
         return False
 
-def init_vector_store(embedding_adapter, texts, filepath: str):
+class _QueryEmbeddingMemo:
     """
-    在 filepath 下创建/加载一个 Chroma 向量库并插入 texts。
-    如果Embedding失败，则返回 None，不中断任务。
+    进程级的查询向量备忘录（LRU，有上限）。
+    键为 (embedding 模型标识, 归一化后的查询文本)，同一进程内重复的检索关键词
+    （例如同一单元内每章都会出现的"[单元技法] ..."）只需调用一次 embedding 接口。
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        # embedding 失败时 call_with_retry 会返回 []，不能缓存
+        if not vector:
+            return
+        with self._lock:
+            self._entries[key] = list(vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def reset_counters(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size
+            }
+
+_query_embedding_memo = _QueryEmbeddingMemo()
+
+class QueryEmbeddingStats:
+    """
+    单次调用方自己的查询向量统计（传给 embed_queries_cached 的 stats 参数）。
+    hits 为命中备忘录的查询数（节省的 embedding 调用），misses 为实际计算的查询数；
+    与进程级计数不同，不受其他线程（例如后台预构建）的检索影响。
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def add(self, hits: int, misses: int):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+def _embedding_model_key(embedding_adapter) -> str:
+    """生成 embedding 模型标识：适配器类型 + 模型名 + 接口地址"""
+    inner = getattr(embedding_adapter, "_embedding", None)
+    model_name = (
+        getattr(embedding_adapter, "model_name", None)
+        or getattr(inner, "model", None)
+        or getattr(inner, "azure_deployment", None)
+        or ""
+    )
+    base_url = (
+        getattr(embedding_adapter, "base_url", None)
+        or getattr(embedding_adapter, "url", None)
+        or getattr(inner, "openai_api_base", None)
+        or getattr(inner, "azure_endpoint", None)
+        or ""
+    )
+    return f"{type(embedding_adapter).__name__}|{model_name}|{base_url}"
+
+def _normalize_query(query: str) -> str:
+    """归一化查询文本（合并空白），使仅有空白差异的关键词共用缓存"""
+    return re.sub(r"\s+", " ", str(query)).strip()
+
+def embed_query_cached(embedding_adapter, query: str):
+    """
+    带进程级备忘录的查询向量计算。
+    失败时返回 []（与 call_with_retry 的 fallback 保持一致），失败结果不会被缓存。
+    """
+    key = (_embedding_model_key(embedding_adapter), _normalize_query(query))
+    vector = _query_embedding_memo.get(key)
+    if vector is not None:
+        return vector
+    vector = call_with_retry(
+        func=embedding_adapter.embed_query,
+        max_retries=3,
+        fallback_return=[],
+        query=query
+    )
+    _query_embedding_memo.put(key, vector)
+    return vector
+
+def embed_queries_cached(embedding_adapter, queries: list, stats: QueryEmbeddingStats = None) -> list:
+    """
+    批量计算查询向量：先查备忘录，未命中的查询合并为一次 embed_documents 调用。
+    返回与 queries 等长的列表，失败的查询对应 []。
+    传入 stats 时把本次调用的命中/计算数累加到其中。
+    """
+    model_key = _embedding_model_key(embedding_adapter)
+    keys = [(model_key, _normalize_query(q)) for q in queries]
+    vectors = [_query_embedding_memo.get(key) for key in keys]
+
+    missing = {}
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(keys[i], []).append(i)
+    if stats is not None:
+        stats.add(len(queries) - sum(len(positions) for positions in missing.values()), len(missing))
+    if missing:
+        texts = [key[1] for key in missing]
+        embedded = call_with_retry(
+            func=embedding_adapter.embed_documents,
+            max_retries=3,
+            fallback_return=[],
+            texts=texts
+        ) or []
+        if len(embedded) != len(texts):
+            embedded = [[] for _ in texts]
+        for (key, positions), vector in zip(missing.items(), embedded):
+            _query_embedding_memo.put(key, vector)
+            for i in positions:
+                vectors[i] = vector or []
+    return vectors
+
+def get_query_embedding_stats() -> dict:
+    """
+    返回查询向量备忘录的进程级计数：hits、misses、当前条目数。
+    计数包含所有线程的查询；统计某一次检索的节省情况请用 QueryEmbeddingStats。
+    """
+    return _query_embedding_memo.stats()
+
+def reset_query_embedding_stats():
+    """重置命中/未命中计数（不清空缓存条目），用于按章节统计节省次数"""
+    _query_embedding_memo.reset_counters()
+
+def _build_lc_embedding(embedding_adapter):
+    """
+    将项目内的 embedding 适配器包装为 LangChain Embeddings 接口。
+    适配器保存在实例属性上，缓存的向量库句柄可以换绑到最新的适配器实例。
     """
     try:
         from langchain_core.embeddings import Embeddings as LCEmbeddings
     except ImportError:
         from langchain.embeddings.base import Embeddings as LCEmbeddings
 
+    class LCEmbeddingWrapper(LCEmbeddings):
+        def __init__(self, adapter):
+            self.embedding_adapter = adapter
+
+        def embed_documents(self, texts):
+            return call_with_retry(
+                func=self.embedding_adapter.embed_documents,
+                max_retries=3,
+                fallback_return=[],
+                texts=texts
+            )
+        def embed_query(self, query: str):
+            return embed_query_cached(self.embedding_adapter, query)
+
+    return LCEmbeddingWrapper(embedding_adapter)
+
+class _AdapterEmbedding:
+    """NumPy 后端使用的 embedding 包装（不依赖 LangChain），接口与 LCEmbeddingWrapper 相同"""
+
+    def __init__(self, adapter):
+        self.embedding_adapter = adapter
+
+    def embed_documents(self, texts):
+        return call_with_retry(
+            func=self.embedding_adapter.embed_documents,
+            max_retries=3,
+            fallback_return=[],
+            texts=texts
+        )
+
+    def embed_query(self, query: str):
+        return embed_query_cached(self.embedding_adapter, query)
+
+# ============== 向量库后端选择 ==============
+# chroma：默认，Chroma 持久化库（SQLite + HNSW）；
+# numpy：npy_vectorstore 内存映射后端，精确检索、启动快，适合几万个分段以内的小说。
+# 新建向量库时使用默认后端（config.json 的 "vectorstore_backend"），并记录到向量库目录的 backend.json；
+# 已有向量库始终按其记录（或文件特征）使用原后端。
+VECTORSTORE_BACKENDS = ("chroma", "numpy")
+BACKEND_FILE = "backend.json"
+_default_backend = "chroma"
+
+def set_default_vector_backend(backend: str):
+    """设置新建向量库使用的后端（启动时根据 config.json 调用）"""
+    global _default_backend
+    backend = (backend or "chroma").lower()
+    if backend not in VECTORSTORE_BACKENDS:
+        logging.warning(f"未知的向量库后端 {backend}，使用 chroma")
+        backend = "chroma"
+    _default_backend = backend
+
+def get_vector_backend(filepath: str) -> str:
+    """返回小说向量库实际使用的后端"""
+    return _resolve_backend(_normalize_store_dir(filepath))
+
+def _resolve_backend(store_dir: str) -> str:
+    marker = os.path.join(store_dir, BACKEND_FILE)
+    if os.path.exists(marker):
+        try:
+            with open(marker, "r", encoding="utf-8") as f:
+                backend = json.load(f).get("backend")
+            if backend in VECTORSTORE_BACKENDS:
+                return backend
+        except (OSError, ValueError) as e:
+            logging.warning(f"读取向量库后端记录失败: {e}")
+    if os.path.exists(os.path.join(store_dir, "chroma.sqlite3")):
+        backend = "chroma"
+    elif any(os.path.exists(os.path.join(store_dir, f"{name}.json"))
+             for name in (CHAPTER_COLLECTION, KNOWLEDGE_COLLECTION, LEGACY_COLLECTION_NAME)):
+        backend = "numpy"
+    else:
+        backend = _default_backend
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+        with open(marker, "w", encoding="utf-8") as f:
+            json.dump({"backend": backend}, f)
+    except OSError as e:
+        logging.warning(f"记录向量库后端失败: {e}")
+    return backend
+
+# ============== 进程级向量库句柄注册表 ==============
+# 每个持久化目录只创建一个 Chroma 客户端；每个 (目录, embedding 模型标识, 集合名) 只创建一个向量库句柄。
+# 写操作通过 get_vector_store_lock 按目录串行化；清空向量库前必须调用 invalidate_vector_store 释放句柄。
+#
+# 每本小说的向量库分为两个集合：章节历史（定稿章节的分段）与知识库（导入的写作知识），
+# 两者分别检索、各自设定检索条数，章节历史还可以只保留最近若干章。
+
+CHAPTER_COLLECTION = "chapter_history"
+KNOWLEDGE_COLLECTION = "knowledge_base"
+LEGACY_COLLECTION_NAME = "novel_collection"  # 旧版本所有数据共用的集合，打开时自动拆分迁移
+
+_registry_lock = threading.RLock()
+_chroma_clients = {}
+_store_handles = {}
+_store_write_locks = {}
+
+def _normalize_store_dir(filepath: str) -> str:
+    return os.path.normcase(os.path.abspath(get_vectorstore_dir(filepath)))
+
+def get_vector_store_lock(filepath: str) -> threading.RLock:
+    """返回指定小说向量库的写锁（同一目录的所有写操作共用一把锁）"""
+    store_dir = _normalize_store_dir(filepath)
+    with _registry_lock:
+        lock = _store_write_locks.get(store_dir)
+        if lock is None:
+            lock = threading.RLock()
+            _store_write_locks[store_dir] = lock
+        return lock
+
+def _get_chroma_client(store_dir: str):
+    """获取（或创建）目录对应的 Chroma 持久化客户端单例"""
+    with _registry_lock:
+        client = _chroma_clients.get(store_dir)
+        if client is None:
+            import chromadb
+            from chromadb.config import Settings
+            client = chromadb.PersistentClient(
+                path=store_dir,
+                settings=Settings(anonymized_telemetry=False)
+            )
+            _chroma_clients[store_dir] = client
+        return client
+
+def _close_chroma_client(client):
+    """尽力释放客户端持有的系统资源（SQLite 连接、文件句柄等）"""
+    try:
+        if hasattr(client, "clear_system_cache"):
+            client.clear_system_cache()
+        system = getattr(client, "_system", None)
+        if system is not None and hasattr(system, "stop"):
+            system.stop()
+    except Exception as e:
+        logging.debug(f"Close chroma client failed: {e}")
+
+def _close_store(store):
+    """释放 NumPy 后端的内存映射（Chroma 句柄的资源随客户端一起释放）"""
+    close = getattr(store._collection, "close", None)
+    if isinstance(store, NpyVectorStore) and close is not None:
+        close()
+
+def _get_store_handle(embedding_adapter, store_dir: str, collection_name: str):
+    """从注册表获取向量库句柄；已缓存时换绑为本次传入的 embedding 适配器"""
+    key = (store_dir, _embedding_model_key(embedding_adapter), collection_name)
+    with _registry_lock:
+        store = _store_handles.get(key)
+        if store is not None:
+            store.embeddings.embedding_adapter = embedding_adapter
+            return store
+        if _resolve_backend(store_dir) == "numpy":
+            store = NpyVectorStore(store_dir, collection_name, _AdapterEmbedding(embedding_adapter))
+        else:
+            from langchain_chroma import Chroma
+            store = Chroma(
+                client=_get_chroma_client(store_dir),
+                collection_name=collection_name,
+                embedding_function=_build_lc_embedding(embedding_adapter)
+            )
+        _store_handles[key] = store
+    # 新建句柄时顺带检查一次旧数据的来源元数据
+    try:
+        _tag_untagged_documents(store._collection)
+    except Exception as e:
+        logging.warning(f"Failed to tag legacy vector store documents: {e}")
+    return store
+
+def invalidate_vector_store(filepath: str):
+    """丢弃指定小说向量库的所有缓存句柄并关闭其客户端（清空/替换向量库目录前调用）"""
+    store_dir = _normalize_store_dir(filepath)
+    with _registry_lock:
+        stores = [_store_handles.pop(key) for key in [k for k in _store_handles if k[0] == store_dir]]
+        client = _chroma_clients.pop(store_dir, None)
+    for store in stores:
+        _close_store(store)
+    discard_sparse_index(store_dir)
+    if client is not None:
+        _close_chroma_client(client)
+
+def close_all_vector_stores():
+    """关闭所有缓存的向量库客户端（进程退出时自动调用）"""
+    with _registry_lock:
+        clients = list(_chroma_clients.values())
+        stores = list(_store_handles.values())
+        _chroma_clients.clear()
+        _store_handles.clear()
+    for store in stores:
+        _close_store(store)
+    for client in clients:
+        _close_chroma_client(client)
+
+atexit.register(close_all_vector_stores)
+
+def init_vector_store(embedding_adapter, texts, filepath: str, collection_name: str = CHAPTER_COLLECTION):
+    """
+    在 filepath 下创建/加载向量库（Chroma 或 NumPy 后端，见 get_vector_backend）的指定集合并插入 texts。
+    如果Embedding失败，则返回 None，不中断任务。
+    """
     store_dir = get_vectorstore_dir(filepath)
     os.makedirs(store_dir, exist_ok=True)
     documents = [Document(page_content=str(t)) for t in texts]
 
     try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        vectorstore = Chroma.from_documents(
-            documents,
-            embedding=chroma_embedding,
-            persist_directory=store_dir,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
-        )
+        with get_vector_store_lock(filepath):
+            _migrate_legacy_collection(embedding_adapter, filepath)
+            vectorstore = _get_store_handle(embedding_adapter, _normalize_store_dir(filepath), collection_name)
+            if documents:
+                ids = vectorstore.add_documents(documents)
+                index_sparse_documents(vectorstore, filepath, ids, [doc.page_content for doc in documents])
         return vectorstore
     except Exception as e:
         logging.warning(f"Init vector store failed: {e}")
         traceback.print_exc()
         return None
 
-def load_vector_store(embedding_adapter, filepath: str):
+def load_vector_store(embedding_adapter, filepath: str, collection_name: str = CHAPTER_COLLECTION):
     """
-    读取已存在的 Chroma 向量库。若不存在则返回 None。
+    读取已存在的向量库中的指定集合（CHAPTER_COLLECTION / KNOWLEDGE_COLLECTION）。若向量库不存在则返回 None。
     如果加载失败（embedding 或IO问题），则返回 None。
+    同一进程内重复调用返回同一个缓存句柄，不会重新打开持久化目录。
     """
-    try:
-        from langchain_core.embeddings import Embeddings as LCEmbeddings
-    except ImportError:
-        from langchain.embeddings.base import Embeddings as LCEmbeddings
     store_dir = get_vectorstore_dir(filepath)
     if not os.path.exists(store_dir):
         logging.info("Vector store not found. Will return None.")
         return None
 
     try:
-        class LCEmbeddingWrapper(LCEmbeddings):
-            def embed_documents(self, texts):
-                return call_with_retry(
-                    func=embedding_adapter.embed_documents,
-                    max_retries=3,
-                    fallback_return=[],
-                    texts=texts
-                )
-            def embed_query(self, query: str):
-                res = call_with_retry(
-                    func=embedding_adapter.embed_query,
-                    max_retries=3,
-                    fallback_return=[],
-                    query=query
-                )
-                return res
-
-        chroma_embedding = LCEmbeddingWrapper()
-        return Chroma(
-            persist_directory=store_dir,
-            embedding_function=chroma_embedding,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_name="novel_collection"
-        )
+        _migrate_legacy_collection(embedding_adapter, filepath)
+        return _get_store_handle(embedding_adapter, _normalize_store_dir(filepath), collection_name)
     except Exception as e:
         logging.warning(f"Failed to load vector store: {e}")
         traceback.print_exc()
         return None
 
-def split_by_length(text: str, max_length: int = 500):
-    """按照 max_length 切分文本"""
-    segments = []
-    start_idx = 0
-    while start_idx < len(text):
-        end_idx = min(start_idx + max_length, len(text))
-        segment = text[start_idx:end_idx]
-        segments.append(segment.strip())
-        start_idx = end_idx
-    return segments
+_migrated_dirs = set()
+
+def _open_legacy_collection(store_dir: str):
+    """打开旧版的单一集合；不存在时返回 None（不会创建）"""
+    if _resolve_backend(store_dir) == "numpy":
+        if not os.path.exists(os.path.join(store_dir, f"{LEGACY_COLLECTION_NAME}.json")):
+            return None
+        return NpyCollection(store_dir, LEGACY_COLLECTION_NAME)
+    client = _get_chroma_client(store_dir)
+    try:
+        return client.get_collection(LEGACY_COLLECTION_NAME)
+    except Exception:
+        return None
+
+def _migrate_legacy_collection(embedding_adapter, filepath: str, page_size: int = 500):
+    """
+    把旧版单一集合中的数据按来源移入章节历史 / 知识库两个集合。
+    直接搬运已有向量，不重新 embedding；按批"先写入新集合、再从旧集合删除"，中断后可继续。
+    每个目录每个进程只检查一次。
+    """
+    store_dir = _normalize_store_dir(filepath)
+    if store_dir in _migrated_dirs:
+        return
+    with get_vector_store_lock(filepath):
+        if store_dir in _migrated_dirs:
+            return
+        legacy = _open_legacy_collection(store_dir)
+        if legacy is not None and legacy.count() > 0:
+            targets = {
+                name: _get_store_handle(embedding_adapter, store_dir, name)
+                for name in (CHAPTER_COLLECTION, KNOWLEDGE_COLLECTION)
+            }
+            moved = 0
+            while True:
+                page = legacy.get(include=["embeddings", "documents", "metadatas"], limit=page_size)
+                ids = page.get("ids", [])
+                if not ids:
+                    break
+                metadatas = page.get("metadatas") or [None] * len(ids)
+                groups = {}
+                for doc_id, embedding, text, metadata in zip(ids, page["embeddings"], page["documents"], metadatas):
+                    if not metadata or not metadata.get("source_type"):
+                        metadata = _infer_legacy_metadata(doc_id, metadata)
+                    name = KNOWLEDGE_COLLECTION if metadata["source_type"] == SOURCE_KNOWLEDGE else CHAPTER_COLLECTION
+                    groups.setdefault(name, []).append((doc_id, embedding, text, metadata))
+                for name, rows in groups.items():
+                    targets[name]._collection.add(
+                        ids=[row[0] for row in rows],
+                        embeddings=[np.asarray(row[1], dtype=np.float32).tolist() for row in rows],
+                        documents=[row[2] for row in rows],
+                        metadatas=[row[3] for row in rows]
+                    )
+                    index_sparse_documents(targets[name], filepath, [row[0] for row in rows], [row[2] for row in rows])
+                legacy.delete(ids=ids)
+                moved += len(ids)
+            logging.info(f"旧版向量库已拆分为章节历史与知识库两个集合，共迁移{moved}条")
+        if legacy is not None:
+            _drop_legacy_collection(store_dir, legacy)
+        _migrated_dirs.add(store_dir)
+
+def _drop_legacy_collection(store_dir: str, legacy):
+    """迁移完成后删除旧集合及旧版的共用稀疏索引文件"""
+    try:
+        if isinstance(legacy, NpyCollection):
+            legacy.close()
+            for name in os.listdir(store_dir):
+                if name.startswith(f"{LEGACY_COLLECTION_NAME}."):
+                    os.remove(os.path.join(store_dir, name))
+        else:
+            _get_chroma_client(store_dir).delete_collection(LEGACY_COLLECTION_NAME)
+        old_sparse = os.path.join(store_dir, "sparse_index.db")
+        if os.path.exists(old_sparse):
+            os.remove(old_sparse)
+    except Exception as e:
+        logging.warning(f"Failed to drop legacy collection: {e}")
+
+# ============== 内置中文分句/分块（无需下载 punkt 模型） ==============
+
+_SENTENCE_END_CHARS = set("。！？!?；;…")
+_OPEN_QUOTES = {"“": "”", "「": "」", "『": "』", "‘": "’", "《": "》", "（": "）", "(": ")"}
+_CLOSE_QUOTES = set(_OPEN_QUOTES.values())
+_TRAILING_CLOSERS = _CLOSE_QUOTES | set("\"'】")
+_CJK_CHAR_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_LATIN_WORD_RE = re.compile(r"[A-Za-z0-9_]+(?:['’.-][A-Za-z0-9_]+)*")
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数：CJK 字符及全角标点按 1 个 token 计，
+    拉丁单词/数字按约 1.3 个 token 计。无需加载任何分词模型。
+    """
+    if not text:
+        return 0
+    cjk_count = len(_CJK_CHAR_RE.findall(text))
+    word_count = len(_LATIN_WORD_RE.findall(text))
+    return cjk_count + (word_count * 13 + 9) // 10
 
-def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similarity_threshold: float = 0.7):
+def split_sentences(text: str) -> list:
+    """
+    基于状态机的中英文分句：
+    1. 在 。！？!?；;… 处断句，连续的结束符（如"？！"、"……"）归入同一句；
+    2. 句末紧跟的右引号/右括号归入当前句；
+    3. 对白引号（“”「」『』）内部的结束符不断句，直到引号闭合；
+    4. 英文句点仅在其后为空白或文本结尾时断句（避免 3.14、e.g 之类被切开）；
+    5. 换行（段落边界）总是断句。
+    """
+    if not text:
+        return []
+
+    sentences = []
+    buf = []
+    quote_stack = []
+    length = len(text)
+    i = 0
+
+    def flush():
+        sentence = "".join(buf).strip()
+        if sentence:
+            sentences.append(sentence)
+        buf.clear()
+
+    while i < length:
+        ch = text[i]
+
+        if ch in "\r\n":
+            flush()
+            quote_stack.clear()
+            i += 1
+            continue
+
+        buf.append(ch)
+
+        if ch in _OPEN_QUOTES:
+            quote_stack.append(_OPEN_QUOTES[ch])
+            i += 1
+            continue
+        if quote_stack and ch == quote_stack[-1]:
+            quote_stack.pop()
+            i += 1
+            continue
+
+        is_end = ch in _SENTENCE_END_CHARS
+        if ch == "." and (i + 1 >= length or text[i + 1].isspace()):
+            is_end = True
+
+        if is_end:
+            # 吞并连续的结束符
+            j = i + 1
+            while j < length and (text[j] in _SENTENCE_END_CHARS or text[j] == "."):
+                buf.append(text[j])
+                j += 1
+            # 吞并句末的右引号/右括号，并同步引号状态
+            while j < length and text[j] in _TRAILING_CLOSERS:
+                if quote_stack and text[j] == quote_stack[-1]:
+                    quote_stack.pop()
+                elif text[j] in _CLOSE_QUOTES:
+                    break
+                buf.append(text[j])
+                j += 1
+            if not quote_stack:
+                flush()
+            i = j
+            continue
+
+        i += 1
+
+    flush()
+    return sentences
+
+def _join_sentences(sentences: list) -> str:
+    """拼接句子：CJK 之间直接相连，拉丁文本之间补一个空格"""
+    parts = []
+    for sentence in sentences:
+        if parts and not _CJK_CHAR_RE.match(parts[-1][-1]) and not _CJK_CHAR_RE.match(sentence[0]):
+            parts.append(" ")
+        parts.append(sentence)
+    return "".join(parts)
+
+def _overlap_tail(sentences: list, overlap_tokens: int) -> list:
+    """取分块末尾不超过 overlap_tokens 的若干整句，作为下一分块的开头"""
+    carried = []
+    carried_tokens = 0
+    for sentence in reversed(sentences):
+        sentence_tokens = estimate_tokens(sentence)
+        if carried_tokens + sentence_tokens > overlap_tokens:
+            break
+        carried.insert(0, sentence)
+        carried_tokens += sentence_tokens
+    return carried
+
+def chunk_sentences(sentences: list, max_tokens: int = 500, overlap_tokens: int = 0) -> list:
+    """
+    将句子按 token 预算拼成分块。
+    overlap_tokens > 0 时，新分块以前一分块末尾不超过 overlap_tokens 的若干整句开头。
+    超过 max_tokens 的单句按字符硬切。
+    """
+    max_tokens = max(1, int(max_tokens))
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    has_new_content = False
+
+    for sentence in sentences:
+        sentence_tokens = estimate_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            if has_new_content:
+                chunks.append(_join_sentences(current))
+            current, current_tokens, has_new_content = [], 0, False
+            chunks.extend(piece for piece in split_by_length(sentence, max_tokens) if piece)
+            continue
+
+        if has_new_content and current_tokens + sentence_tokens > max_tokens:
+            chunks.append(_join_sentences(current))
+            current = _overlap_tail(current, overlap_tokens) if overlap_tokens else []
+            current_tokens = sum(estimate_tokens(c) for c in current)
+            if current_tokens + sentence_tokens > max_tokens:
+                current, current_tokens = [], 0
+            has_new_content = False
+
+        current.append(sentence)
+        current_tokens += sentence_tokens
+        has_new_content = True
+
+    if has_new_content:
+        chunks.append(_join_sentences(current))
+    return chunks
+
+def semantic_chunk_sentences(sentences: list, embedding_adapter, similarity_threshold: float = 0.7,
+                             max_tokens: int = 500, min_tokens: int = None, overlap_tokens: int = 0) -> list:
+    """
+    语义边界分块：一次批量 embedding 所有句子，向量化计算相邻句子的余弦相似度，
+    相似度 >= similarity_threshold 的相邻句子合并到同一分块，且每块不超过 max_tokens。
+    不足 min_tokens（默认 max_tokens 的 1/4）的分块无论相似度都继续合并，避免产生碎片。
+    overlap_tokens > 0 时，新分块以前一分块末尾不超过 overlap_tokens 的若干整句开头（与 chunk_sentences 相同）。
+    embedding 失败或维度异常时退回按长度分块。
+    """
+    if len(sentences) < 2:
+        return chunk_sentences(sentences, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    if min_tokens is None:
+        min_tokens = max_tokens // 4
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+
+    vectors = call_with_retry(
+        func=embedding_adapter.embed_documents,
+        max_retries=3,
+        fallback_return=[],
+        texts=sentences
+    )
+    if not vectors or len(vectors) != len(sentences) or any(not v for v in vectors) \
+            or len({len(v) for v in vectors}) != 1:
+        logging.warning("Sentence embedding failed or returned invalid vectors, fallback to length-based split.")
+        return chunk_sentences(sentences, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    # similarities[i] 为第 i 句与第 i+1 句的余弦相似度
+    similarities = 1.0 - paired_cosine_distances(matrix[:-1], matrix[1:])
+    token_counts = [estimate_tokens(sentence) for sentence in sentences]
+
+    chunks = []
+    current = [sentences[0]]
+    current_tokens = token_counts[0]
+    for i in range(1, len(sentences)):
+        sentence_tokens = token_counts[i]
+        over_budget = current_tokens + sentence_tokens > max_tokens
+        topic_shift = similarities[i - 1] < similarity_threshold and current_tokens >= min_tokens
+        if over_budget or topic_shift:
+            chunks.extend(chunk_sentences(current, max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+            current = _overlap_tail(current, overlap_tokens) if overlap_tokens else []
+            current_tokens = sum(estimate_tokens(c) for c in current)
+            if current_tokens + sentence_tokens > max_tokens:
+                current, current_tokens = [], 0
+        current.append(sentences[i])
+        current_tokens += sentence_tokens
+    if current:
+        chunks.extend(chunk_sentences(current, max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+    return chunks
+
+def split_text_for_vectorstore(chapter_text: str, max_length: int = 500, similarity_threshold: float = 0.7,
+                               overlap_tokens: int = 0, embedding_adapter=None):
     """
     对新的章节文本进行分段后,再用于存入向量库。
-    使用 embedding 进行文本相似度计算。
+    使用内置的中文分句器，max_length 为每段的 token 预算，overlap_tokens 为相邻分段的重叠 token 数。
+    传入 embedding_adapter 时使用 embedding 进行相邻句子相似度计算，按语义边界合并（similarity_threshold）；
+    这需要对每一句调用 embedding，只应在显式开启时传入（见 novel_settings.json 的 semantic_chunking）。
     """
-    if not chapter_text.strip():
+    if not chapter_text or not chapter_text.strip():
         return []
-    
-    nltk.download('punkt', quiet=True)
-    nltk.download('punkt_tab', quiet=True)
-    sentences = nltk.sent_tokenize(chapter_text)
+
+    sentences = split_sentences(chapter_text)
     if not sentences:
         return []
-    
-    # 直接按长度分段,不做相似度合并
-    final_segments = []
-    current_segment = []
-    current_length = 0
-    
-    for sentence in sentences:
-        sentence_length = len(sentence)
-        if current_length + sentence_length > max_length:
-            if current_segment:
-                final_segments.append(" ".join(current_segment))
-            current_segment = [sentence]
-            current_length = sentence_length
+
+    if embedding_adapter is not None:
+        return semantic_chunk_sentences(
+            sentences,
+            embedding_adapter,
+            similarity_threshold=similarity_threshold,
+            max_tokens=max_length,
+            overlap_tokens=overlap_tokens
+        )
+    return chunk_sentences(sentences, max_tokens=max_length, overlap_tokens=overlap_tokens)
+
+def content_hash(text: str) -> str:
+    """分段内容哈希（忽略空白差异），用于生成稳定的文档ID"""
+    normalized = re.sub(r"\s+", " ", str(text)).strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+def _novel_key(filepath: str) -> str:
+    """小说标识：取小说目录名的短哈希，作为章节分段ID的前缀"""
+    name = os.path.basename(os.path.normpath(os.path.abspath(filepath)))
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+
+def make_chapter_chunk_id(filepath: str, chapter_number: int, segment_index: int, text: str) -> str:
+    """章节分段的确定性ID：小说标识 + 章节号 + 分段序号 + 内容哈希"""
+    return f"ch_{_novel_key(filepath)}_{int(chapter_number)}_{segment_index}_{content_hash(text)[:16]}"
+
+# ============== 稀疏索引（BM25）同步 ==============
+def _sparse_index_for(store, filepath: str):
+    """向量库集合对应的稀疏索引（每个集合一个）"""
+    return get_sparse_index(_normalize_store_dir(filepath), store._collection.name)
+
+def index_sparse_documents(store, filepath: str, ids: list, texts: list):
+    """把新写入向量库集合的文档同步写入该集合的稀疏索引；失败只记录日志，不影响向量库写入"""
+    try:
+        _sparse_index_for(store, filepath).add(list(ids), list(texts))
+    except Exception as e:
+        logging.warning(f"Failed to update sparse index: {e}")
+    bump_vector_store_version(filepath)
+
+def remove_sparse_documents(store, filepath: str, ids: list):
+    """从稀疏索引中删除已从向量库集合删除的文档"""
+    try:
+        _sparse_index_for(store, filepath).remove(list(ids))
+    except Exception as e:
+        logging.warning(f"Failed to update sparse index: {e}")
+    bump_vector_store_version(filepath)
+
+def sync_sparse_index(store, filepath: str, page_size: int = 1000) -> int:
+    """
+    使稀疏索引与向量库集合保持一致：补录缺失的文档、删除已不存在的文档。
+    两者文档数一致时视为已同步，只做一次计数比较；用于旧向量库首次启用混合检索时的回填。
+    返回补录+删除的文档数。
+    """
+    index = _sparse_index_for(store, filepath)
+    collection = store._collection
+    if index.count() == collection.count():
+        return 0
+    with get_vector_store_lock(filepath):
+        indexed = index.doc_ids()
+        present = set()
+        offset = 0
+        added = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            ids = page.get("ids", [])
+            if not ids:
+                break
+            present.update(ids)
+            missing = [(doc_id, text) for doc_id, text in zip(ids, page.get("documents") or []) if doc_id not in indexed]
+            if missing:
+                index.add([doc_id for doc_id, _ in missing], [text or "" for _, text in missing])
+                added += len(missing)
+            offset += len(ids)
+        orphaned = list(indexed - present)
+        index.remove(orphaned)
+    if added or orphaned:
+        logging.info(f"稀疏索引已同步：补录{added}条，删除{len(orphaned)}条")
+    return added + len(orphaned)
+
+# ============== 分段元数据 ==============
+SOURCE_CHAPTER = "chapter"
+SOURCE_KNOWLEDGE = "knowledge"
+SOURCE_LEGACY = "legacy"  # 无法判断来源的旧数据（未带元数据写入的 seg_* 等）
+_CHAPTER_ID_RE = re.compile(r"^ch_[0-9a-f]{8}_(\d+)_(\d+)_")
+
+def find_mentioned_characters(text: str, character_names) -> list:
+    """返回 character_names 中在 text 里出现过的角色名（保持传入顺序，去重）"""
+    if not text or not character_names:
+        return []
+    mentioned = []
+    for name in character_names:
+        name = str(name).strip()
+        if name and name not in mentioned and name in text:
+            mentioned.append(name)
+    return mentioned
+
+def chapter_chunk_metadata(chapter_number: int, segment_index: int, text: str,
+                           unit_number: int = None, character_names=None) -> dict:
+    """
+    章节分段的元数据。Chroma 元数据只接受标量，出场角色以"、"拼接为字符串；
+    缺失的字段直接省略（Chroma 不接受 None）。
+    """
+    metadata = {
+        "source_type": SOURCE_CHAPTER,
+        "chapter_number": int(chapter_number),
+        "segment_index": int(segment_index),
+    }
+    if unit_number is not None:
+        metadata["unit_number"] = int(unit_number)
+    characters = find_mentioned_characters(text, character_names)
+    if characters:
+        metadata["characters"] = "、".join(characters)
+    return metadata
+
+def _infer_legacy_metadata(doc_id: str, metadata: dict) -> dict:
+    """为未带 source_type 的旧文档推断元数据：ch_* 由ID解析章节号，kb_* 为知识库，其余标为 legacy"""
+    inferred = dict(metadata or {})
+    match = _CHAPTER_ID_RE.match(doc_id or "")
+    if "chapter_number" in inferred or match:
+        inferred["source_type"] = SOURCE_CHAPTER
+        if match:
+            inferred.setdefault("chapter_number", int(match.group(1)))
+            inferred.setdefault("segment_index", int(match.group(2)))
+    elif (doc_id or "").startswith("kb_"):
+        inferred["source_type"] = SOURCE_KNOWLEDGE
+    else:
+        inferred["source_type"] = SOURCE_LEGACY
+    return inferred
+
+def _tag_untagged_documents(collection, page_size: int = 1000):
+    """
+    一次性迁移：给缺少 source_type 的旧文档补上元数据，使按元数据过滤的检索不会把它们漏掉。
+    只更新元数据，不重新 embedding；已全部带标签时只多一次计数查询。
+    """
+    total = collection.count()
+    if total == 0:
+        return 0
+    already_tagged = collection.get(
+        where={"source_type": {"$in": [SOURCE_CHAPTER, SOURCE_KNOWLEDGE, SOURCE_LEGACY]}},
+        include=[]
+    )
+    if len(already_tagged.get("ids", [])) >= total:
+        return 0
+
+    tagged = 0
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        ids = page.get("ids", [])
+        if not ids:
+            break
+        metadatas = page.get("metadatas") or [None] * len(ids)
+        update_ids, update_metadatas = [], []
+        for doc_id, metadata in zip(ids, metadatas):
+            if metadata and metadata.get("source_type"):
+                continue
+            update_ids.append(doc_id)
+            update_metadatas.append(_infer_legacy_metadata(doc_id, metadata))
+        if update_ids:
+            collection.update(ids=update_ids, metadatas=update_metadatas)
+            tagged += len(update_ids)
+        offset += len(ids)
+    if tagged:
+        logging.info(f"已为{tagged}条旧向量数据补充来源元数据")
+    return tagged
+
+def build_retrieval_filter(current_chapter: int = None, exclude_recent: int = 0,
+                           include_chapters: bool = True, include_knowledge: bool = True,
+                           knowledge_categories=None, include_legacy: bool = True):
+    """
+    构造下推到 Chroma 的 where 条件。
+    - current_chapter + exclude_recent：只检索第 current_chapter-exclude_recent 章之前的章节分段
+      （例如 exclude_recent=3 即排除最近三章，它们的原文已通过前文摘要进入提示词）；
+    - knowledge_categories：只检索这些分类的知识库条目；
+    - include_legacy：是否保留无法判断来源的旧数据（交由正则规则兜底处理）。
+    无任何限制时返回 None。
+    """
+    clauses = []
+    if include_chapters:
+        if current_chapter is not None and exclude_recent > 0:
+            clauses.append({"$and": [
+                {"source_type": SOURCE_CHAPTER},
+                {"chapter_number": {"$lt": int(current_chapter) - int(exclude_recent)}}
+            ]})
+        else:
+            clauses.append({"source_type": SOURCE_CHAPTER})
+    if include_knowledge:
+        categories = [c for c in (knowledge_categories or []) if c]
+        if categories:
+            clauses.append({"$and": [
+                {"source_type": SOURCE_KNOWLEDGE},
+                {"category": {"$in": list(categories)}}
+            ]})
         else:
-            current_segment.append(sentence)
-            current_length += sentence_length
-    
-    if current_segment:
-        final_segments.append(" ".join(current_segment))
-    
-    return final_segments
+            clauses.append({"source_type": SOURCE_KNOWLEDGE})
+    if include_legacy:
+        clauses.append({"source_type": SOURCE_LEGACY})
+
+    unrestricted = (include_chapters and include_knowledge and include_legacy
+                    and not (current_chapter is not None and exclude_recent > 0)
+                    and not knowledge_categories)
+    if unrestricted:
+        return None
+    if not clauses:
+        return {"source_type": "__none__"}
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+def _upsert_chapter_segments(store, filepath: str, chapter_number: int, segments: list,
+                             unit_number: int = None, character_names=None, extra_metadata: dict = None) -> dict:
+    """
+    幂等地写入某一章的分段：
+    - 该章已存在、且ID相同（序号与内容均未变）的分段不重新 embedding，只刷新元数据；
+    - 该章已存在、但不在本次分段中的旧分段被删除；
+    - 只有新增/变化的分段会被 embedding 并写入。
+    返回 {"added": 新写入数, "removed": 删除数, "unchanged": 保留数}
+    """
+    ids = [make_chapter_chunk_id(filepath, chapter_number, i, seg) for i, seg in enumerate(segments)]
+    metadatas = [
+        dict(chapter_chunk_metadata(chapter_number, i, seg, unit_number=unit_number, character_names=character_names),
+             **(extra_metadata or {}))
+        for i, seg in enumerate(segments)
+    ]
+    collection = store._collection
+    with get_vector_store_lock(filepath):
+        existing = set(collection.get(where={"chapter_number": int(chapter_number)}, include=[]).get("ids", []))
+        stale = [doc_id for doc_id in existing if doc_id not in set(ids)]
+        if stale:
+            collection.delete(ids=stale)
+            remove_sparse_documents(store, filepath, stale)
+        new_positions = [i for i, doc_id in enumerate(ids) if doc_id not in existing]
+        kept_positions = [i for i, doc_id in enumerate(ids) if doc_id in existing]
+        if kept_positions:
+            collection.update(
+                ids=[ids[i] for i in kept_positions],
+                metadatas=[metadatas[i] for i in kept_positions]
+            )
+            bump_vector_store_version(filepath)
+        if new_positions:
+            store.add_texts(
+                [segments[i] for i in new_positions],
+                metadatas=[metadatas[i] for i in new_positions],
+                ids=[ids[i] for i in new_positions]
+            )
+            index_sparse_documents(store, filepath, [ids[i] for i in new_positions], [segments[i] for i in new_positions])
+    return {
+        "added": len(new_positions),
+        "removed": len(stale),
+        "unchanged": len(ids) - len(new_positions)
+    }
+
+def apply_chapter_history_window(store, filepath: str, current_chapter: int, window: int) -> int:
+    """
+    章节历史保留策略：只保留最近 window 章（含当前章）的原文分段。
+    更早的章节若有定稿时保存的单章摘要，则以摘要替换原文（每章一个分段，仍可被检索到）；
+    没有摘要的章节直接从集合与稀疏索引中删除。
+    window <= 0 表示全部保留。返回移除的原文分段数。
+    """
+    if not window or window <= 0 or current_chapter is None:
+        return 0
+    from novel_generator.chapter_summaries import load_chapter_summaries
+    cutoff = int(current_chapter) - int(window) + 1
+    collection = store._collection
+    with get_vector_store_lock(filepath):
+        expired = collection.get(
+            where={"$and": [{"source_type": SOURCE_CHAPTER}, {"chapter_number": {"$lt": cutoff}}]},
+            include=["metadatas"]
+        )
+        # 已替换为摘要的章节不再处理
+        expired_by_chapter = {}
+        for doc_id, metadata in zip(expired.get("ids", []), expired.get("metadatas") or []):
+            if metadata and not metadata.get("is_summary"):
+                expired_by_chapter.setdefault(metadata["chapter_number"], (metadata, []))[1].append(doc_id)
+        summaries = load_chapter_summaries(filepath) if expired_by_chapter else {}
+        removed = 0
+        for chapter_number, (metadata, ids) in expired_by_chapter.items():
+            entry = summaries.get(chapter_number)
+            if entry and entry.get("summary"):
+                result = _upsert_chapter_segments(
+                    store, filepath, chapter_number, [entry["summary"]],
+                    unit_number=metadata.get("unit_number"),
+                    character_names=[name for name in metadata.get("characters", "").split("、") if name],
+                    extra_metadata={"is_summary": True}
+                )
+                removed += result["removed"]
+            else:
+                collection.delete(ids=ids)
+                remove_sparse_documents(store, filepath, ids)
+                removed += len(ids)
+    if removed:
+        logging.info(f"章节历史只保留最近{window}章原文，第{cutoff}章之前已移除{removed}个原文分段（有摘要的章节保留摘要）")
+    return removed
 
-def update_vector_store(embedding_adapter, new_chapter: str, filepath: str):
+def update_vector_store(embedding_adapter, new_chapter: str, filepath: str, chapter_number: int = None,
+                        unit_number: int = None, character_names=None, history_window: int = 0,
+                        semantic_chunking: bool = False):
     """
     将最新章节文本插入到向量库中。
     若库不存在则初始化；若初始化/更新失败，则跳过。
-    返回值：成功时返回更新的数据条数，失败时返回0
+    指定 chapter_number 时按章节幂等更新（重复定稿同一章只替换变化的分段，不会留下旧版本），
+    并为每个分段写入来源、章节号、单元号及该分段中出现的角色（取自 character_names）等元数据；
+    未指定时按内容哈希追加（相同内容不会重复写入）。
+    章节写入章节历史集合；history_window > 0 时随后清理该窗口之外的旧章节分段。
+    semantic_chunking=True 时按语义边界分段（逐句 embedding），默认按长度分段。
+    返回值：成功时返回该章当前在库中的分段数，失败时返回0
     """
-    from utils import read_file, clear_file_content, save_string_to_txt
-    splitted_texts = split_text_for_vectorstore(new_chapter)
+    # 默认按长度分段：重复定稿同一章时只有内容变化的分段需要 embedding；
+    # semantic_chunking=True 时按语义边界分段，每次都要对全章逐句 embedding
+    splitted_texts = [
+        t for t in split_text_for_vectorstore(
+            new_chapter, embedding_adapter=embedding_adapter if semantic_chunking else None
+        ) if t.strip()
+    ]
     if not splitted_texts:
         logging.warning("No valid text to insert into vector store. Skipping.")
         return 0
 
     logging.info(f"📝 章节文本已分段，共{len(splitted_texts)}段")
-    
+
     store = load_vector_store(embedding_adapter, filepath)
     if not store:
         logging.info("Vector store does not exist or failed to load. Initializing a new one for new chapter...")
-        store = init_vector_store(embedding_adapter, splitted_texts, filepath)
+        store = init_vector_store(embedding_adapter, [], filepath)
         if not store:
             logging.warning("Init vector store failed, skip embedding.")
             return 0
-        else:
-            logging.info(f"✓ 新向量库创建成功，共插入{len(splitted_texts)}条数据")
-            return len(splitted_texts)
 
     try:
-        docs = [Document(page_content=str(t)) for t in splitted_texts]
-        store.add_documents(docs)
-        logging.info(f"✓ 向量库更新成功，本次更新{len(docs)}条数据")
-        return len(docs)
+        if chapter_number is not None:
+            result = _upsert_chapter_segments(
+                store, filepath, chapter_number, splitted_texts,
+                unit_number=unit_number, character_names=character_names
+            )
+            logging.info(
+                f"✓ 向量库更新成功（第{chapter_number}章）：新增/变化{result['added']}段，"
+                f"删除旧分段{result['removed']}段，未变化{result['unchanged']}段"
+            )
+            apply_chapter_history_window(store, filepath, chapter_number, history_window)
+            return len(splitted_texts)
+
+        ids = [f"seg_{content_hash(t)}" for t in splitted_texts]
+        unique = dict(zip(ids, splitted_texts))
+        with get_vector_store_lock(filepath):
+            existing = set(store._collection.get(ids=list(unique), include=[]).get("ids", []))
+            new_ids = [doc_id for doc_id in unique if doc_id not in existing]
+            if new_ids:
+                store.add_texts(
+                    [unique[doc_id] for doc_id in new_ids],
+                    metadatas=[{"source_type": SOURCE_LEGACY} for _ in new_ids],
+                    ids=new_ids
+                )
+                index_sparse_documents(store, filepath, new_ids, [unique[doc_id] for doc_id in new_ids])
+        logging.info(f"✓ 向量库更新成功，本次更新{len(new_ids)}条数据")
+        return len(splitted_texts)
     except Exception as e:
         logging.warning(f"Failed to update vector store: {e}")
         traceback.print_exc()
         return 0
 
-def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepath: str, k: int = 2) -> str:
+def _distance_to_score(distance: float, space: str) -> float:
+    """将 Chroma 返回的距离换算为相似度分数（越大越相关）"""
+    if space in ("cosine", "ip"):
+        return 1.0 - distance
+    # 默认 l2 为平方欧氏距离；对归一化向量有 d = 2 - 2cos
+    return 1.0 - distance / 2.0
+
+CANDIDATE_FACTOR = 3  # 混合检索 / MMR 时每路召回 k 的倍数作为候选
+MMR_LAMBDA = 0.5       # MMR 中相关度与多样性的权衡（1 为只看相关度）
+
+def get_relevant_contexts_batch(embedding_adapter, queries: list, filepath: str, k: int = 2,
+                                dedupe: bool = True, where: dict = None, hybrid: bool = False,
+                                mmr: bool = False, lambda_mult: float = MMR_LAMBDA,
+                                collection_name: str = CHAPTER_COLLECTION, query_vectors: list = None) -> list:
     """
-    从向量库中检索与 query 最相关的 k 条文本，拼接后返回。
-    如果向量库加载/检索失败，则返回空字符串。
-    最终只返回最多2000字符的检索片段。
+    批量检索：所有查询一次批量 embedding，再对 collection_name 集合做一次多查询检索。
+    返回与 queries 等长的列表，每项为该查询的命中列表：
+        [{"id": 文档ID, "text": 文本, "score": 相似度, "distance": 距离, "metadata": 元数据}, ...]
+    dedupe=True 时按文档ID跨查询去重：同一文档只出现在第一个命中它的查询结果中。
+    where 为元数据过滤条件（见 build_retrieval_filter），直接下推给 Chroma，在检索阶段就排除不需要的分段。
+    hybrid=True 时同时用 BM25 稀疏索引召回，与向量召回按 RRF 融合排序，能命中人名、物品名等精确词；
+    此时 score 为融合分数，另附 dense_score（向量相似度，仅向量召回命中时有值）与 bm25_score。
+    mmr=True 时先召回 k*CANDIDATE_FACTOR 个候选，再按最大边际相关（MMR）选出 k 个彼此不重复的结果；
+    前面查询已选中的分段也计入多样性惩罚，近似重复的片段不会在不同查询里重复出现；
+    此时命中项另附 embedding（库中保存的分段向量，没有时为 None），供后续打分直接使用而无需重新计算。
+    query_vectors 为调用方已算好的查询向量（与 queries 等长），提供时不再查询备忘录。
+    向量库不存在或检索失败时，各查询返回空列表。
     """
-    store = load_vector_store(embedding_adapter, filepath)
+    results = [[] for _ in queries]
+    if not queries:
+        return results
+    store = load_vector_store(embedding_adapter, filepath, collection_name)
     if not store:
-        logging.info("No vector store found or load failed. Returning empty context.")
-        return ""
+        logging.info("No vector store found or load failed. Returning empty contexts.")
+        return results
 
     try:
-        docs = store.similarity_search(query, k=k)
-        if not docs:
-            logging.info(f"No relevant documents found for query '{query}'. Returning empty context.")
-            return ""
-        combined = "\n".join([d.page_content for d in docs])
-        if len(combined) > 2000:
-            combined = combined[:2000]
-        return combined
+        collection = store._collection
+        collection_size = collection.count()
+        if collection_size == 0:
+            return results
+        fetch_k = int(k) * CANDIDATE_FACTOR if (hybrid or mmr) else int(k)
+        n_results = max(1, min(fetch_k, collection_size))
+
+        vectors = query_vectors if query_vectors is not None else embed_queries_cached(embedding_adapter, queries)
+        valid = [i for i, v in enumerate(vectors) if v]
+        if not valid and not hybrid:
+            logging.warning("All query embeddings failed. Returning empty contexts.")
+            return results
+
+        include = ["documents", "metadatas", "distances"]
+        if mmr:
+            include.append("embeddings")
+        response = {}
+        if valid:
+            query_kwargs = {}
+            if where:
+                query_kwargs["where"] = where
+            response = collection.query(
+                query_embeddings=[vectors[i] for i in valid],
+                n_results=n_results,
+                include=include,
+                **query_kwargs
+            )
+        else:
+            logging.warning("All query embeddings failed. Falling back to BM25 results only.")
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+
+        candidates, embeddings = _dense_candidates(response, valid, len(queries), space)
+        if hybrid:
+            candidates = _fuse_sparse_candidates(
+                store, filepath, queries, candidates, embeddings, fetch_k, where, with_embeddings=mmr
+            )
+        if mmr:
+            return _select_mmr(candidates, embeddings, vectors, k, lambda_mult, dedupe)
+        return _select_top(candidates, k, dedupe)
     except Exception as e:
-        logging.warning(f"Similarity search failed: {e}")
+        logging.warning(f"Batch similarity search failed: {e}")
         traceback.print_exc()
+        return [[] for _ in queries]
+
+def _dense_candidates(response: dict, valid: list, query_count: int, space: str):
+    """把 Chroma 多查询结果整理为每个查询的候选列表（按相似度降序），并收集候选向量"""
+    candidates = [[] for _ in range(query_count)]
+    embeddings = {}
+    if not response:
+        return candidates, embeddings
+    for row, query_index in enumerate(valid):
+        ids = response["ids"][row]
+        documents = response["documents"][row]
+        metadatas = (response.get("metadatas") or [[None] * len(ids)] * len(valid))[row]
+        distances = response["distances"][row]
+        row_embeddings = response.get("embeddings")
+        row_embeddings = row_embeddings[row] if row_embeddings is not None else [None] * len(ids)
+        for doc_id, text, metadata, distance, embedding in zip(ids, documents, metadatas, distances, row_embeddings):
+            if not text:
+                continue
+            if embedding is not None:
+                embeddings[doc_id] = embedding
+            candidates[query_index].append({
+                "id": doc_id,
+                "text": text,
+                "score": _distance_to_score(distance, space),
+                "distance": distance,
+                "metadata": metadata or {}
+            })
+    return candidates, embeddings
+
+def _fuse_sparse_candidates(store, filepath: str, queries: list, candidates: list, embeddings: dict,
+                            fetch_k: int, where: dict, with_embeddings: bool = False) -> list:
+    """把向量召回候选与 BM25 召回候选按 RRF 融合，返回每个查询按融合分数降序的候选列表"""
+    sync_sparse_index(store, filepath)
+    index = _sparse_index_for(store, filepath)
+
+    docs = {hit["id"]: hit for hits in candidates for hit in hits}
+    sparse_rankings = [index.search(query, fetch_k) for query in queries]
+    # 仅 BM25 命中的文档需要补取正文与元数据（MMR 时还需向量），并用同一 where 条件过滤
+    sparse_only = {doc_id for ranking in sparse_rankings for doc_id, _ in ranking} - set(docs)
+    if sparse_only:
+        get_kwargs = {"where": where} if where else {}
+        include = ["documents", "metadatas"] + (["embeddings"] if with_embeddings else [])
+        fetched = store._collection.get(ids=list(sparse_only), include=include, **get_kwargs)
+        fetched_ids = fetched.get("ids", [])
+        fetched_embeddings = fetched.get("embeddings")
+        if fetched_embeddings is None:
+            fetched_embeddings = [None] * len(fetched_ids)
+        for doc_id, text, metadata, embedding in zip(fetched_ids, fetched.get("documents") or [],
+                                                     fetched.get("metadatas") or [], fetched_embeddings):
+            if not text:
+                continue
+            docs[doc_id] = {"id": doc_id, "text": text, "metadata": metadata or {}}
+            if embedding is not None:
+                embeddings[doc_id] = embedding
+
+    fused_candidates = []
+    for query_index, dense_hits in enumerate(candidates):
+        dense = {hit["id"]: hit for hit in dense_hits}
+        sparse = {doc_id: score for doc_id, score in sparse_rankings[query_index] if doc_id in docs}
+        fused = reciprocal_rank_fusion([list(dense), list(sparse)])
+        ranked = []
+        for doc_id in sorted(fused, key=fused.get, reverse=True):
+            hit = dense.get(doc_id)
+            ranked.append({
+                "id": doc_id,
+                "text": docs[doc_id]["text"],
+                "score": fused[doc_id],
+                "distance": hit["distance"] if hit else None,
+                "metadata": docs[doc_id]["metadata"],
+                "dense_score": hit["score"] if hit else None,
+                "bm25_score": sparse.get(doc_id, 0.0)
+            })
+        fused_candidates.append(ranked)
+    return fused_candidates
+
+def _select_top(candidates: list, k: int, dedupe: bool) -> list:
+    """按候选顺序为每个查询取前 k 个；dedupe 时跳过前面查询已取过的文档"""
+    results = []
+    seen_ids = set()
+    for hits in candidates:
+        selected = []
+        for hit in hits:
+            if len(selected) >= k:
+                break
+            if dedupe:
+                if hit["id"] in seen_ids:
+                    continue
+                seen_ids.add(hit["id"])
+            selected.append(hit)
+        results.append(selected)
+    return results
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def mmr_select(query_vector, candidate_vectors, k: int, lambda_mult: float = MMR_LAMBDA,
+               relevance=None, selected_vectors=None) -> list:
+    """
+    最大边际相关（MMR）选择，返回选中候选的下标列表（按选中顺序）。
+    每一步选 argmax[ λ·相关度 − (1−λ)·与已选结果的最大余弦相似度 ]。
+    - relevance：候选的相关度；为空时使用候选与 query_vector 的余弦相似度；
+    - selected_vectors：已在别处选中的向量，从一开始就计入多样性惩罚。
+    与已选集合的最大相似度随每次选择增量更新，总计算量为 O(候选数 × k) 次向量点积。
+    """
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    if candidates.ndim != 2 or len(candidates) == 0 or k <= 0:
+        return []
+    candidates = _normalize_rows(candidates)
+    if relevance is None:
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        relevance = candidates @ query
+    relevance = np.asarray(relevance, dtype=np.float32)
+
+    max_similarity = np.full(len(candidates), -np.inf, dtype=np.float32)
+    if selected_vectors is not None and len(selected_vectors):
+        selected = _normalize_rows(np.asarray(selected_vectors, dtype=np.float32))
+        max_similarity = (candidates @ selected.T).max(axis=1)
+
+    chosen = []
+    available = np.ones(len(candidates), dtype=bool)
+    for _ in range(min(k, len(candidates))):
+        penalty = np.where(np.isfinite(max_similarity), max_similarity, 0.0)
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * penalty
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        chosen.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, candidates @ candidates[best])
+    return chosen
+
+def _select_mmr(candidates: list, embeddings: dict, query_vectors: list, k: int,
+                lambda_mult: float, dedupe: bool) -> list:
+    """逐个查询做 MMR 选择；前面查询选中的分段计入后续查询的多样性惩罚"""
+    results = []
+    selected_vectors = []
+    seen_ids = set()
+    for query_index, hits in enumerate(candidates):
+        if dedupe:
+            hits = [hit for hit in hits if hit["id"] not in seen_ids]
+        with_vectors = [hit for hit in hits if hit["id"] in embeddings]
+        if not with_vectors:
+            # 没有向量可用（如 embedding 失败、仅 BM25 命中）时按原排序取前 k 个
+            chosen_hits = hits[:k]
+        else:
+            # 相关度：纯向量检索用余弦相似度；混合检索用归一化后的融合分数，避免压低仅 BM25 命中的精确词结果
+            relevance = None
+            if "bm25_score" in with_vectors[0] or not query_vectors[query_index]:
+                scores = np.array([hit["score"] for hit in with_vectors], dtype=np.float32)
+                relevance = scores / (scores.max() or 1.0)
+            order = mmr_select(
+                query_vectors[query_index],
+                [embeddings[hit["id"]] for hit in with_vectors],
+                k,
+                lambda_mult=lambda_mult,
+                relevance=relevance,
+                selected_vectors=selected_vectors
+            )
+            chosen_hits = [with_vectors[i] for i in order]
+        chosen_hits = [dict(hit, embedding=embeddings.get(hit["id"])) for hit in chosen_hits]
+        for hit in chosen_hits:
+            seen_ids.add(hit["id"])
+            if hit["embedding"] is not None:
+                selected_vectors.append(hit["embedding"])
+        results.append(chosen_hits)
+    return results
+
+def get_relevant_context_from_vector_store(embedding_adapter, query: str, filepath: str, k: int = 2,
+                                           where: dict = None, collection_name: str = CHAPTER_COLLECTION) -> str:
+    """
+    从向量库中检索与 query 最相关的 k 条文本，拼接后返回。
+    如果向量库加载/检索失败，则返回空字符串。
+    最终只返回最多2000字符的检索片段。
+    """
+    hits = get_relevant_contexts_batch(embedding_adapter, [query], filepath, k=k, where=where,
+                                       collection_name=collection_name)[0]
+    if not hits:
+        logging.info(f"No relevant documents found for query '{query}'. Returning empty context.")
         return ""
+    combined = "\n".join(hit["text"] for hit in hits)
+    if len(combined) > 2000:
+        combined = combined[:2000]
+    return combined
 
 def _get_sentence_transformer(model_name: str = 'paraphrase-MiniLM-L6-v2'):
     """获取sentence transformer模型，处理SSL问题"""
@@ -915,6 +915,30 @@ summary_prompt = """\
 仅返回前文摘要文本，不要解释任何内容。
 """
 
+# 单章摘要（定稿时生成并保存，生成后续章节时直接拼接为前情回顾）
+chapter_summary_prompt = """\
+你是一位专业的小说编辑，请为刚定稿的章节写一份供后续章节衔接使用的单章摘要。
+
+## 章节信息
+- 章节编号：第{chapter_number}章
+- 章节标题：{chapter_title}
+- 章节定位：{chapter_role}
+- 核心作用：{chapter_purpose}
+
+## 章节正文
+{chapter_text}
+
+## 摘要要求
+1. 按发生顺序概括本章的核心事件与关键决策
+2. 写明主要角色的状态变化（修为、伤势、关系、立场）以及关键道具的得失
+3. 写明本章结尾时的场景、时间与悬念，以及新埋下或回收的伏笔
+4. 客观陈述，不评价、不展开联想
+5. 总字数控制在{max_chars}字以内
+
+请按如下格式输出（不需要额外解释）：
+本章摘要: <这里写本章摘要>
+"""
+
 # =============== 7. 角色状态更新 ===================
 create_character_state_prompt = """\
 你是一位专业的小说角色状态更新专家，擅长梳理复杂的唱片小说角色状态，精准提炼关键信息。
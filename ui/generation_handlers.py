@@ -17,9 +17,12 @@ from novel_generator import (
     generate_chapter_draft,
     finalize_chapter,
     import_knowledge_file,
+    import_knowledge_files,
     clear_vector_store,
     enrich_chapter_text
 )
+from novel_generator.common import load_novel_settings
+from novel_generator.role_index import read_role_contents
 from consistency_checker import check_consistency
 
 def show_directory_generation_dialog(master, max_chapters):
@@ -286,6 +289,31 @@ def generate_chapter_blueprint_ui(self):
         self.handle_exception("打开章节目录生成对话框时出错")
         self.enable_button_safe(self.btn_generate_directory)
         
+def _prompt_build_kwargs(self, filepath: str, chap_num: int) -> dict:
+    """按界面当前的配置与章节参数，生成 build_chapter_prompt 的参数（不含回调函数）"""
+    return dict(
+        api_key=self.api_key_var.get().strip(),
+        base_url=self.base_url_var.get().strip(),
+        model_name=self.model_name_var.get().strip(),
+        filepath=filepath,
+        novel_number=chap_num,
+        word_number=self.safe_get_int(self.word_number_var, 3000),
+        temperature=self.temperature_var.get(),
+        user_guidance=self.user_guide_text.get("0.0", "end").strip(),
+        characters_involved=self.characters_involved_var.get().strip(),
+        key_items=self.key_items_var.get().strip(),
+        scene_location=self.scene_location_var.get().strip(),
+        time_constraint=self.time_constraint_var.get().strip(),
+        embedding_api_key=self.embedding_api_key_var.get().strip(),
+        embedding_url=self.embedding_url_var.get().strip(),
+        embedding_interface_format=self.embedding_interface_format_var.get().strip(),
+        embedding_model_name=self.embedding_model_name_var.get().strip(),
+        embedding_retrieval_k=self.safe_get_int(self.embedding_retrieval_k_var, 4),
+        interface_format=self.interface_format_var.get().strip(),
+        max_tokens=self.max_tokens_var.get(),
+        timeout=self.safe_get_int(self.timeout_var, 600)
+    )
+
 def generate_chapter_draft_ui(self):
     filepath = self.filepath_var.get().strip()
     if not filepath:
@@ -317,6 +345,7 @@ def generate_chapter_draft_ui(self):
             embedding_interface_format = self.embedding_interface_format_var.get().strip()
             embedding_model_name = self.embedding_model_name_var.get().strip()
             embedding_k = self.safe_get_int(self.embedding_retrieval_k_var, 4)
+            build_kwargs = _prompt_build_kwargs(self, filepath, chap_num)
 
             self.safe_log(f"生成第{chap_num}章草稿：准备打开提示词编辑窗口...")
 
@@ -397,7 +426,11 @@ def generate_chapter_draft_ui(self):
                 def on_build_prompt():
                     # 禁用构建按钮，防止重复点击
                     btn_build.configure(state="disabled")
-                    self.safe_log(f"开始构建第{chap_num}章提示词...")
+                    force_rebuild = force_rebuild_var.get()
+                    # 重新构建时清空上一次的结果，避免两份提示词拼接在一起
+                    text_box.delete("0.0", "end")
+                    update_word_count()
+                    self.safe_log(f"开始构建第{chap_num}章提示词{'（强制重建，忽略缓存）' if force_rebuild else ''}...")
 
                     # 提示词更新回调
                     def on_prompt_update(text):
@@ -416,49 +449,29 @@ def generate_chapter_draft_ui(self):
 
                     def build_prompt_in_thread():                        
                         try:
-                            # 调用 build_chapter_prompt 函数构造初始提示词
-                            from novel_generator.chapter import build_chapter_prompt
-                            prompt_text = build_chapter_prompt(
-                                api_key=api_key,
-                                base_url=base_url,
-                                model_name=model_name,
-                            filepath=filepath,
-                            novel_number=chap_num,
-                            word_number=word_number,
-                            temperature=temperature,
-                            user_guidance=user_guidance,
-                            characters_involved=char_inv,
-                            key_items=key_items,
-                            scene_location=scene_loc,
-                            time_constraint=time_constr,
-                            embedding_api_key=embedding_api_key,
-                            embedding_url=embedding_url,
-                            embedding_interface_format=embedding_interface_format,
-                            embedding_model_name=embedding_model_name,
-                            embedding_retrieval_k=embedding_k,
-                            interface_format=interface_format,
-                            max_tokens=max_tokens,
-                            timeout=timeout_val,
-                            prompt_callback=on_prompt_update,
-                            progress_callback=on_progress_update
-                        )
+                            from novel_generator.prompt_prebuild import (
+                                get_prebuilt_prompt, is_prebuild_running, PREBUILD_WAIT_TIMEOUT
+                            )
+                            from novel_generator.prompt_cache import build_chapter_prompt_cached
+                            # 定稿后的后台预构建仍在进行时短暂等待其完成（结果写入提示词缓存），超时则直接构建
+                            if not force_rebuild and is_prebuild_running(filepath, chap_num):
+                                on_progress_update(0.5, "等待后台预构建的提示词...")
+                                if get_prebuilt_prompt(filepath, chap_num, build_kwargs,
+                                                       wait_timeout=PREBUILD_WAIT_TIMEOUT) is None:
+                                    self.safe_log("后台预构建尚未完成，直接构建提示词...")
+                            # 输入（文件、章节参数、用户指导、向量库内容）未变化时直接使用缓存的构建结果
+                            prompt_text = build_chapter_prompt_cached(
+                                build_kwargs,
+                                force=force_rebuild,
+                                prompt_callback=on_prompt_update,
+                                progress_callback=on_progress_update
+                            )
 
                             # 插入角色内容
                             final_prompt = prompt_text
                             role_names = [name.strip() for name in self.char_inv_text.get("0.0", "end").strip().split(',') if name.strip()]
-                            role_lib_path = os.path.join(filepath, "角色库")
-                            role_contents = []
-
-                            if os.path.exists(role_lib_path):
-                                for root, dirs, files in os.walk(role_lib_path):
-                                    for file in files:
-                                        if file.endswith(".txt") and os.path.splitext(file)[0] in role_names:
-                                            file_path = os.path.join(root, file)
-                                            try:
-                                                with open(file_path, 'r', encoding='utf-8') as f:
-                                                    role_contents.append(f.read().strip())  # 直接使用文件内容，不添加重复名字
-                                            except Exception as e:
-                                                self.safe_log(f"读取角色文件 {file} 失败: {str(e)}")
+                            # 通过角色库索引只读取本章涉及的角色文件，不遍历整个角色库
+                            role_contents = read_role_contents(filepath, role_names) if role_names else []
 
                             if role_contents:
                                 role_content_str = "\n".join(role_contents)
@@ -519,6 +532,10 @@ def generate_chapter_draft_ui(self):
                 btn_build = ctk.CTkButton(button_frame, text="构建提示词", font=("Microsoft YaHei", 11), command=on_build_prompt)
                 btn_build.pack(side="left", padx=5, pady=10)
 
+                # 强制重建：忽略缓存，重新检索并生成提示词
+                force_rebuild_var = ctk.BooleanVar(value=False)
+                ctk.CTkCheckBox(button_frame, text="强制重建", variable=force_rebuild_var, font=("Microsoft YaHei", 11)).pack(side="left", padx=5, pady=10)
+
                 # 确认使用按钮
                 btn_confirm = ctk.CTkButton(button_frame, text="确认使用", font=("Microsoft YaHei", 11), command=on_confirm, state="disabled")
                 btn_confirm.pack(side="left", padx=5, pady=10)
@@ -676,7 +693,14 @@ def finalize_chapter_ui(self):
             finalized_file = os.path.join(chapters_dir, f"chapter_{chap_num}_finalized.txt")
             save_string_to_txt(edited_text, finalized_file)
 
-            self.safe_log(f"✅ 第{chap_num}章定稿完成（已更新前文摘要、角色状态、向量库）。")
+            self.safe_log(f"✅ 第{chap_num}章定稿完成（已更新前文摘要、角色状态，向量库在后台写入）。")
+
+            # 可选：在后台预构建下一章的提示词（novel_settings.json 中 prebuild_next_prompt 为 true 时）
+            if load_novel_settings(filepath).get("prebuild_next_prompt"):
+                from novel_generator.prompt_prebuild import start_prompt_prebuild
+                if start_prompt_prebuild(filepath, chap_num + 1, _prompt_build_kwargs(self, filepath, chap_num + 1),
+                                         log_func=self.safe_log):
+                    self.safe_log(f"正在后台预构建第{chap_num + 1}章的提示词...")
             
             # 在主线程中更新UI
             def update_ui():
@@ -750,11 +774,11 @@ def do_consistency_check(self):
     threading.Thread(target=task, daemon=True).start()
 
 def import_knowledge_handler(self):
-    selected_file = tk.filedialog.askopenfilename(
-        title="选择要导入的知识库文件",
-        filetypes=[("Text Files", "*.txt"), ("All Files", "*.*")]
+    selected_files = tk.filedialog.askopenfilenames(
+        title="选择要导入的知识库文件（可多选）",
+        filetypes=[("Text Files", "*.txt"), ("Markdown Files", "*.md"), ("All Files", "*.*")]
     )
-    if selected_file:
+    if selected_files:
         def task():
             self.disable_button_safe(self.btn_import_knowledge)
             try:
@@ -762,48 +786,37 @@ def import_knowledge_handler(self):
                 emb_url = self.embedding_url_var.get().strip()
                 emb_format = self.embedding_interface_format_var.get().strip()
                 emb_model = self.embedding_model_name_var.get().strip()
+                filepath = self.filepath_var.get().strip()
 
-                # 尝试不同编码读取文件
-                content = None
-                encodings = ['utf-8', 'gbk', 'gb2312', 'ansi']
-                for encoding in encodings:
-                    try:
-                        with open(selected_file, 'r', encoding=encoding) as f:
-                            content = f.read()
-                            break
-                    except UnicodeDecodeError:
-                        continue
-                    except Exception as e:
-                        self.safe_log(f"读取文件时发生错误: {str(e)}")
-                        raise
-
-                if content is None:
-                    raise Exception("无法以任何已知编码格式读取文件")
-
-                # 创建临时UTF-8文件
-                import tempfile
-                import os
-                with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', delete=False, suffix='.txt') as temp:
-                    temp.write(content)
-                    temp_path = temp.name
-
-                try:
-                    self.safe_log(f"开始导入知识库文件: {selected_file}")
-                    import_knowledge_file(
+                if len(selected_files) == 1:
+                    # 单个文件：自动检测编码，流式导入（按长度分段，支持去重与断点续传）
+                    self.safe_log(f"开始导入知识库文件: {selected_files[0]}")
+                    inserted = import_knowledge_file(
                         embedding_api_key=emb_api_key,
                         embedding_url=emb_url,
                         embedding_interface_format=emb_format,
                         embedding_model_name=emb_model,
-                        file_path=temp_path,
-                        filepath=self.filepath_var.get().strip()
+                        file_path=selected_files[0],
+                        filepath=filepath
+                    )
+                    self.safe_log(f"✅ 知识库文件导入完成，新增{inserted}段。")
+                else:
+                    # 多个文件：进程池分段 + 批量 embedding 写入
+                    self.safe_log(f"开始批量导入{len(selected_files)}个知识库文件...")
+                    stats = import_knowledge_files(
+                        embedding_api_key=emb_api_key,
+                        embedding_url=emb_url,
+                        embedding_interface_format=emb_format,
+                        embedding_model_name=emb_model,
+                        paths=list(selected_files),
+                        filepath=filepath,
+                        progress_callback=lambda progress, description: self.safe_log(
+                            f"[{progress * 100:.0f}%] {description}"
+                        )
+                    )
+                    self.safe_log(
+                        f"✅ 知识库批量导入完成：新增{stats['inserted']}段，去重跳过{stats['duplicates']}段。"
                     )
-                    self.safe_log("✅ 知识库文件导入完成。")
-                finally:
-                    # 清理临时文件
-                    try:
-                        os.unlink(temp_path)
-                    except:
-                        pass
 
             except Exception:
                 self.handle_exception("导入知识库时出错")
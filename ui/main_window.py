@@ -12,6 +12,7 @@ from llm_adapters import create_llm_adapter
 
 from config_manager import load_config, save_config, test_llm_config, test_embedding_config
 from utils import read_file, save_string_to_txt, clear_file_content
+from novel_generator.vectorstore_utils import set_default_vector_backend
 from tooltips import tooltips
 
 from ui.context_menu import TextWidgetContextMenu
@@ -62,6 +63,8 @@ class NovelGeneratorGUI:
         # --------------- 配置文件路径 ---------------
         self.config_file = "config.json"
         self.loaded_config = load_config(self.config_file)
+        # 新建向量库使用的后端："chroma"（默认）或 "numpy"
+        set_default_vector_backend(self.loaded_config.get("vectorstore_backend", "chroma"))
 
         if self.loaded_config:
             last_llm = self.loaded_config.get("last_interface_format", "OpenAI")
@@ -9,6 +9,7 @@ from tkinter import messagebox, BooleanVar
 from customtkinter import CTkScrollableFrame, CTkTextbox, END
 from utils import read_file, save_string_to_txt  # 导入 utils 中的函数
 from novel_generator.common import invoke_with_cleaning  # 新增导入
+from novel_generator.role_index import update_role_index, refresh_role_index
 from prompt_definitions import Character_Import_Prompt
 
 DEFAULT_FONT = ("Microsoft YaHei", 12)
@@ -171,6 +172,14 @@ class RoleLibrary:
         if "全部" in self._get_all_categories():
             self.show_category("全部")
 
+    def _update_index(self, *paths):
+        """角色文件写入、删除或移动后更新角色库索引"""
+        update_role_index(os.path.dirname(self.save_path), paths)
+
+    def _refresh_index(self):
+        """分类目录增删、改名后刷新角色库索引"""
+        refresh_role_index(os.path.dirname(self.save_path))
+
     def _get_all_categories(self):
         """获取所有有效分类（包括动态更新）"""
         categories = ["全部"]
@@ -239,6 +248,7 @@ class RoleLibrary:
             try:
                 # 执行移动操作
                 shutil.move(old_path, new_path)
+                self._update_index(old_path, new_path)
                 
                 # 更新显示
                 self.selected_category = new_category if new_category != "全部" else "全部"
@@ -375,6 +385,7 @@ class RoleLibrary:
                             os.unlink(file_path)
                     except Exception as e:
                         print(f"删除文件{file_path}时出错: {e}")
+                self._refresh_index()
             os.makedirs(target_dir, exist_ok=True)
 
             # 调用LLM进行分析
@@ -709,6 +720,7 @@ class RoleLibrary:
                 # 直接写入文件，覆盖已存在的文件
                 with open(dest_path, 'w', encoding='utf-8') as f:
                     f.write('\n'.join(content_lines))
+                self._update_index(dest_path)
 
             # 刷新分类显示
             self.load_categories()
@@ -739,6 +751,7 @@ class RoleLibrary:
                 self.save_path, "全部", f"{self.current_role}.txt")
             if os.path.exists(all_path):
                 os.remove(all_path)
+            self._update_index(role_path, all_path)
             self.show_category(self.selected_category)
             self.preview_text.delete("1.0", "end")
             msg = messagebox.showinfo("成功", "角色已删除", parent=self.window)
@@ -843,6 +856,8 @@ class RoleLibrary:
                 old_path = os.path.join(self.save_path, self.selected_category,
                                         f"{self.current_role}.txt")
                 os.rename(old_path, save_path)
+                self._update_index(old_path)
+            self._update_index(save_path)
 
             # 更新显示
             self.current_role = new_name
@@ -957,6 +972,7 @@ class RoleLibrary:
                     # 回滚重命名操作
                     os.rename(new_path, old_path)
                     return
+            self._update_index(old_path, new_path, all_old_path, all_new_path)
 
             # 刷新显示
             self.current_role = new_name
@@ -997,6 +1013,7 @@ class RoleLibrary:
 
         with open(os.path.join(role_dir, f"{base_name}.txt"), "w", encoding="utf-8") as f:
             f.write(content)
+        self._update_index(os.path.join(role_dir, f"{base_name}.txt"))
 
         # 刷新显示
         self.show_category(category)
@@ -1160,6 +1177,7 @@ class RoleLibrary:
                                 os.remove(dst)
                                 shutil.move(src, dst)
                 shutil.rmtree(cat_path)
+            self._refresh_index()
             self.load_categories()
             # 刷新分类选择下拉框
             self.category_combobox.configure(values=self._get_all_categories())
@@ -1529,6 +1547,7 @@ class RoleLibrary:
             try:
                 os.rename(os.path.join(self.save_path, old_name),
                           os.path.join(self.save_path, new_name))
+                self._refresh_index()
                 self.load_categories()
                 # 更新分类选择框
                 self.category_combobox.configure(